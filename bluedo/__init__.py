@@ -3,13 +3,36 @@ import sys
 __version__ = "v2.5.0-dev"
 __projectname__ = "bluedo"
 
-try:
-    from . import bluedoapp
-except ImportError:
-    import bluedoapp
-
 
 def main(args=None):
+    argv = sys.argv if args is None else args
+
+    if argv[1:2] == ["replay"]:
+        from . import replay
+
+        return replay.main(argv[2:])
+
+    if argv[1:2] == ["calibrate"]:
+        from . import calibrate
+
+        return calibrate.main(argv[2:])
+
+    if argv[1:2] == ["status"]:
+        from . import service
+
+        return service.main(argv[2:])
+
+    # Headless mode must not import GTK, so bluedoapp is imported late
+    if "--headless" in argv[1:]:
+        from . import headless
+
+        return headless.main(argv)
+
+    try:
+        from . import bluedoapp
+    except ImportError:
+        import bluedoapp
+
     app = bluedoapp.BlueDo()
     return app.run(args)
 
@@ -0,0 +1,504 @@
+"""Desktop actions run when the user comes and goes.
+
+DesktopActions applies them in-process: GSettings for the screensaver,
+logind over D-Bus for unlocking and MPRIS for music. Whatever isn't
+available falls back to the shell commands below. GSettings isn't
+thread-safe, so actions hand that part to the main loop.
+
+ActionExecutor runs them off the probe thread, concurrently and with a
+time limit, lock and unlock first.
+"""
+
+import os
+import subprocess
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import NamedTuple
+
+from gi.repository import Gio, GLib
+
+from . import log
+
+LOGIN1_NAME = "org.freedesktop.login1"
+LOGIN1_PATH = "/org/freedesktop/login1"
+LOGIN1_MANAGER = "org.freedesktop.login1.Manager"
+LOGIN1_SESSION = "org.freedesktop.login1.Session"
+MPRIS_PREFIX = "org.mpris.MediaPlayer2."
+MPRIS_PATH = "/org/mpris/MediaPlayer2"
+MPRIS_PLAYER = "org.mpris.MediaPlayer2.Player"
+DBUS_TIMEOUT = 2000  # ms
+MAIN_CONTEXT_TIMEOUT = 5.0  # Seconds to wait for the main loop
+
+SESSION_SCHEMA = "org.gnome.desktop.session"
+SCREENSAVER_SCHEMA = "org.gnome.desktop.screensaver"
+
+UNLOCKED_IDLE_DELAY = 600
+LOCKED_IDLE_DELAY = 10
+
+MIXER_CONTROLS = ("Master", "Speaker", "Headphone")
+
+
+def in_main_context(func, timeout=MAIN_CONTEXT_TIMEOUT):
+    """Run func() in the default main context and return its result. Actions
+    run on pool threads, and GSettings may only be used from one thread.
+
+    Runs right here only if this thread can acquire the context, otherwise
+    waits for the thread that owns it to dispatch func. That thread must
+    not block on the caller meanwhile, see ActionExecutor.close().
+    """
+
+    done = threading.Event()
+    result = {}
+
+    def call():
+        try:
+            result["value"] = func()
+        except Exception as err:  # Raised again in the calling thread
+            result["error"] = err
+        done.set()
+        return GLib.SOURCE_REMOVE
+
+    GLib.MainContext.default().invoke_full(GLib.PRIORITY_DEFAULT, call)
+    if not done.wait(timeout):
+        raise TimeoutError(f"Main loop busy for {timeout}s")
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+class DesktopActions:
+    """Lock, unlock, mute and pause without forking, where possible.
+
+    The D-Bus connections, GSettings objects and logind session paths are
+    looked up once and reused.
+    """
+
+    def __init__(self):
+        self.gsettings = {}  # Schema: Gio.Settings, None if not installed
+        self.system_bus = None
+        self.session_bus = None
+        self.sessions = None  # logind session object paths
+        self.paused = []  # MPRIS players we paused
+        self.worker = None  # worker.CommandWorker for user commands, if enabled
+        self.session = None  # session.SessionMonitor, if followed
+
+    #
+    # Connections
+    #
+
+    def settings(self, schema):
+        """Return Gio.Settings for schema, None if it isn't installed. Only
+        from the main context, see in_main_context()."""
+
+        if schema not in self.gsettings:
+            source = Gio.SettingsSchemaSource.get_default()
+            if source is not None and source.lookup(schema, True) is not None:
+                self.gsettings[schema] = Gio.Settings.new(schema)
+            else:
+                log.info("GSettings schema %s not found.", schema)
+                self.gsettings[schema] = None
+        return self.gsettings[schema]
+
+    def bus(self, bus_type):
+        try:
+            if bus_type == Gio.BusType.SYSTEM:
+                if self.system_bus is None:
+                    self.system_bus = Gio.bus_get_sync(bus_type, None)
+                return self.system_bus
+            if self.session_bus is None:
+                self.session_bus = Gio.bus_get_sync(bus_type, None)
+            return self.session_bus
+        except GLib.Error as err:
+            log.warning("Unable to connect to D-Bus: %s", err)
+            return None
+
+    def call(self, bus, name, path, interface, method, args=None, reply=None):
+        return bus.call_sync(
+            name,
+            path,
+            interface,
+            method,
+            args,
+            None if reply is None else GLib.VariantType(reply),
+            Gio.DBusCallFlags.NONE,
+            DBUS_TIMEOUT,
+            None,
+        ).unpack()
+
+    def session_paths(self):
+        """Return logind object paths of our sessions. Our own session if
+        we are in one, else every session of our user."""
+
+        if self.sessions:
+            return self.sessions
+        bus = self.bus(Gio.BusType.SYSTEM)
+        if bus is None:
+            return []
+
+        def manager(method, args=None, reply=None):
+            return self.call(
+                bus, LOGIN1_NAME, LOGIN1_PATH, LOGIN1_MANAGER, method, args, reply
+            )
+
+        try:
+            try:
+                (path,) = manager(
+                    "GetSessionByPID", GLib.Variant("(u)", (os.getpid(),)), "(o)"
+                )
+                self.sessions = [path]
+            except GLib.Error:
+                # Not in a session, as when started from a systemd user unit
+                (sessions,) = manager("ListSessions", reply="(a(susso))")
+                self.sessions = [
+                    path for _, uid, _, _, path in sessions if uid == os.getuid()
+                ]
+        except GLib.Error as err:
+            log.warning("Unable to find logind session: %s", err)
+            return []
+
+        log.debug("logind sessions %s", self.sessions)
+        return self.sessions
+
+    def players(self):
+        """Return bus names of MPRIS media players, None without a bus"""
+
+        bus = self.bus(Gio.BusType.SESSION)
+        if bus is None:
+            return None
+        (names,) = self.call(
+            bus,
+            "org.freedesktop.DBus",
+            "/org/freedesktop/DBus",
+            "org.freedesktop.DBus",
+            "ListNames",
+            reply="(as)",
+        )
+        return [name for name in names if name.startswith(MPRIS_PREFIX)]
+
+    def player_call(self, player, method):
+        self.call(
+            self.bus(Gio.BusType.SESSION), player, MPRIS_PATH, MPRIS_PLAYER, method
+        )
+
+    def playing(self, player):
+        (status,) = self.call(
+            self.bus(Gio.BusType.SESSION),
+            player,
+            MPRIS_PATH,
+            "org.freedesktop.DBus.Properties",
+            "Get",
+            GLib.Variant("(ss)", (MPRIS_PLAYER, "PlaybackStatus")),
+            "(v)",
+        )
+        return status == "Playing"
+
+    #
+    # Actions
+    #
+
+    def lock(self):
+        """Soft-lock: let the screensaver lock after LOCKED_IDLE_DELAY"""
+
+        if not in_main_context(self.soft_lock):
+            lock()
+
+    def soft_lock(self):
+        """GSettings part of lock(), in the main context. False if the
+        schemas aren't installed."""
+
+        session = self.settings(SESSION_SCHEMA)
+        screensaver = self.settings(SCREENSAVER_SCHEMA)
+        if session is None or screensaver is None:
+            return False
+
+        if (
+            screensaver.get_boolean("lock-enabled")
+            and session.get_uint("idle-delay") == LOCKED_IDLE_DELAY
+            and screensaver.get_uint("lock-delay") == 0
+        ):
+            log.debug("Session already soft-locked.")
+            return True
+
+        log.info("Soft-locked session (%ss timeout).", LOCKED_IDLE_DELAY)
+        screensaver.set_boolean("lock-enabled", True)
+        session.set_uint("idle-delay", LOCKED_IDLE_DELAY)
+        screensaver.set_uint("lock-delay", 0)
+        Gio.Settings.sync()
+        return True
+
+    def reset_idle_delay(self):
+        """Undo the soft-lock, in the main context. False if the schema
+        isn't installed."""
+
+        session = self.settings(SESSION_SCHEMA)
+        if session is None:
+            return False
+        if session.get_uint("idle-delay") != UNLOCKED_IDLE_DELAY:
+            session.set_uint("idle-delay", UNLOCKED_IDLE_DELAY)
+            Gio.Settings.sync()
+        return True
+
+    def unlock(self):
+        """Reset idle delay and unlock the logind session"""
+
+        if self.session is not None and self.session.unlocked:
+            in_main_context(self.reset_idle_delay)
+            log.debug("Session not locked, not unlocking.")
+            return
+
+        paths = self.session_paths()
+        if not paths or not in_main_context(self.reset_idle_delay):
+            unlock()
+            return
+
+        log.info("Unlocked session.")
+        bus = self.bus(Gio.BusType.SYSTEM)
+        for path in paths:
+            try:
+                self.call(bus, LOGIN1_NAME, path, LOGIN1_SESSION, "Unlock")
+            except GLib.Error as err:
+                log.warning("Unable to unlock %s: %s", path, err)
+                self.sessions = None  # Look them up again next time
+
+    def mute(self):
+        mute()
+
+    def unmute(self):
+        unmute()
+
+    def pause_music(self):
+        """Pause every playing MPRIS player, remembering which"""
+
+        try:
+            players = self.players()
+        except GLib.Error:
+            players = None
+        if players is None:
+            pause_music()
+            return
+
+        log.info("Pausing music.")
+        self.paused = []
+        for player in players:
+            try:
+                if self.playing(player):
+                    self.player_call(player, "Pause")
+                    self.paused.append(player)
+            except GLib.Error as err:
+                log.warning("Unable to pause %s: %s", player, err)
+
+    def resume_music(self):
+        """Resume the players paused by pause_music"""
+
+        if not self.paused:
+            return
+        log.info("Resume music.")
+        paused, self.paused = self.paused, []
+        for player in paused:
+            try:
+                self.player_call(player, "Play")
+            except GLib.Error as err:
+                log.warning("Unable to resume %s: %s", player, err)
+
+    def run_user_command(self, cmd="", timeout=None):
+        if self.worker is None:
+            run_user_command(cmd, timeout)
+            return
+        log.info("Running user command <%s> in worker.", cmd)
+        self.worker.run(cmd, timeout)
+
+
+class Action(NamedTuple):
+    name: str
+    func: Callable
+    args: tuple = ()
+    priority: int = 1  # Lower runs first, equal priorities run together
+
+
+class ActionResult(NamedTuple):
+    name: str
+    error: Exception  # None if the action succeeded
+    elapsed: float  # Seconds
+
+
+class ActionExecutor:
+    """Run batches of actions in the background.
+
+    Batches run one at a time in the order submitted, so a here never
+    overtakes the away before it. Within a batch, each priority group runs
+    concurrently and must finish, or time out, before the next starts.
+    Errors and timeouts are logged and returned, never raised. A timed out
+    action can't be stopped, it is left running and reported.
+    """
+
+    def __init__(self, timeout=10.0, max_workers=4):
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="bluedo-action"
+        )
+        self.batches = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="bluedo-batch"
+        )
+        self.results = []  # Of the last batch
+        self.on_result = None  # Called with each ActionResult, on a pool thread
+
+    def submit(self, name, actions):
+        """Run actions. Returns a Future of their ActionResults."""
+        return self.batches.submit(self.run_batch, name, list(actions))
+
+    def run_batch(self, name, actions):
+        started = time.perf_counter()
+        results = []
+        for priority in sorted({action.priority for action in actions}):
+            group = [action for action in actions if action.priority == priority]
+            futures = {
+                self.pool.submit(self.run_one, action): action for action in group
+            }
+            done, pending = wait(futures, timeout=self.timeout)
+            for future in done:
+                results.append(future.result())
+            for future in pending:
+                action = futures[future]
+                log.error(
+                    "Action %s still running after %ss", action.name, self.timeout
+                )
+                result = ActionResult(
+                    action.name, TimeoutError(action.name), self.timeout
+                )
+                if self.on_result is not None:
+                    self.on_result(result)
+                results.append(result)
+
+        log.debug("Actions for %s done in %.3fs", name, time.perf_counter() - started)
+        self.results = results
+        return results
+
+    def run_one(self, action):
+        started = time.perf_counter()
+        error = None
+        try:
+            action.func(*action.args)
+        except Exception as err:  # Report, and let the other actions run
+            log.error("Action %s failed: %s", action.name, err)
+            error = err
+        result = ActionResult(action.name, error, time.perf_counter() - started)
+        log.debug("Action %s took %.1f ms", action.name, result.elapsed * 1000)
+        if self.on_result is not None:
+            self.on_result(result)
+        return result
+
+    def close(self, timeout=None):
+        """Wait up to timeout seconds for submitted batches, then stop.
+
+        Actions may wait for the main context, see in_main_context(). If
+        the caller owns it, as on exit from the main loop, it keeps
+        dispatching it while it waits.
+        """
+
+        last = self.batches.submit(lambda: None)
+        context = GLib.MainContext.default()
+        if context.is_owner():
+            iterate_until(context, last, timeout)
+        else:
+            wait([last], timeout=timeout)
+        self.batches.shutdown(wait=False, cancel_futures=True)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iterate_until(context, future, timeout=None):
+    """Dispatch context until future is done or timeout seconds passed"""
+
+    expired = []
+
+    def on_timeout():
+        expired.append(True)
+        return GLib.SOURCE_REMOVE
+
+    timer = None
+    if timeout is not None:
+        timer = GLib.timeout_add(int(timeout * 1000), on_timeout)
+    future.add_done_callback(lambda _future: context.wakeup())
+    while not future.done() and not expired:
+        context.iteration(True)
+    if timer is not None and not expired:
+        GLib.source_remove(timer)
+
+
+#
+# Shell fallbacks
+#
+
+
+def run_user_command(cmd="", timeout=None):
+    """Run user supplied command. Killed after timeout seconds."""
+    log.info("Running user command <%s>.", cmd)
+    subprocess.run(cmd, shell=True, check=True, timeout=timeout)
+
+
+def amixer(state, controls):
+    """Set controls in one amixer process"""
+
+    script = "".join(f"sset {control} {state}\n" for control in controls)
+    subprocess.run(
+        ["amixer", "-q", "-s"],
+        input=script,
+        text=True,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+
+
+def mute():
+    """Mute sound"""
+    log.info("Muting sound.")
+    amixer("mute", MIXER_CONTROLS[:1])
+
+
+def unmute():
+    """Unmute sound"""
+    log.info("Unmuting sound.")
+    amixer("unmute", MIXER_CONTROLS)
+
+
+def pause_music():
+    """Pause music"""
+    log.info("Pausing music.")
+    subprocess.run("playerctl pause 2> /dev/null", shell=True, check=True)
+
+
+def resume_music():
+    """Resume music"""
+    log.info("Resume music.")
+    subprocess.run("playerctl play 2> /dev/null", shell=True, check=True)
+
+
+def unlock():
+    """Unlock desktop session"""
+    log.info("Unlocked session.")
+
+    # Reset soft lock. Set lock time to something reasonable
+    cmd = f"gsettings set org.gnome.desktop.session idle-delay {UNLOCKED_IDLE_DELAY}; "
+
+    # Hard unlock.
+    cmd += "loginctl unlock-session $( loginctl list-sessions --no-legend| cut -f1 -d' ' ); "
+
+    subprocess.run(cmd, shell=True, check=True)
+
+
+def lock():
+    """Lock desktop session"""
+    log.info("Soft-locked session (%ss timeout).", LOCKED_IDLE_DELAY)
+
+    # Hard lock. Is problematic if your phone refuse to connect
+    # cmd = "/usr/bin/loginctl lock-session $( loginctl list-sessions --no-legend| cut -f1 -d' ' );"
+
+    # Soft lock. Set a very short lock time, 10 seconds
+    cmd = (
+        "gsettings set org.gnome.desktop.screensaver lock-enabled true; "
+        + f"gsettings set org.gnome.desktop.session idle-delay {LOCKED_IDLE_DELAY}; "
+        + "gsettings set org.gnome.desktop.screensaver lock-delay 0; "
+    )
+
+    subprocess.run(cmd, shell=True, check=True)
@@ -0,0 +1,225 @@
+"""Probing over several Bluetooth adapters.
+
+AdapterPool probes through every adapter present, or the ones listed in
+probe_adapters, each with its own probe and ProbeScheduler, all adapters
+at once. Readings of a device from several adapters are combined: "best"
+keeps the strongest, "mean" averages them.
+
+A classic connection lives on one adapter, so a device that answered on
+one is probed only there in later cycles. If it stops answering there, it
+is probed on the other adapters in the same cycle. BLE advertisements are
+heard by every adapter, so all of them are always asked.
+
+Adapters are looked up in sysfs before every cycle. One that disappears is
+dropped at once and its devices go to the others, one that appears is used
+from that cycle on. Whether each adapter is up, its probes, readings and
+busy time are published as metrics labelled with the adapter.
+"""
+
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import log, probe, scheduler
+
+SYSFS = "/sys/class/bluetooth"
+ADAPTER_NAME = re.compile(r"hci(\d+)")
+COMBINE_MODES = ("best", "mean")
+
+
+def list_adapters(sysfs=SYSFS):
+    """Return indexes of present adapters, [0] if sysfs can't be read"""
+
+    try:
+        names = os.listdir(sysfs)
+    except OSError:
+        return [0]
+    # Connections show up as hci0:256 and the like, skip those
+    matches = (ADAPTER_NAME.fullmatch(name) for name in names)
+    return sorted(int(match.group(1)) for match in matches if match)
+
+
+def adapter_index(name):
+    """Return the index of "hci1" or "1" """
+    return int(name.removeprefix("hci"))
+
+
+class Adapter:
+    """One adapter with its probe"""
+
+    def __init__(
+        self, index, backend, irks, max_workers, metrics=None, make_probe=None
+    ):
+        self.index = index
+        self.name = f"hci{index}"
+        make_probe = make_probe or probe.make_probe
+        self.probe = make_probe(backend, adapter=index, irks=irks)
+        self.scheduler = scheduler.ProbeScheduler(self.probe, max_workers=max_workers)
+        self.metrics = metrics.adapter(self.name) if metrics is not None else None
+        if self.metrics is not None:
+            self.metrics.up.set(1)
+
+    def probe_all(self, addresses):
+        started = time.perf_counter()
+        try:
+            samples = self.scheduler.probe_all(addresses)
+        except OSError as err:
+            log.warning("Probe failed: %s", err, adapter=self.name)
+            samples = dict.fromkeys(addresses)
+        if self.metrics is not None:
+            self.metrics.busy.inc(time.perf_counter() - started)
+            self.metrics.probes.inc(len(addresses))
+            self.metrics.readings.inc(
+                sum(1 for sample in samples.values() if sample is not None)
+            )
+        return samples
+
+    def close(self):
+        if self.metrics is not None:
+            self.metrics.up.set(0)
+        self.scheduler.close()
+
+
+class AdapterPool:
+    """A probe that spreads its work over several adapters.
+
+    Engine and calibrate probe through it with read_rssi_many. adapters is
+    a list of names like "hci1" to use, empty for all. max_workers is the
+    probe_concurrency of each adapter's ProbeScheduler. metrics is an
+    optional metrics.Metrics. make_probe(backend, adapter, irks) makes the
+    probe of each adapter, probe.make_probe by default.
+    """
+
+    def __init__(
+        self,
+        backend="auto",
+        adapters=(),
+        combine="best",
+        irks=(),
+        max_workers=3,
+        metrics=None,
+        sysfs=SYSFS,
+        make_probe=None,
+    ):
+        self.backend = backend
+        self.wanted = {adapter_index(name) for name in adapters}
+        self.combine = combine
+        self.irks = irks
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.sysfs = sysfs
+        self.make_probe = make_probe
+        self.adapters = {}  # Index: Adapter
+        self.home = {}  # Address: index of the adapter it last answered on
+        self.pool = None
+        self.refresh()
+
+    @property
+    def name(self):
+        names = ", ".join(adapter.name for adapter in self.adapters.values())
+        return f"{self.backend} on {names or 'no adapter'}"
+
+    @property
+    def needs_connection(self):
+        return any(adapter.probe.needs_connection for adapter in self.adapters.values())
+
+    def refresh(self):
+        """Follow adapters coming and going"""
+
+        present = set(list_adapters(self.sysfs))
+        if self.wanted:
+            present &= self.wanted
+        if present == set(self.adapters):
+            return
+
+        for index in set(self.adapters) - present:
+            adapter = self.adapters.pop(index)
+            log.warning("Adapter gone, probing without it", adapter=adapter.name)
+            adapter.close()
+        for index in sorted(present - set(self.adapters)):
+            log.info("Probing with adapter", adapter=f"hci{index}")
+            self.adapters[index] = Adapter(
+                index,
+                self.backend,
+                self.irks,
+                self.max_workers,
+                self.metrics,
+                self.make_probe,
+            )
+        self.home = {
+            address: index
+            for address, index in self.home.items()
+            if index in self.adapters
+        }
+
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        self.pool = ThreadPoolExecutor(
+            max_workers=max(1, len(self.adapters)), thread_name_prefix="bluedo-adapter"
+        )
+
+    def read_rssi(self, address):
+        return self.read_rssi_many([address])[address]
+
+    def read_rssi_many(self, addresses):
+        """Return {address: RssiSample or None}, combined over adapters"""
+
+        self.refresh()
+        heard = {address: [] for address in addresses}
+        homed = set()
+        plan = {index: [] for index in self.adapters}
+        for address in addresses:
+            home = self.home.get(address)
+            if home is not None and self.adapters[home].probe.needs_connection:
+                plan[home].append(address)
+                homed.add(address)
+            else:
+                for wanted in plan.values():
+                    wanted.append(address)
+        self.run(plan, heard)
+
+        # Devices lost on their adapter may have moved to another one
+        lost = [address for address in homed if not heard[address]]
+        if lost:
+            plan = {
+                index: [address for address in lost if self.home[address] != index]
+                for index in self.adapters
+            }
+            self.run(plan, heard)
+
+        samples = {}
+        for address, readings in heard.items():
+            if not readings:
+                self.home.pop(address, None)
+                samples[address] = None
+                continue
+            best = max(readings, key=lambda sample: sample.rssi)
+            self.home[address] = best.adapter
+            if self.combine == "mean" and len(readings) > 1:
+                rssi = round(sum(sample.rssi for sample in readings) / len(readings))
+                best = best._replace(rssi=rssi)
+            samples[address] = best
+        return samples
+
+    def run(self, plan, heard):
+        """Probe {index: addresses} on all adapters at once, add readings
+        to heard"""
+
+        futures = [
+            self.pool.submit(self.adapters[index].probe_all, addresses)
+            for index, addresses in plan.items()
+            if addresses
+        ]
+        for future in futures:
+            for address, sample in future.result().items():
+                if sample is not None:
+                    heard[address].append(sample)
+
+    def close(self):
+        for adapter in self.adapters.values():
+            adapter.close()
+        self.adapters = {}
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
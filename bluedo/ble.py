@@ -0,0 +1,567 @@
+"""Presence from BLE advertisements.
+
+Phones advertise several times a second whether or not anything is
+connected to them. The "ble" probe backend puts the adapter in passive LE
+scanning over a raw HCI socket, so nothing is sent to the phone and no
+connection is kept open, and collects the advertisements on a thread. A
+probe cycle gets the median RSSI each device advertised with in the last
+WINDOW seconds, or None if it wasn't heard.
+
+Phones advertise from resolvable private addresses that change every few
+minutes. With the identity resolving key (IRK) of a device such an address
+can be matched to it: the low 3 bytes are an AES-128 hash of the high 3
+under the IRK. IRKs of devices paired over LE are read from
+/var/lib/bluetooth, which needs root, or given with ble_irks as
+ADDRESS=KEY, KEY as BlueZ stores it. AES needs the cryptography package,
+install bluedo[ble].
+
+Raw HCI sockets need CAP_NET_RAW. Without it the scan can't start and an
+error says so; grant it to the Python running BlueDo with
+"setcap cap_net_raw+ep" on its real executable.
+
+bluetoothd may reconfigure scanning when it discovers devices itself, in
+which case advertisements still arrive, only maybe less often. Controllers
+the kernel drives with the Bluetooth 5 extended scan commands refuse the
+legacy ones, those are scanned with the extended commands instead, and
+report advertisements in extended reports. A scan the controller refuses
+is an error, not an empty room.
+
+RecordedAdvertisements plays back a btsnoop capture ("btmon -w FILE") in
+place of the adapter, for tests.
+"""
+
+import configparser
+import glob
+import os
+import socket
+import statistics
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from typing import NamedTuple
+
+from . import log
+from .probe import HCI_COMMAND_PKT, HCI_EVENT_PKT, HCI_FILTER, SOL_HCI, RssiSample
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # Only needed to resolve private addresses
+    Cipher = None
+
+EVT_CMD_COMPLETE = 0x0E
+EVT_LE_META_EVENT = 0x3E
+EVT_LE_ADVERTISING_REPORT = 0x02
+EVT_LE_EXT_ADVERTISING_REPORT = 0x0D
+
+OGF_LE_CTL = 0x08
+OPCODE_LE_SET_SCAN_PARAMETERS = (OGF_LE_CTL << 10) | 0x000B
+OPCODE_LE_SET_SCAN_ENABLE = (OGF_LE_CTL << 10) | 0x000C
+OPCODE_LE_SET_EXT_SCAN_PARAMETERS = (OGF_LE_CTL << 10) | 0x0041
+OPCODE_LE_SET_EXT_SCAN_ENABLE = (OGF_LE_CTL << 10) | 0x0042
+
+PASSIVE_SCAN = 0x00
+LE_1M_PHY = 0x01
+SCAN_INTERVAL = 0x0030  # 30 ms in 0.625 ms units, window the same: always on
+PUBLIC_ADDRESS = 0x00
+RANDOM_ADDRESS = 0x01
+ANONYMOUS_ADDRESS = 0xFF  # Extended reports only
+RSSI_UNAVAILABLE = 127
+EXT_DATA_MORE = 0b01  # Data status of an extended report with more to come
+# Event type, address type, address, primary PHY, secondary PHY, SID, TX
+# power, RSSI, periodic interval, direct address type, direct address, data
+# length
+EXT_REPORT = struct.Struct("<HB6sBBBbbHB6sB")
+
+WINDOW = 5.0  # Seconds of advertisements per reading
+MAX_ADVERTS = 256  # Kept per device
+CACHE_SIZE = 4096  # Resolved private addresses remembered
+COMMAND_TIMEOUT = 1.0  # Seconds
+BLUEZ_STORAGE = "/var/lib/bluetooth"
+
+
+class Advertisement(NamedTuple):
+    address: str  # As advertised, may be a private address
+    address_type: int
+    rssi: int
+    timestamp: float  # time.monotonic(), or recording time
+
+
+def address_text(raw):
+    """Convert a little endian bdaddr_t to "AA:BB:CC:DD:EE:FF" """
+    return ":".join(f"{byte:02X}" for byte in reversed(raw))
+
+
+def parse_advertising_report(packet, timestamp):
+    """Return the Advertisements in an HCI LE Advertising Report or LE
+    Extended Advertising Report event, [] for any other packet"""
+
+    if len(packet) < 5 or packet[0] != HCI_EVENT_PKT or packet[1] != EVT_LE_META_EVENT:
+        return []
+    if packet[3] == EVT_LE_ADVERTISING_REPORT:
+        return parse_legacy_reports(packet, timestamp)
+    if packet[3] == EVT_LE_EXT_ADVERTISING_REPORT:
+        return parse_extended_reports(packet, timestamp)
+    return []
+
+
+def parse_legacy_reports(packet, timestamp):
+    adverts = []
+    offset = 5
+    # One report after the other, as BlueZ reads them. Controllers send one.
+    for _ in range(packet[4]):
+        if offset + 9 > len(packet):
+            break
+        address_type = packet[offset + 1]
+        raw = packet[offset + 2 : offset + 8]
+        length = packet[offset + 8]
+        offset += 9 + length
+        if offset >= len(packet):
+            break
+        rssi = struct.unpack_from("<b", packet, offset)[0]
+        offset += 1
+        if rssi != RSSI_UNAVAILABLE:
+            adverts.append(
+                Advertisement(address_text(raw), address_type, rssi, timestamp)
+            )
+    return adverts
+
+
+def parse_extended_reports(packet, timestamp):
+    """Controllers the kernel scans with the extended commands send these,
+    also for legacy advertisements"""
+
+    adverts = []
+    offset = 5
+    for _ in range(packet[4]):
+        if offset + EXT_REPORT.size > len(packet):
+            break
+        event_type, address_type, raw, *_, rssi, _, _, _, length = (
+            EXT_REPORT.unpack_from(packet, offset)
+        )
+        offset += EXT_REPORT.size + length
+        if offset > len(packet):
+            break
+        if (event_type >> 5) & 0b11 == EXT_DATA_MORE:
+            continue  # Counted with its last fragment
+        if rssi != RSSI_UNAVAILABLE and address_type != ANONYMOUS_ADDRESS:
+            adverts.append(
+                Advertisement(address_text(raw), address_type, rssi, timestamp)
+            )
+    return adverts
+
+
+#
+# Private address resolution
+#
+
+
+def resolvable(address, address_type):
+    """True for a resolvable private address, top bits 01"""
+    return address_type == RANDOM_ADDRESS and int(address[:2], 16) >> 6 == 0b01
+
+
+def parse_irks(entries):
+    """Return {identity address: IRK} from "ADDRESS=KEY" entries, KEY in
+    hex as BlueZ stores it"""
+
+    irks = {}
+    for entry in entries:
+        address, _, key = entry.partition("=")
+        irks[address.strip().upper()] = bytes.fromhex(key.strip())[::-1]
+    return irks
+
+
+def load_bluez_irks(storage=BLUEZ_STORAGE):
+    """Return {identity address: IRK} of devices BlueZ has paired, {} if the
+    storage can't be read"""
+
+    irks = {}
+    for path in glob.glob(os.path.join(storage, "*", "*", "info")):
+        info = configparser.ConfigParser(interpolation=None)
+        try:
+            info.read(path)  # Skips files it can't open
+        except configparser.Error as err:
+            log.debug("Unable to read %s: %s", path, err)
+            continue
+        key = info.get("IdentityResolvingKey", "Key", fallback=None)
+        if key:
+            address = os.path.basename(os.path.dirname(path))
+            irks.update(parse_irks([f"{address}={key}"]))
+    return irks
+
+
+def ah(cipher, prand):
+    """The random address hash function of the Core spec, Vol 3 Part H 2.2.2"""
+
+    encryptor = cipher.encryptor()
+    return (encryptor.update(bytes(13) + prand) + encryptor.finalize())[-3:]
+
+
+class Resolver:
+    """Map advertised addresses to identity addresses"""
+
+    def __init__(self, irks=None):
+        self.irks = dict(irks or {})  # Identity address: IRK, MSB first
+        self.cache = {}  # Private address: identity address or None
+        if self.irks and Cipher is None:
+            log.warning("Resolving private addresses needs the cryptography package")
+            self.irks = {}
+        self.ciphers = {
+            address: Cipher(algorithms.AES(irk), modes.ECB())
+            for address, irk in self.irks.items()
+        }
+
+    def identity(self, address, address_type):
+        """Return the identity address behind address. Public and static
+        addresses are their own, private ones resolve to None if no IRK
+        matches."""
+
+        if not resolvable(address, address_type):
+            return address
+        if address in self.cache:
+            return self.cache[address]
+        raw = bytes.fromhex(address.replace(":", ""))
+        prand, hash_ = raw[:3], raw[3:]
+        identity = None
+        for candidate, cipher in self.ciphers.items():
+            if ah(cipher, prand) == hash_:
+                identity = candidate
+                break
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache.clear()
+        self.cache[address] = identity
+        return identity
+
+
+#
+# Collection
+#
+
+
+class AdvertisementTable:
+    """Recent advertisement RSSI of the watched devices, by identity
+    address. add() may be called from any thread."""
+
+    def __init__(self, resolver, window=WINDOW):
+        self.resolver = resolver
+        self.window = window
+        self.watched = set()
+        self.adverts = {}  # Identity address: deque of (timestamp, rssi)
+        self.lock = threading.Lock()
+
+    def watch(self, addresses):
+        addresses = {address.upper() for address in addresses}
+        with self.lock:
+            self.watched = addresses
+            for address in set(self.adverts) - addresses:
+                del self.adverts[address]
+
+    def add(self, advert):
+        address = self.resolver.identity(advert.address, advert.address_type)
+        if address not in self.watched:
+            return
+        with self.lock:
+            adverts = self.adverts.get(address)
+            if adverts is None:
+                adverts = self.adverts[address] = deque(maxlen=MAX_ADVERTS)
+            adverts.append((advert.timestamp, advert.rssi))
+
+    def reading(self, address, now):
+        """Return (median RSSI, time of the last advertisement) over the
+        last window seconds, None if there were none"""
+
+        with self.lock:
+            adverts = self.adverts.get(address.upper())
+            if not adverts:
+                return None
+            while adverts and adverts[0][0] < now - self.window:
+                adverts.popleft()
+            if not adverts:
+                return None
+            return statistics.median_high(rssi for _, rssi in adverts), adverts[-1][0]
+
+
+class CommandRefused(OSError):
+    """The controller answered an HCI command with an error status"""
+
+
+class BleScanner:
+    """Passive LE scan on a raw HCI socket, on a reader thread"""
+
+    def __init__(self, adapter=0):
+        self.adapter = adapter
+        self.extended = False  # Scanning with the extended commands
+        self.sock = None
+        self.thread = None
+        self.running = False
+        self.callback = None
+
+    def start(self, callback):
+        """Scan, calling callback(Advertisement) on the reader thread"""
+
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+        try:
+            sock.bind((self.adapter,))
+            event_mask = (1 << EVT_CMD_COMPLETE, 1 << (EVT_LE_META_EVENT - 32))
+            sock.setsockopt(
+                SOL_HCI,
+                HCI_FILTER,
+                struct.pack("<IIIH", 1 << HCI_EVENT_PKT, *event_mask, 0),
+            )
+            sock.settimeout(COMMAND_TIMEOUT)
+            self.sock = sock
+            self.enable()
+        except OSError:
+            sock.close()
+            self.sock = None
+            raise
+
+        self.callback = callback
+        self.running = True
+        self.thread = threading.Thread(target=self.read, name="bluedo-ble", daemon=True)
+        self.thread.start()
+
+    def enable(self):
+        """Start a passive scan. A controller the kernel has driven with the
+        extended scan commands refuses the legacy ones, so those are tried
+        next. Raises CommandRefused if neither is accepted."""
+
+        try:
+            self.stop_first(OPCODE_LE_SET_SCAN_ENABLE, struct.pack("<BB", 0, 0))
+            self.command(
+                OPCODE_LE_SET_SCAN_PARAMETERS,
+                struct.pack("<BHHBB", PASSIVE_SCAN, SCAN_INTERVAL, SCAN_INTERVAL, 0, 0),
+            )
+            # Every advertisement, not just the first from each address
+            self.command(OPCODE_LE_SET_SCAN_ENABLE, struct.pack("<BB", 1, 0))
+            self.extended = False
+            return
+        except CommandRefused as err:
+            log.debug("%s, trying extended scan commands", err)
+
+        self.stop_first(OPCODE_LE_SET_EXT_SCAN_ENABLE, struct.pack("<BBHH", 0, 0, 0, 0))
+        self.command(
+            OPCODE_LE_SET_EXT_SCAN_PARAMETERS,
+            struct.pack(
+                "<BBBBHH", 0, 0, LE_1M_PHY, PASSIVE_SCAN, SCAN_INTERVAL, SCAN_INTERVAL
+            ),
+        )
+        self.command(OPCODE_LE_SET_EXT_SCAN_ENABLE, struct.pack("<BBHH", 1, 0, 0, 0))
+        self.extended = True
+
+    def stop_first(self, opcode, params):
+        """Stop a running scan, parameters can't change while scanning. Some
+        controllers refuse to stop one that isn't running."""
+
+        try:
+            self.command(opcode, params)
+        except CommandRefused as err:
+            log.debug("%s", err)
+
+    def disable(self):
+        if self.extended:
+            self.command(
+                OPCODE_LE_SET_EXT_SCAN_ENABLE, struct.pack("<BBHH", 0, 0, 0, 0)
+            )
+        else:
+            self.command(OPCODE_LE_SET_SCAN_ENABLE, struct.pack("<BB", 0, 0))
+
+    def command(self, opcode, params):
+        """Send an HCI command and wait for it to complete. Raises
+        CommandRefused if the controller answers with an error status."""
+
+        self.sock.send(
+            struct.pack("<BHB", HCI_COMMAND_PKT, opcode, len(params)) + params
+        )
+        deadline = time.monotonic() + COMMAND_TIMEOUT
+        while time.monotonic() < deadline:
+            packet = self.sock.recv(260)
+            if (
+                len(packet) >= 7
+                and packet[1] == EVT_CMD_COMPLETE
+                and struct.unpack_from("<H", packet, 4)[0] == opcode
+            ):
+                if packet[6] != 0:
+                    raise CommandRefused(
+                        f"LE command {opcode:04x} refused, status {packet[6]:#04x}"
+                    )
+                return
+        raise TimeoutError(f"LE command {opcode:04x} got no reply")
+
+    def read(self):
+        while self.running:
+            try:
+                packet = self.sock.recv(260)
+            except TimeoutError:
+                continue
+            except OSError as err:
+                if self.running:
+                    log.warning("BLE scan stopped: %s", err)
+                self.running = False
+                return
+            for advert in parse_advertising_report(packet, time.monotonic()):
+                self.callback(advert)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(2 * COMMAND_TIMEOUT)
+            self.thread = None
+        if self.sock is not None:
+            try:
+                self.disable()
+            except OSError as err:
+                log.debug("Unable to stop LE scan: %s", err)
+            self.sock.close()
+            self.sock = None
+
+
+def scan_failed(err):
+    """Log why the LE scan couldn't start"""
+
+    if isinstance(err, PermissionError):
+        log.error(
+            "LE scanning needs CAP_NET_RAW, grant it with: "
+            "sudo setcap cap_net_raw+ep %s",
+            os.path.realpath(sys.executable),
+        )
+    elif isinstance(err, CommandRefused):
+        log.error("LE scan refused by the adapter: %s", err)
+    else:
+        log.info("Unable to start LE scan: %s", err)
+
+
+class BleProbe:
+    """Probe backend reading RSSI from advertisements"""
+
+    name = "ble"
+    needs_connection = False
+
+    def __init__(self, adapter=0, irks=None, window=WINDOW, source=None, clock=None):
+        self.adapter = adapter
+        self.table = AdvertisementTable(Resolver(irks), window)
+        self.source = source or BleScanner(adapter)
+        self.clock = clock or time.monotonic
+        self.started = False
+        self.lock = threading.Lock()
+
+    def open(self):
+        with self.lock:
+            if not self.started:
+                self.source.start(self.table.add)
+                self.started = True
+
+    def read_rssi(self, address):
+        return self.read_rssi_many([address])[address]
+
+    def read_rssi_many(self, addresses):
+        """Return {address: RssiSample or None}"""
+
+        self.table.watch(addresses)
+        try:
+            self.open()
+        except OSError as err:
+            scan_failed(err)
+        now = self.clock()
+        samples = {}
+        for address in addresses:
+            reading = self.table.reading(address, now)
+            samples[address] = (
+                None
+                if reading is None
+                else RssiSample(address, reading[0], reading[1], self.adapter)
+            )
+        return samples
+
+    def close(self):
+        with self.lock:
+            if self.started:
+                self.source.stop()
+                self.started = False
+
+
+def make_probe(adapter=0, irk_entries=()):
+    """Return a started BleProbe, with IRKs from BlueZ and irk_entries"""
+
+    irks = load_bluez_irks()
+    irks.update(parse_irks(irk_entries))
+    probe = BleProbe(adapter=adapter, irks=irks)
+    try:
+        probe.open()
+    except (OSError, AttributeError) as err:
+        # AttributeError: Python built without AF_BLUETOOTH
+        scan_failed(err)
+    return probe
+
+
+#
+# Test stand-in
+#
+
+BTSNOOP_MAGIC = b"btsnoop\0"
+BTSNOOP_H4 = 1002
+BTSNOOP_MONITOR = 2001
+MONITOR_EVENT_PKT = 3
+
+
+def read_btsnoop(path):
+    """Return [(seconds since the first packet, HCI event packet)] from a
+    btsnoop file, as written by btmon -w"""
+
+    with open(path, "rb") as f:
+        magic, _version, datalink = struct.unpack(">8sII", f.read(16))
+        if magic != BTSNOOP_MAGIC or datalink not in (BTSNOOP_H4, BTSNOOP_MONITOR):
+            raise ValueError(f"{path} is not a btsnoop H4 or monitor capture")
+        events = []
+        start = None
+        while len(header := f.read(24)) == 24:
+            _, length, flags, _, micros = struct.unpack(">IIIIq", header)
+            data = f.read(length)
+            if datalink == BTSNOOP_MONITOR:
+                if flags & 0xFFFF != MONITOR_EVENT_PKT:
+                    continue
+                data = bytes([HCI_EVENT_PKT]) + data
+            elif not data or data[0] != HCI_EVENT_PKT:
+                continue
+            if start is None:
+                start = micros
+            events.append(((micros - start) / 1e6, data))
+    return events
+
+
+class RecordedAdvertisements:
+    """Stand-in for BleScanner that plays back recorded HCI events.
+
+    Nothing is delivered until play(until) hands over every event up to
+    until seconds into the recording. Give the BleProbe clock=lambda:
+    recording.now so its window follows the recording.
+    """
+
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda event: event[0])
+        self.position = 0
+        self.now = 0.0
+        self.callback = None
+
+    @classmethod
+    def load(cls, path):
+        return cls(read_btsnoop(path))
+
+    def start(self, callback):
+        self.callback = callback
+
+    def stop(self):
+        self.callback = None
+
+    def play(self, until):
+        self.now = until
+        while (
+            self.position < len(self.events) and self.events[self.position][0] <= until
+        ):
+            timestamp, packet = self.events[self.position]
+            self.position += 1
+            if self.callback is not None:
+                for advert in parse_advertising_report(packet, timestamp):
+                    self.callback(advert)
@@ -2,55 +2,85 @@ import gi
 
 gi.require_version("Gtk", "3.0")
 gi.require_version("GdkPixbuf", "2.0")
-import configparser
 import os
-import subprocess
+import shutil
 import sys
-import syslog
-import threading
 import time
-from contextlib import suppress
 
-import appdirs
 from gi.repository import GdkPixbuf, Gio, GLib, Gtk
 
-from . import __projectname__, __version__
+from . import __projectname__, __version__, bluez, log, presence, service, uisink
+from .engine import CONFIG_PATH, Engine
 
 try:
     gi.require_version("AppIndicator3", "0.1")
     from gi.repository import AppIndicator3
 except ValueError:  # Namespace AppIndicator3 not available
-    syslog.syslog(
-        syslog.LOG_INFO, "Unable to find AppIndicator3, trying AyatanaAppIndicator3"
-    )
+    log.info("Unable to find AppIndicator3, trying AyatanaAppIndicator3")
     gi.require_version("AyatanaAppIndicator3", "0.1")
     from gi.repository import AyatanaAppIndicator3 as AppIndicator3
 
 
+# Widgets from the glade file, set as attributes on BlueDo
+MENU_WIDGETS = (
+    "dropdown_menu",
+    "menuitem_advanced",
+    "menuitem_autostart",
+    "menuitem_enable",
+    "menuitem_minimize",
+)
+WINDOW_WIDGETS = (
+    "button_enabled",
+    "check_awaylock",
+    "check_awaymute",
+    "check_awaypause",
+    "check_awayrun",
+    "check_hererun",
+    "check_hereunlock",
+    "check_resume",
+    "check_unmute",
+    "combo_device",
+    "entry_away",
+    "entry_here",
+    "instructions_viewport",
+    "label_info",
+    "levelSignal",
+    "link_bluetoothsettings",
+)
+
+
+def log_resources(what, started):
+    """Log time since started and resident memory"""
+
+    elapsed = time.perf_counter() - started
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        rss = 0
+    log.info("%s in %.3fs, RSS %.1f MiB", what, elapsed, rss / 1048576)
+
+
 class BlueDo(Gtk.Application):
-    config_path = appdirs.user_config_dir(__projectname__) + "/" + __projectname__ + ".ini"
-    config_section = "CONFIG"
+    config_path = CONFIG_PATH
     run_path = os.path.dirname(os.path.realpath(__file__)) + "/"
+    glade_path = run_path + "window.glade"
     autostart_dir = os.getenv("HOME") + "/.config/autostart/"
 
-    builder = None
-    enabled = False
-    debug = False
-    threshold = 0
-    interval = 4
-    away_count = 5
-    advanced = False
-    bt_address = ""
-    bt_name = ""
-    here_command = ""
-    away_command = ""
-    config = None
-    minimized = False  # Start up minimized
-    nearby_devices = []
-    ping_stop = False  # Signal background ping thread to shut down
-    scan_stop = False  # Signal background device thread to shut down
+    builder = None  # For the main window, None while it is not shown
+    demo_image = None
+    animation_timeout = None
+    engine = None  # engine.Engine, probing and actions
+    applying = False  # Widgets are being set from settings, don't save
+    start_enabled = False  # --enable
+    start_minimized = False  # --minimize
+    ui = None  # uisink.UiSink, feeds the window when it is shown
+    inventory = None  # bluez.DeviceInventory, None if falling back to bluetoothctl
+    scan_timer = None  # GLib source polling bluetoothctl while the window is shown
+    presence_service = None  # service.PresenceService, the D-Bus API
     window_width = 1020
     window_heigth = 750
+    ui_fps = 10  # Most window updates per second
 
     def __init__(self, *args, **kwargs):
         super().__init__(
@@ -60,6 +90,8 @@ class BlueDo(Gtk.Application):
             **kwargs,
         )
         self.window = None
+        self.created = time.perf_counter()
+        self.ui = uisink.UiSink(max_fps=self.ui_fps)
 
         # Command line options https://python-gtk-3-tutorial.readthedocs.io/en/latest/application.html
         self.add_main_option(
@@ -79,99 +111,115 @@ class BlueDo(Gtk.Application):
             None,
         )
 
+    @property
+    def settings(self):
+        return self.engine.settings
+
     def do_activate(self, *args):
-        """Load config, populate UI"""
+        """Load config and show the tray icon. The main window is built the
+        first time it is shown. Activating again, as starting bluedo a
+        second time does, only shows the window."""
+
+        if self.engine is not None:
+            if self.start_enabled and not self.settings.enabled:
+                self.engine.set_enabled(True)
+            self.show_window()
+            return
+
+        self.load_config()
+        self.icon_path = self.run_path + "images/bluedo.png"
+
+        # Tray menu, the only part of the glade file loaded at start
+        menu_builder = Gtk.Builder()
+        menu_builder.add_objects_from_file(self.glade_path, ["dropdown_menu"])
+        for name in MENU_WIDGETS:
+            setattr(self, name, menu_builder.get_object(name))
 
-        # Load widgets from glade file
-        self.builder = Gtk.Builder()
-        self.builder.add_from_file(self.run_path + "/window.glade")
-
-        self.button_enabled = self.builder.get_object("button_enabled")
-        self.combo_device = self.builder.get_object("combo_device")
-        self.entry_away = self.builder.get_object("entry_away")
-        self.entry_here = self.builder.get_object("entry_here")
-        self.check_hereunlock = self.builder.get_object("check_hereunlock")
-        self.check_hererun = self.builder.get_object("check_hererun")
-        self.check_resume = self.builder.get_object("check_resume")
-        self.check_unmute = self.builder.get_object("check_unmute")
-        self.check_awaylock = self.builder.get_object("check_awaylock")
-        self.check_awaypause = self.builder.get_object("check_awaypause")
-        self.check_awaymute = self.builder.get_object("check_awaymute")
-        self.check_unmute = self.builder.get_object("check_unmute")
-        self.check_awayrun = self.builder.get_object("check_awayrun")
-        self.menuitem_advanced = self.builder.get_object("menuitem_advanced")
-        self.menuitem_minimize = self.builder.get_object("menuitem_minimize")
-        self.dropdown_menu = self.builder.get_object("dropdown_menu")
-        self.menuitem_enable = self.builder.get_object("menuitem_enable")
-        self.label_info = self.builder.get_object("label_info")
-        self.levelSignal = self.builder.get_object("levelSignal")
-        self.instructions_viewport = self.builder.get_object("instructions_viewport")
-
-        self.link_bluetoothsettings = self.builder.get_object("link_bluetoothsettings")
-        self.link_bluetoothsettings.set_label("Bluetooth settings")
-        self.menuitem_autostart = self.builder.get_object("menuitem_autostart")
         self.menuitem_autostart.set_active(self.check_autostart())
+        self.menuitem_advanced.set_active(self.settings.advanced)
+        self.menuitem_minimize.set_active(self.settings.minimized)
+        self.menuitem_enable.set_active(self.settings.enabled)
+        self.menuitem_enable.set_sensitive(len(self.settings.bt_address) > 0)
 
-        self.show_animation()
+        # Signals
+        menu_builder.connect_signals(self)
+        self.handler_id = self.menuitem_enable.connect(
+            "toggled", self.menuitemenable_clicked
+        )
 
-        # Load config
-        self.load_config()
+        # Tray icon
+        self.indicator = AppIndicator3.Indicator.new(
+            "customtray",
+            self.run_path + "bluedo.png",
+            AppIndicator3.IndicatorCategory.APPLICATION_STATUS,
+        )
+        self.indicator.set_status(AppIndicator3.IndicatorStatus.ACTIVE)
+        self.indicator.set_menu(self.dropdown_menu)
+        log_resources("Tray ready", self.created)
+
+        log.info("%s enabled %s.", __projectname__, self.settings.enabled)
+
+        self.engine.watch_config()
+        self.engine.connect(self.on_engine_event)
+        self.engine.start()  # Ping selected device for RSSI
+
+        # The application already owns its name on the session bus
+        connection = self.get_dbus_connection()
+        if connection is not None:
+            self.presence_service = service.PresenceService(self.engine)
+            self.presence_service.register(connection, self.get_dbus_object_path())
+
+        self.inventory = bluez.open_inventory()
+        self.engine.reconnector.inventory = self.inventory
+        self.start_devicescan()  # Look for paired bluetooth devices
+
+        if not self.settings.minimized:
+            self.show_window()
+
+        Gtk.main()
+
+    def show_window(self):
+        """Build the main window from the glade file and show it"""
+
+        if self.window is not None:
+            self.window.present()
+            return
+
+        started = time.perf_counter()
+        self.builder = Gtk.Builder()
+        self.builder.add_objects_from_file(self.glade_path, ["main_window"])
+        for name in WINDOW_WIDGETS:
+            setattr(self, name, self.builder.get_object(name))
+
+        self.link_bluetoothsettings.set_label("Bluetooth settings")
 
         # Populate widgets
-        if self.bt_address:
-            self.combo_device.append_text(f"{self.bt_name} ({self.bt_address})")
-            self.combo_device.set_active(0)
+        for name, widget in self.check_widgets().items():
+            widget.set_active(getattr(self.settings, name))
+
+        if self.settings.bt_address:
+            self.combo_device.append(self.settings.bt_address, self.device_text())
+            self.combo_device.set_active_id(self.settings.bt_address)
 
-        if len(self.bt_address) > 0:
-            self.button_enabled.set_active(self.enabled)
-            self.menuitem_enable.set_active(self.enabled)
+        if len(self.settings.bt_address) > 0:
+            self.button_enabled.set_active(self.settings.enabled)
         else:
             self.button_enabled.set_sensitive(False)
-            self.menuitem_enable.set_sensitive(False)
-
-        self.entry_away.set_text(f"{self.away_command}")
-        self.entry_here.set_text(f"{self.here_command}")
 
-        # Icon
-        self.icon_path = self.run_path + "/images/bluedo.png"
+        self.entry_away.set_text(f"{self.settings.away_command}")
+        self.entry_here.set_text(f"{self.settings.here_command}")
 
         self.window = self.builder.get_object("main_window")
         try:
             self.window.set_icon_from_file(self.icon_path)
         except gi.repository.GLib.Error:
-            syslog.syslog(f"Unable to find icon {self.icon_path}")
-
-        self.on_enable_state(self.button_enabled, self.enabled)
-
-        # Signals
-        self.builder.connect_signals(self)
-        self.handler_id = self.menuitem_enable.connect(
-            "toggled", self.menuitemenable_clicked
-        )
-
-        self.window.show_all()
-
-        # Check for dependency playerctl
-        try:
-            subprocess.run("which playerctl > /dev/null", shell=True, check=True)
-            self.check_awaypause.set_sensitive(True)
-            self.check_resume.set_sensitive(True)
-        except subprocess.CalledProcessError:
-            self.check_awaypause.set_sensitive(False)
-            self.check_awaypause.set_label(
-                "Pause music - Install playerctl to enable this option"
-            )
-            self.check_resume.set_sensitive(False)
-            self.check_resume.set_label(
-                "Unpause music - Install playerctl to enable this option"
-            )
+            log.info("Unable to find icon %s", self.icon_path)
 
         # Check for dependency amixer
-        try:
-            subprocess.run("which amixer > /dev/null", shell=True, check=True)
+        if shutil.which("amixer"):
             self.check_awaymute.set_sensitive(True)
             self.check_unmute.set_sensitive(True)
-        except subprocess.CalledProcessError:
+        else:
             self.check_awaymute.set_sensitive(False)
             self.check_awaymute.set_label(
                 "Pause music - Install amixer to enable this option"
@@ -181,32 +229,66 @@ class BlueDo(Gtk.Application):
                 "Unpause music - Install amixer to enable this option"
             )
 
-        # Menu for about, advanced
-        self.menuitem_advanced.set_active(self.advanced)
-        self.advanced_clicked(self.menuitem_advanced)
+        # Signals
+        self.builder.connect_signals(self)
+        self.builder.get_object("menu_button").set_popup(self.dropdown_menu)
 
-        # Tray icon
-        self.indicator = AppIndicator3.Indicator.new(
-            "customtray",
-            self.run_path + "bluedo.png",
-            AppIndicator3.IndicatorCategory.APPLICATION_STATUS,
-        )
-        self.indicator.set_status(AppIndicator3.IndicatorStatus.ACTIVE)
-        self.indicator.set_menu(self.dropdown_menu)
+        self.window.show_all()
+        self.update_advanced()
+        self.show_animation()
 
-        if self.minimized:
-            self.menuitem_minimize.set_active(True)
-            self.window.hide()
+        # Fill combo_device
+        self.ui.attach(self.render)
+        self.refresh_devices()
+        if not self.inventory:
+            self.scan_timer = GLib.timeout_add_seconds(
+                max(1, int(self.settings.interval)), self.refresh_devices
+            )
 
-        self.start_devicethread()  # Look for paired bluetooth devices
-        self.start_pingthread()  # Ping selected device for RSSI
+        log_resources("Window shown", started)
 
-        Gtk.main()
+    def hide_window(self):
+        """Destroy the main window and everything in it. The tray icon
+        stays."""
+
+        if self.window is None:
+            return
+
+        started = time.perf_counter()
+        if self.animation_timeout:
+            GLib.source_remove(self.animation_timeout)
+            self.animation_timeout = None
+        self.ui.detach()
+        if self.scan_timer:
+            GLib.source_remove(self.scan_timer)
+            self.scan_timer = None
+
+        window = self.window
+        self.window = None  # Tells on_window_destroy this is not an exit
+        window.destroy()
+
+        # Drop our references so the widgets and pixbufs can be freed
+        self.builder = None
+        self.demo_image = None
+        for name in WINDOW_WIDGETS:
+            setattr(self, name, None)
+
+        log_resources("Window destroyed", started)
+
+    def on_window_destroy(self, widget):
+        """Closing the window exits, tearing it down on minimize doesn't"""
+
+        if self.window is not None:
+            self.on_exit_application()
 
     def on_exit_application(self, *args):
-        self.scan_stop = True
-        self.ping_stop = True
-        self.here_callback()
+        if self.presence_service is not None:
+            self.presence_service.unregister()
+            self.presence_service = None
+        if self.inventory:
+            self.inventory.stop()
+        self.engine.here_callback()
+        self.engine.stop()
 
         Gtk.main_quit()
 
@@ -219,14 +301,14 @@ class BlueDo(Gtk.Application):
         self.demo_image.set_from_animation(pixbufanim)
         self.instructions_viewport.add(self.demo_image)
         self.demo_image.show()
-        GLib.timeout_add(30000, self.stop_animation)
+        self.animation_timeout = GLib.timeout_add(30000, self.stop_animation)
 
     def stop_animation(self):
         """Switch demo animation to static image"""
 
-        path_picture = self.run_path + "unlocked.png"
-        if self.debug:
-            syslog.syslog(syslog.LOG_DEBUG, f"Showing picture <{path_picture}>")
+        self.animation_timeout = None
+        path_picture = self.run_path + "images/unlocked.png"
+        log.debug("Showing picture <%s>", path_picture)
 
         self.demo_image.set_from_animation(
             GdkPixbuf.PixbufAnimation.new_from_file(path_picture)
@@ -234,6 +316,7 @@ class BlueDo(Gtk.Application):
         self.instructions_viewport.remove(self.instructions_viewport.get_child())
         self.instructions_viewport.add(self.demo_image)
         self.demo_image.show()
+        return GLib.SOURCE_REMOVE
 
     #
     # Widgets
@@ -241,47 +324,47 @@ class BlueDo(Gtk.Application):
 
     def on_enable_state(self, widget, state):
         """When btnEnable changes state, start and stop pings"""
+        self.set_enabled(state)
 
-        if state == self.menuitem_enable.get_active():
-            # Called from menu
-            pass
-        else:
+    def set_enabled(self, state):
+        if state != self.menuitem_enable.get_active():
             # Set by user or config
             with self.menuitem_enable.handler_block(self.handler_id):
                 self.menuitem_enable.set_active(state)
 
-        syslog.syslog(syslog.LOG_INFO, f"{__projectname__} enabled {state}.")
-        self.enabled = state
+        log.info("%s enabled %s.", __projectname__, state)
+        self.settings.enabled = state
         self.save_config()
 
     def on_device_changed(self, widget):
         """When combo_device changes"""
-        text = ""
-        with suppress(AttributeError):
-            text = self.combo_device.get_active_text().strip()
-
-        if len(text) == 0:
-            self.button_enabled.set_sensitive(False)
-            self.menuitem_enable.set_sensitive(False)
+        if self.applying:
+            return
+        newaddress = self.combo_device.get_active_id()
+        text = self.combo_device.get_active_text() or ""
+
+        if not newaddress:
+            if not self.settings.bt_address:
+                self.button_enabled.set_sensitive(False)
+                self.menuitem_enable.set_sensitive(False)
         else:
-            newaddress = text.split()[-1].replace("(", "").replace(")", "")
-            newname = text.replace(newaddress, "").replace("(", "").replace(")", "")
+            newname = text.rpartition(" (")[0]
 
-            if newaddress != self.bt_address:
-                self.bt_address = newaddress
-                self.bt_name = newname
+            if newaddress != self.settings.bt_address:
+                self.settings.bt_address = newaddress
+                self.settings.bt_name = newname
                 self.button_enabled.set_sensitive(True)
                 self.menuitem_enable.set_sensitive(True)
                 self.save_config()
 
     def on_away_changed(self, widget):
         """When entry_away changes"""
-        self.away_command = widget.get_text()
+        self.settings.away_command = widget.get_text()
         self.save_config()
 
     def on_here_changed(self, widget):
         """When entry_here changes"""
-        self.here_command = widget.get_text()
+        self.settings.here_command = widget.get_text()
         self.save_config()
 
     def on_chkbutton_changed(self, widget):
@@ -290,8 +373,7 @@ class BlueDo(Gtk.Application):
 
     def disable_all(self):
         if self.button_enabled.get_sensitive():
-            if self.debug:
-                syslog.syslog(syslog.LOG_DEBUG, "disable_all")
+            log.debug("disable_all")
 
             self.button_enabled.set_sensitive(False)
             self.menuitem_enable.set_sensitive(False)
@@ -299,8 +381,7 @@ class BlueDo(Gtk.Application):
 
     def enable_all(self):
         if not self.button_enabled.get_sensitive():
-            if self.debug:
-                syslog.syslog(syslog.LOG_DEBUG, "enable_all")
+            log.debug("enable_all")
 
             self.button_enabled.set_sensitive(True)
             self.menuitem_enable.set_sensitive(True)
@@ -325,43 +406,45 @@ class BlueDo(Gtk.Application):
     def advanced_clicked(self, state):
         """Show advancd options"""
 
-        # menuitem_advanced = self.builder.get_object("menuitem_advanced")
-        self.advanced = self.menuitem_advanced.get_active()
+        self.settings.advanced = self.menuitem_advanced.get_active()
+        if self.window is not None:
+            self.update_advanced()
+        self.save_config()
 
-        check_hererun = self.builder.get_object("check_hererun")
-        entry_here = self.builder.get_object("entry_here")
-        check_awayrun = self.builder.get_object("check_awayrun")
-        entry_away = self.builder.get_object("entry_away")
+    def update_advanced(self):
+        """Show or hide the advanced widgets in the window"""
 
-        check_hererun.set_visible(self.advanced)
-        entry_here.set_visible(self.advanced)
-        check_awayrun.set_visible(self.advanced)
-        entry_away.set_visible(self.advanced)
+        advanced = self.settings.advanced
+        self.check_hererun.set_visible(advanced)
+        self.entry_here.set_visible(advanced)
+        self.check_awayrun.set_visible(advanced)
+        self.entry_away.set_visible(advanced)
 
         self.window.set_size_request(self.window_width, self.window_heigth)
 
-        if not self.advanced:
-            check_hererun.set_active(self.advanced)
-            check_awayrun.set_active(self.advanced)
+        if not advanced:
+            self.check_hererun.set_active(advanced)
+            self.check_awayrun.set_active(advanced)
             self.window.set_size_request(self.window_width, 450)
 
-        self.save_config()
-
     def minimize_clicked(self, state):
         """Toggle minimize to tray"""
 
-        self.minimized = self.menuitem_minimize.get_active()
+        self.settings.minimized = self.menuitem_minimize.get_active()
 
-        if self.minimized:
-            self.window.hide()
+        if self.settings.minimized:
+            self.hide_window()
         else:
-            self.window.show()
+            self.show_window()
 
         self.save_config()
 
     def menuitemenable_clicked(self, state):
         """Toggle enable"""
-        self.button_enabled.set_active(not self.button_enabled.get_active())
+        if self.window is not None:
+            self.button_enabled.set_active(not self.button_enabled.get_active())
+        else:
+            self.set_enabled(self.menuitem_enable.get_active())
 
     def autostart_clicked(self, state):
         """Toggle autostart"""
@@ -378,165 +461,71 @@ class BlueDo(Gtk.Application):
     #
 
     def save_config(self):
-        """Save config"""
-
-        if not self.config.has_section(self.config_section):
-            self.config.add_section(self.config_section)
-
-        self.config.set(self.config_section, "debug", str(self.debug))
-        self.config.set(self.config_section, "bt_address", self.bt_address)
-        self.config.set(self.config_section, "threshold", str(self.threshold))
-        self.config.set(self.config_section, "interval", str(self.interval))
-        self.config.set(self.config_section, "away_count", str(self.away_count))
-        self.config.set(self.config_section, "away_command", self.away_command)
-        self.config.set(self.config_section, "here_command", self.here_command)
-
-        self.config.set(self.config_section, "bt_name", self.bt_name)
-        self.config.set(
-            self.config_section, "here_unlock", str(self.check_hereunlock.get_active())
-        )
-        self.config.set(
-            self.config_section, "check_resume", str(self.check_resume.get_active())
-        )
-        self.config.set(
-            self.config_section, "check_unmute", str(self.check_unmute.get_active())
-        )
-        self.config.set(
-            self.config_section, "here_run", str(self.check_hererun.get_active())
-        )
-        self.config.set(
-            self.config_section, "away_lock", str(self.check_awaylock.get_active())
-        )
-        self.config.set(
-            self.config_section, "away_run", str(self.check_awayrun.get_active())
-        )
-        self.config.set(
-            self.config_section, "away_mute", str(self.check_awaymute.get_active())
-        )
-        self.config.set(
-            self.config_section, "away_pause", str(self.check_awaypause.get_active())
-        )
-        self.config.set(self.config_section, "advanced", str(self.advanced))
-        self.config.set(self.config_section, "minimized", str(self.minimized))
-        self.config.set(self.config_section, "enabled", str(self.enabled))
+        """Save config. Written to disk shortly after the last change."""
 
-        with open(self.config_path, mode="w", encoding="utf8") as f:
-            self.config.write(f)
+        if self.applying:
+            return
 
-    def load_config(self):
-        """Load config"""
-
-        if self.debug:
-            syslog.syslog(syslog.LOG_DEBUG, f"Loading config from {self.config_path}")
+        if self.window is not None:
+            for name, widget in self.check_widgets().items():
+                setattr(self.settings, name, widget.get_active())
 
-        self.config = configparser.ConfigParser(interpolation=None)
-        self.config.read(self.config_path)
+        self.engine.save_config()
 
-        if not os.path.isdir(os.path.dirname(self.config_path)):
-            os.mkdir(os.path.dirname(self.config_path))
-
-        if not self.config.has_section(self.config_section):
-            self.config.add_section(self.config_section)
+    def load_config(self):
+        """Load config"""
 
-        self.bt_address = self.config.get(
-            self.config_section, "bt_address", fallback=""
-        )
-        self.threshold = self.config.getint(
-            self.config_section, "threshold", fallback=-4
-        )
-        self.interval = self.config.getint(self.config_section, "interval", fallback=5)
-        self.away_count = self.config.getint(
-            self.config_section, "away_count", fallback=3
-        )
-        self.away_command = self.config.get(
-            self.config_section, "away_command", fallback=""
-        )
-        self.here_command = self.config.get(
-            self.config_section, "here_command", fallback=""
-        )
-        self.bt_name = self.config.get(
-            self.config_section, "bt_name", fallback="(current)"
-        )
-        if (
-            "true"
-            in self.config.get(self.config_section, "debug", fallback="false").lower()
-        ):
-            self.debug = True
-        if (
-            "true"
-            in self.config.get(
-                self.config_section, "here_unlock", fallback="true"
-            ).lower()
-        ):
-            self.check_hereunlock.set_active(True)
-        if (
-            "true"
-            in self.config.get(
-                self.config_section, "check_resume", fallback="false"
-            ).lower()
-        ):
-            self.check_resume.set_active(True)
-        if (
-            "true"
-            in self.config.get(
-                self.config_section, "check_unmute", fallback="false"
-            ).lower()
-        ):
-            self.check_unmute.set_active(True)
-        if (
-            "true"
-            in self.config.get(
-                self.config_section, "here_run", fallback="false"
-            ).lower()
-        ):
-            self.check_hererun.set_active(True)
-        if (
-            "true"
-            in self.config.get(
-                self.config_section, "away_lock", fallback="true"
-            ).lower()
-        ):
-            self.check_awaylock.set_active(True)
-        if (
-            "true"
-            in self.config.get(
-                self.config_section, "away_mute", fallback="false"
-            ).lower()
-        ):
-            self.check_awaymute.set_active(True)
-        if (
-            "true"
-            in self.config.get(
-                self.config_section, "away_pause", fallback="false"
-            ).lower()
-        ):
-            self.check_awaypause.set_active(True)
-        if (
-            "true"
-            in self.config.get(
-                self.config_section, "away_run", fallback="false"
-            ).lower()
-        ):
-            self.check_awayrun.set_active(True)
-        if (
-            "true"
-            in self.config.get(
-                self.config_section, "advanced", fallback="false"
-            ).lower()
-        ):
-            self.advanced = True
-        if (
-            "true"
-            in self.config.get(
-                self.config_section, "minimized", fallback="false"
-            ).lower()
-        ):
-            self.minimized = True
-        if (
-            "true"
-            in self.config.get(self.config_section, "enabled", fallback="false").lower()
-        ):
-            self.enabled = True
+        self.engine = Engine(self.config_path)
+        self.engine.load_config()
+        if self.start_enabled:
+            self.settings.enabled = True
+        if self.start_minimized:
+            self.settings.minimized = True
+        self.engine.connect_settings(self.apply_to_widgets)
+
+    def check_widgets(self):
+        """Settings shown as check buttons"""
+
+        return {
+            "here_unlock": self.check_hereunlock,
+            "here_run": self.check_hererun,
+            "check_resume": self.check_resume,
+            "check_unmute": self.check_unmute,
+            "away_lock": self.check_awaylock,
+            "away_mute": self.check_awaymute,
+            "away_pause": self.check_awaypause,
+            "away_run": self.check_awayrun,
+        }
+
+    def apply_to_widgets(self, changed):
+        """Show changed settings in the window, without saving them again"""
+
+        self.applying = True
+        try:
+            if "enabled" in changed:
+                self.menuitem_enable.set_active(self.settings.enabled)
+                self.menuitem_enable.set_sensitive(len(self.settings.bt_address) > 0)
+            if "advanced" in changed:
+                self.menuitem_advanced.set_active(self.settings.advanced)
+            if "minimized" in changed:
+                self.menuitem_minimize.set_active(self.settings.minimized)
+            if self.window is None:
+                return
+
+            for name, widget in self.check_widgets().items():
+                if name in changed:
+                    widget.set_active(getattr(self.settings, name))
+            if "here_command" in changed:
+                self.entry_here.set_text(self.settings.here_command)
+            if "away_command" in changed:
+                self.entry_away.set_text(self.settings.away_command)
+            if "bt_address" in changed or "bt_name" in changed:
+                self.show_devices(self.ui.state.get("devices", ()))
+                self.combo_device.set_active_id(self.settings.bt_address)
+            if "enabled" in changed:
+                self.button_enabled.set_active(self.settings.enabled)
+        finally:
+            self.applying = False
 
     def create_autostart(self, ensure=True):
         """Create autostart file. Or deletes if not ensure."""
@@ -564,84 +553,89 @@ Categories=Utility;
     # Bluetooth
     #
 
-    def bluetooth_list(self, dryrun=False):
-        """Load bluetooth devices"""
+    def bluetooth_list(self, callback):
+        """Load bluetooth devices from bluetoothctl, without blocking. Calls
+        callback(devices) on the main loop."""
 
-        cmd = ["bluetoothctl", "devices"]
-        devices = []
-
-        if dryrun:
-            self.devices = [
-                ("FP3", "84:cf:bf:8d:90:d4"),
-                ("[TV] TV stua", "8C:79:F5:B9:C4:BF"),
-                ("[TV] tv10b", "78:BD:BC:6E:C5:A3"),
-            ]
+        try:
+            proc = Gio.Subprocess.new(
+                ["bluetoothctl", "devices"],
+                Gio.SubprocessFlags.STDOUT_PIPE | Gio.SubprocessFlags.STDERR_SILENCE,
+            )
+        except GLib.Error as err:
+            log.warning("Unable to run bluetoothctl: %s", err)
+            return
+
+        def on_done(proc, result):
+            try:
+                _, stdout, _ = proc.communicate_utf8_finish(result)
+            except GLib.Error as err:
+                log.warning("bluetoothctl failed: %s", err)
+                return
+            callback(parse_bluetoothctl(stdout or ""))
+
+        proc.communicate_utf8_async(None, None, on_done)
+
+    def start_devicescan(self):
+        """Follow the BlueZ inventory. Without one, bluetoothctl is polled
+        while the window is shown, see refresh_devices."""
+
+        if self.inventory:
+            self.inventory.connect(self.refresh_devices)
+
+    def refresh_devices(self):
+        """Update combo_device from the inventory or bluetoothctl"""
+
+        if self.window is None:
+            return GLib.SOURCE_REMOVE
+        if self.inventory:
+            self.update_combodevices(self.inventory.devices())
         else:
-            with subprocess.Popen(
-                args=cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-            ) as proc:
-                for line in iter(proc.stdout.readline, b""):
-                    if BlueDo.debug:
-                        syslog.syslog(syslog.LOG_DEBUG, "bluetoothctl line: " + line)
-                    if line.strip() == "":  # iter calls until output is ''
-                        break
-                    if line == "No default controller available\n":
-                        break
-                    addr = ""
-                    try:
-                        addr = line.split()[1]
-                    except IndexError:
-                        syslog.syslog(
-                            syslog.LOG_INFO, "Skipping empty line from bluetoothctl."
-                        )
-                        continue
-                    name = " ".join(line.split()[2:])
-                    devices += [(name, addr)]
-
-                proc.communicate()  # Allow cmd to exit cleanly
-        return devices
-
-    def start_devicethread(self):
-        if self.debug:
-            syslog.syslog(syslog.LOG_DEBUG, "Staring thread update_combodevices")
-        t = threading.Thread(target=self.update_combodevices)
-        t.start()
-
-    def update_combodevices(self):
-        """Run bluetooth_list and compare if new bluetoothdevices are
-        present. Update combo_devices with result"""
-
-        while True:
-            if self.scan_stop:  # Check if asked to shut down
-                break
+            self.bluetooth_list(self.update_combodevices)
+        return GLib.SOURCE_CONTINUE
 
-            # Don't update combo if open
-            if self.combo_device.get_property("popup-shown"):
-                time.sleep(self.interval)
-                continue
+    def update_combodevices(self, newscan):
+        """Hand newscan, [(name, address)], to the window"""
+        self.ui.post(devices=tuple(newscan))
 
-            # Save contents of combo_device, clear and reset
-            newscan = self.bluetooth_list()
+    def render(self, changes):
+        """Apply state from the UI sink to the window. Returns what has to
+        wait."""
 
-            if len(newscan) == 0:
-                self.disable_all()
+        retry = []
+        if "rssi" in changes:
+            self.levelSignal.set_value(max(0, 10 + changes["rssi"]))
+
+        if "devices" in changes:
+            # Don't update combo if open
+            if self.combo_device.get_property("popup-shown"):
+                retry.append("devices")
             else:
-                self.enable_all()
+                self.show_devices(changes["devices"])
+        return retry
+
+    def show_devices(self, devices):
+        if len(devices) == 0:
+            self.disable_all()
+        else:
+            self.enable_all()
 
-            if newscan != self.nearby_devices:
-                self.nearby_devices = newscan
-                current = self.combo_device.get_active_text() or ""
-                self.combo_device.remove_all()
-                self.combo_device.append_text(current)
-                self.combo_device.set_active(0)
+        # Keep the selected device listed while it is out of range
+        rows = [(f"{name} ({address})", address) for name, address in devices]
+        address = self.settings.bt_address
+        if address and address not in {row_id for _, row_id in rows}:
+            rows.insert(0, (self.device_text(), address))
 
-                for address, name in newscan:
-                    self.combo_device.append_text(f"{address} ({name})")
+        applying, self.applying = self.applying, True
+        try:
+            uisink.sync_rows(self.combo_device.get_model(), rows)
+            if self.combo_device.get_active_id() is None and address:
+                self.combo_device.set_active_id(address)
+        finally:
+            self.applying = applying
 
-            time.sleep(self.interval)
+    def device_text(self):
+        return f"{self.settings.bt_name.strip()} ({self.settings.bt_address})"
 
     def do_command_line(self, command_line):
         """Parse app startup commandline arguments"""
@@ -649,214 +643,52 @@ Categories=Utility;
         options = command_line.get_options_dict()
         options = options.end().unpack()
 
-        if "enable" in options:
-            self.enabled = True
-        if "minimize" in options:
-            self.minimized = True
+        # Each launch's own options, a second launch activates this one
+        self.start_enabled = "enable" in options
+        self.start_minimized = "minimize" in options
 
         self.activate()
         return 0
 
-    def start_pingthread(self):
-        if self.debug:
-            syslog.syslog(syslog.LOG_DEBUG, "Staring thread bluetooth_ping")
-        thread = threading.Thread(
-            target=self.bluetooth_ping,
-            args=(),
-            kwargs={
-                "here_callback": self.here_callback,
-                "away_callback": self.away_callback,
-            },
-        )
-
-        thread.daemon = True  # Daemonize
-        thread.start()  # Start the thread
-        return thread
-
-    def bluetooth_ping(self, here_callback, away_callback):
-        """Ping selected bluetooth device. Perform actions based on RSSI."""
-
-        hcibin = "hcitool"
-        getrssicmd = [hcibin, "rssi"]
-
-        lost_pings = 0
-
-        while not self.ping_stop:
-            rssi = -99
-
-            if len(self.bt_address) < 17:
-                if self.debug:
-                    syslog.syslog(
-                        syslog.LOG_DEBUG,
-                        f"Invalid address {self.bt_address}, not scanning.",
-                    )
-                self.levelSignal.set_value(0)
-                time.sleep(self.interval)
-                continue
-
-            if self.debug:
-                syslog.syslog(
-                    syslog.LOG_DEBUG,
-                    f"Running BT scanning command <{' '.join(getrssicmd + [self.bt_address])}>",
-                )
-            with subprocess.Popen(
-                args=getrssicmd + [self.bt_address],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-            ) as proc:
-                for line in iter(proc.stdout.readline, b""):
-                    if self.debug and len(line) > 0:
-                        syslog.syslog(
-                            syslog.LOG_DEBUG, f"hcitool line: <{line.strip()}>"
-                        )
-                    if line.strip() == "":  # iter calls until output is ''
-                        break
-                    rssi = int(line.strip().split()[-1])
-
-            if rssi is None:
-                rssi = -99
-            self.levelSignal.set_value(10 + rssi)
-
-            if rssi is None or rssi < self.threshold:
-                if self.debug:
-                    syslog.syslog(syslog.LOG_DEBUG, "No connection")
-                    if lost_pings > 0:
-                        syslog.syslog(syslog.LOG_DEBUG, f"Lost {lost_pings}")
-                        if lost_pings % 5 == 0:
-                            attempt_bluetooth_connection(self.bt_address)
-
-                if self.enabled:
-                    lost_pings += 1
-                    if lost_pings == self.away_count:
-                        away_callback()
-            elif lost_pings > 0:
-                lost_pings = 0
-                here_callback()
-
-            time.sleep(self.interval)
-
     #
     # Callbacks
     #
 
-    def here_callback(self):
-        if self.debug:
-            syslog.syslog(syslog.LOG_DEBUG, "Here")
-
-        self.indicator.set_icon_full(self.run_path + "phonelink-white-18dp.svg", "Here")
-
-        if self.check_hereunlock.get_active():
-            unlock()
-
-        if self.check_hererun.get_active():
-            run_user_command(cmd=self.entry_here.get_text())
-
-        if self.check_resume.get_active():
-            resume_music()
-
-        if self.check_unmute.get_active():
-            unmute()
-
-    def away_callback(self):
-        if self.debug:
-            syslog.syslog(syslog.LOG_DEBUG, "Away")
-
-        self.indicator.set_icon_full(
-            self.run_path + "phonelink_off-white-18dp.svg", "Away"
-        )
-
-        if self.check_awaylock.get_active():
-            lock()
-
-        if self.check_awaymute.get_active():
-            mute()
-
-        if self.check_awaypause.get_active():
-            pause_music()
-
-        if self.check_awayrun.get_active():
-            run_user_command(cmd=self.entry_away.get_text())
-
-
-#
-# Static functions
-#
-
-
-def attempt_bluetooth_connection(device):
-    """Sometimes ubuntu seems to not reconnect automatically."""
-    syslog.syslog(syslog.LOG_INFO, "Attempting to start a bluetooth connection.")
-    subprocess.run(
-        f"/usr/bin/bluetoothctl connect {device} > /dev/null", shell=True, check=False
-    )
+    def on_engine_event(self, event):
+        """Show engine state. Called on the main loop after every cycle."""
 
+        self.ui.post(rssi=self.engine.rssi)
 
-def run_user_command(cmd=""):
-    """Run user supplied command"""
-    syslog.syslog(syslog.LOG_INFO, f"Running user command <{cmd}>.")
-    subprocess.run(cmd, shell=True, check=True)
-
-
-def mute():
-    """Mute sound"""
-    syslog.syslog(syslog.LOG_INFO, "Muting sound.")
-    subprocess.run("amixer set Master mute > /dev/null", shell=True, check=True)
-
-
-def unmute():
-    """Unmute sound"""
-    syslog.syslog(syslog.LOG_INFO, "Unmuting sound.")
-    subprocess.run(
-        "amixer set Master unmute > /dev/null; amixer set Speaker "
-        + "unmute > /dev/null; amixer set Headphone unmute > /dev/null;",
-        shell=True,
-        check=True,
-    )
-
-
-def pause_music():
-    """Pause music"""
-    syslog.syslog(syslog.LOG_INFO, "Pausing music.")
-    subprocess.run("playerctl pause 2> /dev/null", shell=True, check=True)
-
-
-def resume_music():
-    """Resume music"""
-    syslog.syslog(syslog.LOG_INFO, "Resume music.")
-    subprocess.run("playerctl play 2> /dev/null", shell=True, check=True)
-
-
-def unlock():
-    """Unlock desktop session"""
-    idledelay = 600
-    syslog.syslog(syslog.LOG_INFO, "Unlocked session.")
-
-    # Reset soft lock. Set lock time to something reasonable
-    cmd = f"gsettings set org.gnome.desktop.session idle-delay {idledelay}; "
-
-    # Hard unlock.
-    cmd += "loginctl unlock-session $( loginctl list-sessions --no-legend| cut -f1 -d' ' ); "
-
-    subprocess.run(cmd, shell=True, check=True)
-
-
-def lock():
-    """Lock desktop session"""
-    idledelay = 10
-    syslog.syslog(syslog.LOG_INFO, f"Soft-locked session ({idledelay}s timeout).")
+        if event == presence.HERE:
+            self.indicator.set_icon_full(
+                self.run_path + "phonelink-white-18dp.svg", "Here"
+            )
+        elif event == presence.LEAVING:
+            self.indicator.set_icon_full(
+                self.run_path + "phonelink-white-18dp.svg", "Leaving"
+            )
+        elif event == presence.AWAY:
+            self.indicator.set_icon_full(
+                self.run_path + "phonelink_off-white-18dp.svg", "Away"
+            )
 
-    # Hard lock. Is problematic if your phone refuse to connect
-    # cmd = "/usr/bin/loginctl lock-session $( loginctl list-sessions --no-legend| cut -f1 -d' ' );"
 
-    # Soft lock. Set a very short lock time, 10 seconds
-    cmd = (
-        "gsettings set org.gnome.desktop.screensaver lock-enabled true; "
-        + f"gsettings set org.gnome.desktop.session idle-delay {idledelay}; "
-        + "gsettings set org.gnome.desktop.screensaver lock-delay 0; "
-    )
+def parse_bluetoothctl(text):
+    """Return [(name, address)] from the output of bluetoothctl devices"""
 
-    subprocess.run(cmd, shell=True, check=True)
+    devices = []
+    for line in text.splitlines():
+        log.debug("bluetoothctl line: %s", line)
+        if line.strip() == "" or line == "No default controller available":
+            break
+        try:
+            addr = line.split()[1]
+        except IndexError:
+            log.info("Skipping empty line from bluetoothctl.")
+            continue
+        name = " ".join(line.split()[2:])
+        devices += [(name, addr)]
+    return devices
 
 
 if __name__ == "__main__":
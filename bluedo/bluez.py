@@ -0,0 +1,285 @@
+"""BlueZ device inventory over D-Bus.
+
+Keeps an in-memory table of the devices BlueZ knows about, fed by the
+org.freedesktop.DBus.ObjectManager interface on org.bluez. The table is
+filled once with GetManagedObjects and then kept current by the
+InterfacesAdded, InterfacesRemoved and PropertiesChanged signals, so no
+process has to be started to list devices.
+"""
+
+import threading
+
+from . import log
+
+BLUEZ_SERVICE = "org.bluez"
+ADAPTER_INTERFACE = "org.bluez.Adapter1"
+DEVICE_INTERFACE = "org.bluez.Device1"
+OBJECT_MANAGER_INTERFACE = "org.freedesktop.DBus.ObjectManager"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+
+# Device1 properties kept in the table
+DEVICE_PROPERTIES = ("Address", "Name", "Alias", "Paired", "Connected", "RSSI")
+
+
+class DeviceInventory:
+    """Device table for org.bluez, updated from D-Bus signals.
+
+    bus is a Gio.DBusConnection on the system bus, or a FakeBus in tests.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.adapters_table = {}  # Object path: adapter properties
+        self.devices_table = {}  # Object path: device properties
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.subscriptions = []
+
+    def start(self):
+        """Subscribe to BlueZ signals and load the current objects.
+
+        Raises whatever the bus raises (GLib.Error) if BlueZ is not available.
+        """
+
+        self.subscriptions = [
+            self.bus.signal_subscribe(
+                BLUEZ_SERVICE,
+                OBJECT_MANAGER_INTERFACE,
+                "InterfacesAdded",
+                "/",
+                None,
+                0,
+                self.on_interfaces_added,
+            ),
+            self.bus.signal_subscribe(
+                BLUEZ_SERVICE,
+                OBJECT_MANAGER_INTERFACE,
+                "InterfacesRemoved",
+                "/",
+                None,
+                0,
+                self.on_interfaces_removed,
+            ),
+            self.bus.signal_subscribe(
+                BLUEZ_SERVICE,
+                PROPERTIES_INTERFACE,
+                "PropertiesChanged",
+                None,
+                None,
+                0,
+                self.on_properties_changed,
+            ),
+        ]
+
+        try:
+            reply = self.bus.call_sync(
+                BLUEZ_SERVICE,
+                "/",
+                OBJECT_MANAGER_INTERFACE,
+                "GetManagedObjects",
+                None,
+                None,
+                0,
+                -1,
+                None,
+            )
+        except Exception:
+            self.stop()
+            raise
+
+        (objects,) = reply.unpack()
+        with self.lock:
+            for path, interfaces in objects.items():
+                self.add_interfaces(path, interfaces)
+        self.notify()
+
+    def stop(self):
+        """Unsubscribe from BlueZ signals"""
+
+        for subscription in self.subscriptions:
+            self.bus.signal_unsubscribe(subscription)
+        self.subscriptions = []
+
+    def connect(self, callback):
+        """Call callback() whenever the device table changes"""
+        self.listeners.append(callback)
+
+    def notify(self):
+        for callback in self.listeners:
+            callback()
+
+    def devices(self):
+        """Return known devices as (name, address), the same shape as
+        bluedoapp.parse_bluetoothctl. Empty if there is no adapter."""
+
+        with self.lock:
+            if not self.adapters_table:
+                return []
+            return [
+                (props.get("Name") or props.get("Alias", ""), props["Address"])
+                for _path, props in sorted(self.devices_table.items())
+                if "Address" in props
+            ]
+
+    def adapters(self):
+        """Return object paths of present adapters"""
+
+        with self.lock:
+            return sorted(self.adapters_table)
+
+    def device_path(self, address):
+        """Return the object path for address, or None"""
+
+        address = address.upper()
+        with self.lock:
+            for path, props in self.devices_table.items():
+                if props.get("Address", "").upper() == address:
+                    return path
+        return None
+
+    #
+    # Signal handlers
+    #
+
+    def add_interfaces(self, path, interfaces):
+        if ADAPTER_INTERFACE in interfaces:
+            self.adapters_table[path] = dict(interfaces[ADAPTER_INTERFACE])
+        if DEVICE_INTERFACE in interfaces:
+            props = interfaces[DEVICE_INTERFACE]
+            self.devices_table[path] = {
+                key: props[key] for key in DEVICE_PROPERTIES if key in props
+            }
+
+    def on_interfaces_added(self, connection, sender, path, interface, signal, params):
+        object_path, interfaces = params.unpack()
+        log.debug("bluez added %s", object_path)
+
+        with self.lock:
+            self.add_interfaces(object_path, interfaces)
+        self.notify()
+
+    def on_interfaces_removed(
+        self, connection, sender, path, interface, signal, params
+    ):
+        object_path, interfaces = params.unpack()
+        log.debug("bluez removed %s", object_path)
+
+        with self.lock:
+            if ADAPTER_INTERFACE in interfaces:
+                self.adapters_table.pop(object_path, None)
+            if DEVICE_INTERFACE in interfaces:
+                self.devices_table.pop(object_path, None)
+        self.notify()
+
+    def on_properties_changed(
+        self, connection, sender, path, interface, signal, params
+    ):
+        changed_interface, changed, invalidated = params.unpack()
+        if changed_interface != DEVICE_INTERFACE:
+            return
+
+        with self.lock:
+            props = self.devices_table.setdefault(path, {})
+            for key, value in changed.items():
+                if key in DEVICE_PROPERTIES:
+                    props[key] = value
+            for key in invalidated:
+                props.pop(key, None)
+        self.notify()
+
+
+def open_inventory():
+    """Return a started DeviceInventory on the system bus, or None if BlueZ
+    can't be reached. Callers fall back to bluetoothctl."""
+
+    from gi.repository import Gio, GLib
+
+    try:
+        bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+        inventory = DeviceInventory(bus)
+        inventory.start()
+    except GLib.Error as err:
+        log.info("BlueZ D-Bus unavailable, using bluetoothctl: %s", err)
+        return None
+    return inventory
+
+
+#
+# Test stand-in
+#
+
+
+class FakeVariant:
+    """Minimal GLib.Variant stand-in, only supports unpack()"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def unpack(self):
+        return self.value
+
+
+class FakeBus:
+    """Stand-in for a Gio.DBusConnection with BlueZ on it.
+
+    Holds a set of managed objects and lets tests add, remove and change
+    them, emitting the same signals BlueZ would.
+    """
+
+    def __init__(self, objects=None):
+        self.objects = objects or {}
+        self.subscribers = {}
+        self.next_id = 1
+
+    def call_sync(self, bus_name, path, interface, method, *args):
+        if (interface, method) != (OBJECT_MANAGER_INTERFACE, "GetManagedObjects"):
+            raise NotImplementedError(f"{interface}.{method}")
+        return FakeVariant(({p: dict(i) for p, i in self.objects.items()},))
+
+    def signal_subscribe(self, sender, interface, member, path, arg0, flags, callback):
+        subscription = self.next_id
+        self.next_id += 1
+        self.subscribers[subscription] = (interface, member, callback)
+        return subscription
+
+    def signal_unsubscribe(self, subscription):
+        self.subscribers.pop(subscription, None)
+
+    def emit(self, path, interface, member, params):
+        for sub_interface, sub_member, callback in list(self.subscribers.values()):
+            if (sub_interface, sub_member) == (interface, member):
+                callback(
+                    self, BLUEZ_SERVICE, path, interface, member, FakeVariant(params)
+                )
+
+    def add_adapter(self, path="/org/bluez/hci0", address="00:00:00:00:00:00"):
+        interfaces = {ADAPTER_INTERFACE: {"Address": address, "Powered": True}}
+        self.objects[path] = interfaces
+        self.emit("/", OBJECT_MANAGER_INTERFACE, "InterfacesAdded", (path, interfaces))
+
+    def add_device(self, address, name, adapter="/org/bluez/hci0", **props):
+        path = f"{adapter}/dev_{address.upper().replace(':', '_')}"
+        interfaces = {
+            DEVICE_INTERFACE: {"Address": address, "Name": name, **props},
+        }
+        self.objects[path] = interfaces
+        self.emit("/", OBJECT_MANAGER_INTERFACE, "InterfacesAdded", (path, interfaces))
+        return path
+
+    def remove(self, path):
+        interfaces = self.objects.pop(path)
+        self.emit(
+            "/",
+            OBJECT_MANAGER_INTERFACE,
+            "InterfacesRemoved",
+            (path, list(interfaces)),
+        )
+
+    def change(self, path, **changed):
+        self.objects[path][DEVICE_INTERFACE].update(changed)
+        self.emit(
+            path,
+            PROPERTIES_INTERFACE,
+            "PropertiesChanged",
+            (DEVICE_INTERFACE, changed, []),
+        )
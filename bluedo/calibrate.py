@@ -0,0 +1,210 @@
+"""Pick threshold and here_threshold from measured RSSI.
+
+    bluedo calibrate [--here SECONDS] [--away SECONDS] [--dry-run]
+
+Probes the configured devices while the user sits at the desk, then while
+they are away, and sets threshold between the two. The low end of the
+"here" readings (here_quantile) and the high end of the "away" readings
+(away_quantile) bound a gap: threshold goes a third into it from below,
+here_threshold two thirds, so the middle third is the hysteresis band.
+
+With auto_calibrate the engine does the same in the background, sorting
+readings by its own here/away state and slowly forgetting old ones.
+
+RSSI readings are integers, so a sketch is a 256 bin histogram. Memory is
+fixed whatever the number of samples, and quantiles are exact.
+"""
+
+import argparse
+import sys
+import time
+from array import array
+
+from . import adapters, presence
+from .config import CONFIG_PATH, ConfigStore, Settings
+
+HERE_QUANTILE = 0.05
+AWAY_QUANTILE = 0.95
+MIN_SAMPLES = 30
+WALK_TIME = 15  # Seconds to walk away before sampling "away"
+
+
+class RssiSketch:
+    """Histogram of RSSI values from -128 to 127"""
+
+    def __init__(self):
+        self.counts = array("d", bytes(8 * 256))
+        self.total = 0.0
+
+    def add(self, rssi):
+        self.counts[max(-128, min(127, rssi)) + 128] += 1
+        self.total += 1
+
+    def quantile(self, q):
+        """Lowest RSSI with at least q of the samples at or below it"""
+
+        if self.total <= 0:
+            return None
+        target = q * self.total
+        seen = 0.0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return index - 128
+        return 127
+
+    def decay(self, factor):
+        for index, count in enumerate(self.counts):
+            if count:
+                self.counts[index] = count * factor
+        self.total *= factor
+
+
+class Calibrator:
+    """Here and away sketches per device"""
+
+    def __init__(
+        self,
+        here_quantile=HERE_QUANTILE,
+        away_quantile=AWAY_QUANTILE,
+        min_samples=MIN_SAMPLES,
+    ):
+        self.here_quantile = here_quantile
+        self.away_quantile = away_quantile
+        self.min_samples = min_samples
+        self.here = {}  # Address: RssiSketch
+        self.away = {}
+
+    def add(self, address, rssi, present):
+        """Add a reading, None for a failed probe. Failed probes only count
+        when away, at the desk they are noise."""
+
+        if rssi is None:
+            if present:
+                return
+            rssi = presence.NO_SIGNAL
+        sketches = self.here if present else self.away
+        sketch = sketches.get(address)
+        if sketch is None:
+            sketch = sketches[address] = RssiSketch()
+        sketch.add(rssi)
+
+    def decay(self, factor):
+        for sketch in (*self.here.values(), *self.away.values()):
+            sketch.decay(factor)
+
+    def bands(self, address):
+        """Return (threshold, here_threshold, overlap) for address, None
+        until there are enough samples of both. overlap is True if here
+        and away readings overlap, then both are the low end of here."""
+
+        here = self.here.get(address)
+        away = self.away.get(address)
+        if (
+            here is None
+            or away is None
+            or here.total < self.min_samples
+            or away.total < self.min_samples
+        ):
+            return None
+
+        low = here.quantile(self.here_quantile)
+        high = away.quantile(self.away_quantile)
+        gap = low - high
+        if gap < 2:
+            return low, low, gap <= 0
+        return high + gap // 3, high + (2 * gap + 2) // 3, False
+
+    def summary(self, address):
+        here = self.here.get(address)
+        away = self.away.get(address)
+        parts = []
+        for name, sketch in (("here", here), ("away", away)):
+            if sketch is None or sketch.total == 0:
+                parts.append(f"{name}: no readings")
+                continue
+            parts.append(
+                f"{name}: {sketch.total:.0f} readings, median "
+                + f"{sketch.quantile(0.5)}, 5% {sketch.quantile(0.05)}, "
+                + f"95% {sketch.quantile(0.95)}"
+            )
+        return "; ".join(parts)
+
+
+#
+# Command line
+#
+
+
+def sample(probes, addresses, calibrator, present, seconds, interval):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for address, reading in probes.read_rssi_many(addresses).items():
+            calibrator.add(address, None if reading is None else reading.rssi, present)
+        print(".", end="", flush=True)
+        time.sleep(interval)
+    print()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="bluedo calibrate",
+        description="Measure RSSI at and away from the desk and set thresholds",
+    )
+    parser.add_argument("--here", type=float, default=60, metavar="SECONDS")
+    parser.add_argument("--away", type=float, default=60, metavar="SECONDS")
+    parser.add_argument("--config", default=CONFIG_PATH)
+    parser.add_argument("--dry-run", action="store_true", help="don't save")
+    options = parser.parse_args(args)
+
+    config = ConfigStore(options.config)
+    config.load()
+    settings = Settings.from_config(config, "CONFIG")
+    addresses = settings.probe_addresses()
+    if not addresses:
+        print("No device configured, pick one in BlueDo first", file=sys.stderr)
+        return 1
+
+    probes = adapters.AdapterPool(
+        settings.probe_backend,
+        adapters=settings.probe_adapters,
+        combine=settings.adapter_combine,
+        irks=settings.ble_irks,
+        max_workers=settings.probe_concurrency,
+    )
+    calibrator = Calibrator(min_samples=1)
+    interval = settings.resolved().min_interval
+    try:
+        input(f"Stay at the desk with {', '.join(addresses)}, press Enter to start")
+        sample(probes, addresses, calibrator, True, options.here, interval)
+        input(f"Press Enter, then within {WALK_TIME}s walk to where BlueDo should lock")
+        time.sleep(WALK_TIME)
+        sample(probes, addresses, calibrator, False, options.away, interval)
+    except (KeyboardInterrupt, EOFError):
+        print()
+        return 1
+    finally:
+        probes.close()
+
+    for address in addresses:
+        print(f"{address} {calibrator.summary(address)}")
+        bands = calibrator.bands(address)
+        if bands is None:
+            continue
+        threshold, here_threshold, overlap = bands
+        if overlap:
+            print("  Readings overlap, expect false locks. Try walking further away.")
+        print(f"  threshold = {threshold}, here_threshold = {here_threshold}")
+
+    bands = calibrator.bands(addresses[0])
+    if bands is None:
+        print("No readings of the selected device, config not changed")
+        return 1
+    if options.dry_run:
+        return 0
+
+    settings.threshold, settings.here_threshold, _ = bands
+    settings.to_config(config, "CONFIG")
+    config.flush()
+    print(f"Saved to {options.config}")
+    return 0
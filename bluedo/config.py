@@ -0,0 +1,347 @@
+"""Config file handling"""
+
+import configparser
+import dataclasses
+import io
+import os
+import re
+import tempfile
+import threading
+import uuid
+from contextlib import suppress
+
+import appdirs
+
+from . import __projectname__, log
+from .adapters import COMBINE_MODES
+from .presence import FILTERS, PREDICT_MODES
+from .probe import BACKENDS
+
+CONFIG_PATH = appdirs.user_config_dir(__projectname__) + "/" + __projectname__ + ".ini"
+
+TRUE_STRINGS = ("true", "yes", "on", "1")
+
+# Allowed values for choice fields
+CHOICES = {
+    "probe_backend": BACKENDS,
+    "rssi_filter": tuple(FILTERS),
+    "predict": PREDICT_MODES,
+    "adapter_combine": COMBINE_MODES,
+}
+
+# Fields that must be at least this
+MINIMUM = {
+    "interval": 0.1,
+    "min_interval": 0.1,
+    "max_interval": 0.1,
+    "away_count": 1,
+    "here_count": 1,
+    "quorum": 1,
+    "probe_concurrency": 1,
+    "predict_window": 2,
+    "predict_slope": 0.0,
+    "action_timeout": 0.1,
+    "history_records": 16,
+}
+
+
+@dataclasses.dataclass(slots=True)
+class Settings:
+    """Typed config, with the defaults for every key in the config file.
+
+    here_threshold, min_interval and max_interval are None unless set, and
+    are then derived from threshold and interval, see resolved(). Only set
+    values are saved, so the derived ones follow threshold and interval.
+    """
+
+    enabled: bool = False
+    debug: bool = False
+    bt_address: str = ""
+    bt_name: str = "(current)"
+    bt_addresses: tuple = ()
+    quorum: int = 1
+    threshold: int = -4
+    here_threshold: int = None
+    here_count: int = 1
+    away_count: int = 3
+    rssi_filter: str = "none"
+    predict: str = "off"
+    predict_slope: float = 1.0
+    predict_window: int = 5
+    interval: float = 5.0
+    min_interval: float = None
+    max_interval: float = None
+    probe_backend: str = "auto"
+    probe_concurrency: int = 3
+    ble_irks: tuple = ()
+    probe_adapters: tuple = ()
+    adapter_combine: str = "best"
+    here_unlock: bool = True
+    here_run: bool = False
+    here_command: str = ""
+    check_resume: bool = False
+    check_unmute: bool = False
+    away_lock: bool = True
+    away_mute: bool = False
+    away_pause: bool = False
+    away_run: bool = False
+    away_command: str = ""
+    action_timeout: float = 10.0
+    command_worker: bool = False
+    command_init: str = ""
+    metrics_textfile: str = ""
+    metrics_socket: str = ""
+    history_file: str = ""
+    history_records: int = 1048576
+    auto_calibrate: bool = False
+    advanced: bool = False
+    minimized: bool = False
+
+    def resolved(self):
+        """Return a copy with the derived defaults filled in. here_threshold
+        is never below threshold."""
+
+        here_threshold = self.here_threshold
+        if here_threshold is None or here_threshold < self.threshold:
+            here_threshold = self.threshold
+        return dataclasses.replace(
+            self,
+            here_threshold=here_threshold,
+            min_interval=(
+                min(1.0, self.interval)
+                if self.min_interval is None
+                else self.min_interval
+            ),
+            max_interval=(
+                2 * self.interval if self.max_interval is None else self.max_interval
+            ),
+        )
+
+    @classmethod
+    def from_config(cls, parser, section):
+        """Parse section of parser. Invalid values are logged and replaced by
+        their default."""
+
+        settings = cls()
+        for field in dataclasses.fields(cls):
+            raw = parser.get(section, field.name, fallback=None)
+            if raw is None:
+                continue
+            try:
+                value = parse_value(field.type, raw)
+                validate(field.name, value)
+            except ValueError as err:
+                log.warning("Ignoring config %s = <%s>: %s", field.name, raw, err)
+                continue
+            setattr(settings, field.name, value)
+        return settings
+
+    def to_config(self, parser, section):
+        if not parser.has_section(section):
+            parser.add_section(section)
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            if value is None:
+                parser.remove_option(section, field.name)  # Derived
+                continue
+            if isinstance(value, tuple):
+                value = ", ".join(value)
+            parser.set(section, field.name, str(value))
+
+    def probe_addresses(self):
+        """Return valid addresses to probe, selected device first"""
+
+        addresses = []
+        for address in (self.bt_address, *self.bt_addresses):
+            if len(address) == 17 and address not in addresses:
+                addresses.append(address)
+        return addresses
+
+    def diff(self, other):
+        """Return names of fields that differ between self and other"""
+
+        return {
+            field.name
+            for field in dataclasses.fields(self)
+            if getattr(self, field.name) != getattr(other, field.name)
+        }
+
+
+def parse_value(kind, raw):
+    raw = raw.strip()
+    if kind is bool:
+        return raw.lower() in TRUE_STRINGS
+    if kind is int:
+        return int(raw)
+    if kind is float:
+        return float(raw)
+    if kind is tuple:
+        return tuple(part.strip() for part in raw.split(",") if part.strip())
+    return raw
+
+
+def validate(name, value):
+    if name in CHOICES and value not in CHOICES[name]:
+        raise ValueError(f"must be one of {', '.join(CHOICES[name])}")
+    if name in MINIMUM and value < MINIMUM[name]:
+        raise ValueError(f"must be at least {MINIMUM[name]}")
+    if name == "bt_address" and value and len(value) != 17:
+        raise ValueError("not a bluetooth address")
+    if name == "bt_addresses" and any(len(address) != 17 for address in value):
+        raise ValueError("not a list of bluetooth addresses")
+    if name == "probe_adapters" and not all(
+        re.fullmatch(r"(hci)?\d+", adapter) for adapter in value
+    ):
+        raise ValueError("not a list of adapters like hci0")
+    if name == "ble_irks":
+        for entry in value:
+            address, _, key = entry.partition("=")
+            if len(address.strip()) != 17 or len(bytes.fromhex(key)) != 16:
+                raise ValueError("not a list of ADDRESS=KEY, KEY 32 hex digits")
+
+
+class ConfigStore(configparser.ConfigParser):
+    """ConfigParser that writes itself back lazily and atomically.
+
+    set() only marks the store dirty. schedule_flush() writes after delay
+    seconds on a timer thread, restarting the timer on every call so a burst
+    of changes (typing in an entry) ends in one write. flush() writes now if
+    anything changed, through a temporary file renamed over the config.
+    """
+
+    def __init__(self, path, delay=1.0):
+        super().__init__(interpolation=None)
+        self.path = path
+        self.delay = delay
+        self.dirty = False
+        self.written = None  # Text last read or written
+        self.timer = None
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+
+    def load(self, text=None):
+        """Read the config file, or text, replacing what is in memory"""
+
+        with self.lock:
+            for section in self.sections():
+                self.remove_section(section)
+            if text is None:
+                try:
+                    with open(self.path, encoding="utf8") as f:
+                        text = f.read()
+                except FileNotFoundError:
+                    text = None
+            if text is not None:
+                self.read_string(text, source=self.path)
+            self.written = text
+            self.dirty = False
+
+    def reload(self):
+        """Load the file again if someone else changed it. Returns True if
+        it was reloaded."""
+
+        try:
+            with open(self.path, encoding="utf8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            if text == self.written:
+                return False  # Our own write
+            self.load(text)
+        return True
+
+    def set(self, section, option, value=None):
+        with self.lock:
+            if self.get(section, option, fallback=None) != value:
+                super().set(section, option, value)
+                self.dirty = True
+
+    def remove_option(self, section, option):
+        with self.lock:
+            removed = super().remove_option(section, option)
+            self.dirty |= removed
+            return removed
+
+    def schedule_flush(self):
+        """Flush after delay seconds, coalescing with pending calls"""
+
+        with self.lock:
+            if not self.dirty:
+                return
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Write the config file if anything changed since the last write"""
+
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.dirty:
+                return
+            buffer = io.StringIO()
+            self.write(buffer)
+            text = buffer.getvalue()
+            self.dirty = False
+
+        # Write outside self.lock so set() never waits for the disk
+        with self.write_lock:
+            if text == self.written:
+                return
+            try:
+                atomic_write(self.path, text)
+            except OSError as err:
+                log.error("Unable to save config %s: %s", self.path, err)
+                self.dirty = True
+                return
+            self.written = text
+
+        log.debug("Saved config to %s", self.path)
+
+
+def open_temp(path):
+    """Create a temporary file next to path for atomic_write(). Returns
+    (fd, temporary path). It gets the mode path has, or for a new file the
+    mode open() would give it: 0666 less the umask, applied by the kernel
+    so the process-wide umask is never changed."""
+
+    directory = os.path.dirname(path) or "."
+    prefix = "." + os.path.basename(path)
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = None
+
+    if mode is not None:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=prefix, suffix=".tmp")
+        os.fchmod(fd, mode)  # mkstemp makes it 0600
+        return fd, tmp_path
+
+    while True:
+        tmp_path = os.path.join(directory, f"{prefix}{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            fd = os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+        except FileExistsError:
+            continue
+        return fd, tmp_path
+
+
+def atomic_write(path, text):
+    """Replace path with text, so readers never see a partial file"""
+
+    fd, tmp_path = open_temp(path)
+    try:
+        with os.fdopen(fd, mode="w", encoding="utf8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
@@ -0,0 +1,546 @@
+"""Presence engine: probing, here/away decisions and actions.
+
+Engine runs from the config file alone and imports nothing from GTK, so it
+can be driven by the tray app or run headless. Frontends follow it through
+connect().
+
+Everything but the probes themselves runs on the GLib main loop: a probe
+cycle is started from a timer, runs on a worker thread and hands its result
+back with idle_add. Between probes nothing wakes up.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gi.repository import Gio, GLib
+
+from . import (
+    actions,
+    adapters,
+    calibrate,
+    history,
+    log,
+    metrics,
+    presence,
+    reconnect,
+    scheduler,
+    session,
+    worker,
+)
+from .config import CONFIG_PATH, ConfigStore, Settings
+
+CALIBRATE_PERIOD = 3600  # Seconds between auto calibration updates
+CALIBRATE_HALF_LIFE = 7 * 86400  # Seconds until old readings count half
+
+
+class Engine:
+    config_section = "CONFIG"
+
+    def __init__(self, config_path=CONFIG_PATH):
+        self.config_path = config_path
+        self.debug = False
+        self.config = None  # config.ConfigStore
+        self.settings = None  # config.Settings
+        self.config_monitor = None  # Gio.FileMonitor on config_path
+        self.reconfigure = set()  # Settings fields changed, applied before next probe
+        self.listeners = []
+        self.settings_listeners = []
+        self.actions = actions.DesktopActions()
+        self.session = session.SessionMonitor(self.actions.session_paths)
+        self.session.connect(self.on_session_changed)
+        self.actions.session = self.session
+        self.executor = actions.ActionExecutor()
+        self.metrics = metrics.Metrics()
+        self.executor.on_result = self.metrics.action
+        self.reconnector = reconnect.ReconnectManager(metrics=self.metrics)
+        self.exporter = None  # metrics.Exporter, if configured
+        self.recorder = None  # history.HistoryRecorder, if configured
+        self.calibrator = None  # calibrate.Calibrator, with auto_calibrate
+        self.calibrated_at = 0.0
+
+        self.probe = None  # adapters.AdapterPool
+        self.presence_engine = None
+        self.pacer = None
+        self.probe_rate = 0.0  # Effective probes per second
+        self.rssi = presence.NO_SIGNAL  # Strongest reading of the last cycle
+        self.readings = {}  # Address: raw RSSI of the last cycle, None if lost
+        self.running = False
+        self.timer = None  # GLib source of the next probe cycle
+        self.parked = False  # No address to probe, waiting for settings
+        self.cycle_started = 0.0
+        self.cycle_pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="bluedo-cycle"
+        )
+
+    #
+    # Config
+    #
+
+    def load_config(self):
+        """Load config"""
+
+        log.debug("Loading config from %s", self.config_path)
+
+        if not os.path.isdir(os.path.dirname(self.config_path)):
+            os.mkdir(os.path.dirname(self.config_path))
+
+        self.config = ConfigStore(self.config_path)
+        self.config.load()
+
+        self.settings = Settings.from_config(self.config, self.config_section)
+        self.debug = self.settings.debug
+        log.set_debug(self.debug)
+        self.executor.timeout = self.settings.action_timeout
+
+    def save_config(self):
+        """Save config. Written to disk shortly after the last change."""
+
+        self.settings.to_config(self.config, self.config_section)
+        self.config.schedule_flush()
+        if self.parked:
+            self.wake()
+
+    def watch_config(self):
+        """Reload config when it is changed on disk"""
+
+        self.config_monitor = Gio.File.new_for_path(self.config_path).monitor_file(
+            Gio.FileMonitorFlags.WATCH_MOVES, None
+        )
+        self.config_monitor.connect("changed", self.on_config_file_changed)
+
+    def on_config_file_changed(self, monitor, file, other_file, event_type):
+        if event_type not in (
+            Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+            Gio.FileMonitorEvent.CREATED,
+            Gio.FileMonitorEvent.MOVED_IN,
+            Gio.FileMonitorEvent.RENAMED,
+        ):
+            return
+        if not self.config.reload():
+            return
+
+        settings = Settings.from_config(self.config, self.config_section)
+        changed = self.settings.diff(settings)
+        if not changed:
+            return
+
+        log.info("Config changed on disk: %s", ", ".join(sorted(changed)))
+        self.settings = settings
+        self.debug = settings.debug
+        log.set_debug(self.debug)
+        self.executor.timeout = settings.action_timeout
+        self.reconfigure |= changed
+        for callback in self.settings_listeners:
+            callback(changed)
+        self.wake()
+
+    def connect_settings(self, callback):
+        """Call callback(changed) when settings are reloaded from disk, or
+        changed by set_enabled()"""
+        self.settings_listeners.append(callback)
+
+    def set_enabled(self, enabled):
+        """Switch away actions on or off for a remote caller, and show it
+        in the frontends"""
+
+        if enabled == self.settings.enabled:
+            return
+        log.info("Enabled %s.", enabled)
+        self.settings.enabled = enabled
+        self.save_config()
+        for callback in self.settings_listeners:
+            callback({"enabled"})
+
+    #
+    # Probing
+    #
+
+    def connect(self, callback):
+        """Call callback(event) on the main loop after every probe cycle.
+        event is presence.HERE, AWAY, LEAVING or None."""
+        self.listeners.append(callback)
+
+    def notify(self, event):
+        for callback in self.listeners:
+            try:
+                callback(event)
+            except Exception as err:
+                log.error("Listener %s failed: %s", callback.__qualname__, err)
+
+    def start(self):
+        """Start probing from the GLib main loop"""
+
+        self.start_probe()
+        self.presence_engine = presence.PresenceEngine(self.settings.threshold)
+        self.configure_engine(set())
+        self.session.start()
+        self.running = True
+        if not self.session.paused:
+            self.schedule(0)
+
+    def stop(self):
+        self.running = False
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        self.session.stop()
+        self.config.flush()  # Write any pending change now
+        self.executor.close(timeout=self.settings.action_timeout)
+        if self.actions.worker is not None:
+            self.actions.worker.close()
+        if self.exporter is not None:
+            self.exporter.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.probe is not None:
+            self.probe.close()
+        self.reconnector.stop()
+        self.cycle_pool.shutdown(wait=False, cancel_futures=True)
+
+    def schedule(self, delay):
+        """Run the next probe cycle in delay seconds"""
+
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+        self.timer = GLib.timeout_add(int(delay * 1000), self.on_probe_timer)
+
+    def wake(self):
+        """Probe now, unless a probe is already running. For changes that
+        shouldn't wait for the current delay."""
+
+        if self.running and (self.timer is not None or self.parked):
+            self.schedule(0)
+
+    def on_session_changed(self, changed):
+        """Pause probing while suspended or switched away from, probe again
+        right away when back"""
+
+        if not self.running or not changed & {"asleep", "active"}:
+            return
+        if self.session.paused:
+            if self.timer is not None:
+                GLib.source_remove(self.timer)
+                self.timer = None
+            self.reconnector.stop()
+            log.info("Probing paused")
+        elif self.timer is None:
+            log.info("Probing resumed")
+            self.schedule(0)
+
+    def on_probe_timer(self):
+        """Start a probe cycle. The probes run on a worker thread, the result
+        comes back to on_probe_done on the main loop."""
+
+        self.timer = None
+        self.parked = False
+        if self.reconfigure:
+            changed, self.reconfigure = self.reconfigure, set()
+            self.configure_engine(changed)
+
+        addresses = self.probe_addresses()
+        if not addresses:
+            log.debug("Invalid address, not scanning.", device=self.settings.bt_address)
+            self.rssi = presence.NO_SIGNAL
+            self.notify(None)
+            self.parked = True  # Until settings change, see wake()
+            return GLib.SOURCE_REMOVE
+
+        self.cycle_started = time.perf_counter()
+        future = self.cycle_pool.submit(self.probe.read_rssi_many, addresses)
+        future.add_done_callback(
+            lambda future: GLib.idle_add(self.on_probe_done, future)
+        )
+        return GLib.SOURCE_REMOVE
+
+    def on_probe_done(self, future):
+        """Feed a probe cycle to the presence engine and act on it"""
+
+        if not self.running:
+            return GLib.SOURCE_REMOVE
+        if self.session.paused:
+            # Probes across a suspend fail, don't take that as away
+            self.timer = None
+            return GLib.SOURCE_REMOVE
+        try:
+            self.process_cycle(future)
+        except Exception as err:
+            log.error("Handling probe cycle failed: %s", err)
+        finally:
+            # Whatever went wrong, keep probing
+            self.schedule_next()
+        return GLib.SOURCE_REMOVE
+
+    def process_cycle(self, future):
+        try:
+            samples = future.result()
+        except Exception as err:
+            log.error("Probe cycle failed: %s", err)
+            samples = {}
+        self.record_cycle(samples)
+
+        engine = self.presence_engine
+        self.readings = {
+            address: None if sample is None else sample.rssi
+            for address, sample in samples.items()
+        }
+        event = engine.feed(self.readings, enabled=self.settings.enabled)
+        self.rssi = engine.rssi
+        if self.recorder is not None:
+            self.record_history(samples, engine.state)
+        if self.calibrator is not None:
+            self.follow_calibration(samples, engine.state)
+
+        if engine.misses > 0:
+            log.debug("No connection, lost %d", engine.misses)
+        if self.probe.needs_connection:
+            self.reconnector.update(self.readings)
+
+        if event == presence.AWAY:
+            if engine.crossed_at is not None:
+                self.metrics.away_delay.observe(engine.changed_at - engine.crossed_at)
+            self.away_callback()
+        elif event == presence.HERE:
+            self.here_callback()
+        elif event == presence.LEAVING:
+            self.leaving_callback()
+        else:
+            self.notify(None)
+
+    def schedule_next(self):
+        engine = self.presence_engine
+        state = engine.state
+        delay = self.pacer.next(
+            self.rssi, engine.threshold, state, here_threshold=engine.here_threshold
+        )
+        self.probe_rate = self.pacer.rate
+        self.metrics.probe_interval.set(delay)
+        log.debug(
+            "Next probe in %.1fs (%.2f/s)",
+            delay,
+            self.probe_rate,
+            rssi=self.rssi,
+            state=state,
+        )
+        self.schedule(delay)
+
+    def record_cycle(self, samples):
+        self.metrics.probe_seconds.observe(time.perf_counter() - self.cycle_started)
+        self.metrics.probes.inc(len(samples))
+        for sample in samples.values():
+            if sample is None:
+                self.metrics.probe_failures.inc()
+            else:
+                self.metrics.rssi.observe(sample.rssi)
+
+    def record_history(self, samples, state):
+        now = time.time()
+        for address, sample in samples.items():
+            rssi = presence.NO_SIGNAL if sample is None else sample.rssi
+            self.recorder.append(now, address, rssi, state)
+
+    def follow_calibration(self, samples, state):
+        """Feed auto calibration, and move the thresholds along with it
+        every CALIBRATE_PERIOD"""
+
+        for address, sample in samples.items():
+            self.calibrator.add(
+                address, None if sample is None else sample.rssi, state == presence.HERE
+            )
+
+        now = time.monotonic()
+        if now - self.calibrated_at < CALIBRATE_PERIOD:
+            return
+        self.calibrated_at = now
+        self.calibrator.decay(0.5 ** (CALIBRATE_PERIOD / CALIBRATE_HALF_LIFE))
+
+        addresses = self.probe_addresses()
+        bands = addresses and self.calibrator.bands(addresses[0])
+        if not bands or bands[2]:
+            return  # Not enough readings yet, or no clear gap
+        threshold, here_threshold, _ = bands
+        settings = self.settings
+        current = settings.resolved()
+        if (threshold, here_threshold) == (current.threshold, current.here_threshold):
+            return
+
+        log.info(
+            "Calibrated threshold %d -> %d, here_threshold %d -> %d",
+            current.threshold,
+            threshold,
+            current.here_threshold,
+            here_threshold,
+        )
+        settings.threshold = threshold
+        settings.here_threshold = here_threshold
+        self.reconfigure |= {"threshold", "here_threshold"}
+        self.save_config()
+
+    def start_probe(self):
+        self.reconnector.stop()
+        self.probe = adapters.AdapterPool(
+            self.settings.probe_backend,
+            adapters=self.settings.probe_adapters,
+            combine=self.settings.adapter_combine,
+            irks=self.settings.ble_irks,
+            max_workers=self.settings.probe_concurrency,
+            metrics=self.metrics,
+        )
+        log.debug("Using probe backend %s", self.probe.name)
+
+    def configure_engine(self, changed):
+        """Apply settings to the probe, pacer and presence engine. An empty
+        changed means everything. Not while a probe cycle runs."""
+
+        settings = self.settings.resolved()
+        engine = self.presence_engine
+
+        if changed & {
+            "probe_backend",
+            "probe_concurrency",
+            "ble_irks",
+            "probe_adapters",
+            "adapter_combine",
+        }:
+            self.probe.close()
+            self.start_probe()
+
+        if not changed or changed & {"interval", "min_interval", "max_interval"}:
+            self.pacer = scheduler.AdaptiveInterval(
+                settings.min_interval, settings.max_interval
+            )
+
+        engine.threshold = settings.threshold
+        engine.here_threshold = settings.here_threshold
+        engine.away_count = settings.away_count
+        engine.here_count = settings.here_count
+        engine.quorum = settings.quorum
+
+        if "rssi_filter" in changed:
+            engine.filters.clear()
+        engine.filter_name = settings.rssi_filter
+
+        if not changed or changed & {"command_worker", "command_init"}:
+            self.start_worker()
+
+        if not changed or changed & {"metrics_textfile", "metrics_socket"}:
+            self.start_exporter()
+
+        if not changed or changed & {"history_file", "history_records"}:
+            self.start_recorder()
+
+        if not changed or "auto_calibrate" in changed:
+            self.calibrator = (
+                calibrate.Calibrator() if settings.auto_calibrate else None
+            )
+            self.calibrated_at = time.monotonic()
+
+        if not changed or changed & {"predict", "predict_slope", "predict_window"}:
+            engine.predictor = presence.TrendPredictor(
+                window=settings.predict_window, slope=settings.predict_slope
+            )
+            engine.predict = settings.predict
+            engine.warned = False
+
+    def start_worker(self):
+        """Start or stop the persistent shell for user commands"""
+
+        old = self.actions.worker
+        self.actions.worker = None
+        if old is not None:
+            old.close()
+        if self.settings.command_worker:
+            self.actions.worker = worker.CommandWorker(init=self.settings.command_init)
+            # Spawn the shell and run init now, not in the first command's time
+            threading.Thread(
+                target=self.actions.worker.start, name="bluedo-worker", daemon=True
+            ).start()
+
+    def start_exporter(self):
+        """Start or stop publishing metrics"""
+
+        if self.exporter is not None:
+            self.exporter.stop()
+            self.exporter = None
+        if self.settings.metrics_textfile or self.settings.metrics_socket:
+            self.exporter = metrics.Exporter(
+                self.metrics,
+                textfile=os.path.expanduser(self.settings.metrics_textfile),
+                socket_path=os.path.expanduser(self.settings.metrics_socket),
+            )
+            self.exporter.start()
+
+    def start_recorder(self):
+        """Start or stop recording RSSI history"""
+
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if not self.settings.history_file:
+            return
+        path = os.path.expanduser(self.settings.history_file)
+        try:
+            self.recorder = history.HistoryRecorder(
+                path, capacity=self.settings.history_records
+            ).open()
+        except OSError as err:
+            log.error("Unable to record history to %s: %s", path, err)
+            self.recorder = None
+
+    def probe_addresses(self):
+        """Return valid addresses to probe, selected device first"""
+        return self.settings.probe_addresses()
+
+    #
+    # Callbacks
+    #
+
+    def here_callback(self):
+        """Run here actions in the background. Returns a Future of their
+        results."""
+        log.debug("Here", device=self.settings.bt_address, rssi=self.rssi)
+
+        self.notify(presence.HERE)
+
+        settings = self.settings
+        todo = []
+        if settings.here_unlock:
+            todo.append(actions.Action("unlock", self.actions.unlock, priority=0))
+        if settings.here_run:
+            todo.append(self.command_action("here_command", settings.here_command))
+        if settings.check_resume:
+            todo.append(actions.Action("resume_music", self.actions.resume_music))
+        if settings.check_unmute:
+            todo.append(actions.Action("unmute", self.actions.unmute))
+        return self.executor.submit("here", todo)
+
+    def leaving_callback(self):
+        """RSSI is falling steadily, user is probably walking away"""
+        log.info("Signal falling, user may be leaving.", rssi=self.rssi)
+
+        self.notify(presence.LEAVING)
+
+    def away_callback(self):
+        """Run away actions in the background, lock first. Returns a Future
+        of their results."""
+        log.debug("Away", device=self.settings.bt_address, rssi=self.rssi)
+
+        self.notify(presence.AWAY)
+
+        settings = self.settings
+        todo = []
+        if settings.away_lock:
+            todo.append(actions.Action("lock", self.actions.lock, priority=0))
+        if settings.away_mute:
+            todo.append(actions.Action("mute", self.actions.mute))
+        if settings.away_pause:
+            todo.append(actions.Action("pause_music", self.actions.pause_music))
+        if settings.away_run:
+            todo.append(self.command_action("away_command", settings.away_command))
+        return self.executor.submit("away", todo)
+
+    def command_action(self, name, cmd):
+        return actions.Action(
+            name, self.actions.run_user_command, (cmd, self.settings.action_timeout)
+        )
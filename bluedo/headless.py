@@ -0,0 +1,42 @@
+"""Run BlueDo without GTK, from the config file alone"""
+
+import signal
+
+from gi.repository import GLib
+
+from . import __projectname__, bluez, log, service
+from .engine import Engine
+
+
+def main(args):
+    engine = Engine()
+    engine.load_config()
+    if "-e" in args or "--enable" in args:
+        engine.settings.enabled = True
+
+    loop = GLib.MainLoop()
+    presence_service = service.publish(engine)
+    # Device paths for reconnecting, devices may be on any adapter
+    inventory = bluez.open_inventory()
+    engine.reconnector.inventory = inventory
+
+    def on_exit():
+        log.info("%s stopping.", __projectname__)
+        presence_service.unregister()
+        if inventory:
+            inventory.stop()
+        engine.here_callback()
+        engine.stop()
+        loop.quit()
+        return GLib.SOURCE_REMOVE
+
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, on_exit)
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, on_exit)
+
+    log.info(
+        "%s running headless, enabled %s.", __projectname__, engine.settings.enabled
+    )
+    engine.watch_config()
+    engine.start()
+    loop.run()
+    return 0
@@ -0,0 +1,163 @@
+"""RSSI history in a fixed-size ring file.
+
+Every probe reading can be appended to a memory-mapped file of fixed
+16 byte records: wall clock time, device address, raw RSSI and the
+presence state after the cycle. Once the file is full the oldest
+records are overwritten. At one reading every 5 seconds the default
+2**20 records hold about 8 weeks for one device.
+
+Reading the file back as arrays needs NumPy, install bluedo[analysis].
+records() works without it.
+"""
+
+import mmap
+import os
+import struct
+
+from . import log, presence
+
+try:
+    import numpy
+except ImportError:  # Only needed to read history as arrays
+    numpy = None
+
+MAGIC = b"BLUEDOH1"
+HEADER = struct.Struct("<8sIIQ8x")  # Magic, record size, capacity, written
+RECORD = struct.Struct("<d6sbB")  # Timestamp, address, RSSI, state
+
+STATES = (presence.HERE, presence.AWAY)
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+DEFAULT_CAPACITY = 1 << 20
+
+if numpy is not None:
+    DTYPE = numpy.dtype(
+        [("timestamp", "<f8"), ("address", "S6"), ("rssi", "i1"), ("state", "u1")]
+    )
+
+
+def require_numpy():
+    if numpy is None:
+        raise RuntimeError("Reading RSSI history as arrays needs numpy")
+
+
+def address_bytes(address):
+    return bytes.fromhex(address.replace(":", ""))
+
+
+def address_text(raw):
+    return ":".join(f"{byte:02X}" for byte in raw)
+
+
+class HistoryRecorder:
+    """Append readings to a ring file. Not thread safe, call append() from
+    one thread."""
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.map = None
+        self.written = 0  # Records appended since the file was created
+        self.addresses = {}  # Address text: bytes
+
+    def open(self):
+        size = HEADER.size + self.capacity * RECORD.size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            fresh = True
+            if len(header) == HEADER.size:
+                magic, record_size, capacity, written = HEADER.unpack(header)
+                if (magic, record_size, capacity) == (
+                    MAGIC,
+                    RECORD.size,
+                    self.capacity,
+                ):
+                    fresh = False
+                    self.written = written
+                else:
+                    log.warning(
+                        "Starting new RSSI history in %s, the old one has "
+                        + "another layout or size.",
+                        self.path,
+                    )
+            if fresh:
+                os.ftruncate(fd, 0)
+                self.written = 0
+            os.ftruncate(fd, size)  # Sparse until written
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)  # The map keeps its own reference
+
+        self.write_header()
+        return self
+
+    def write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, RECORD.size, self.capacity, self.written)
+
+    def append(self, timestamp, address, rssi, state):
+        raw = self.addresses.get(address)
+        if raw is None:
+            raw = self.addresses[address] = address_bytes(address)
+        offset = HEADER.size + (self.written % self.capacity) * RECORD.size
+        RECORD.pack_into(
+            self.map,
+            offset,
+            timestamp,
+            raw,
+            max(-128, min(127, rssi)),
+            STATE_CODES.get(state, 0),
+        )
+        self.written += 1
+        self.write_header()
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+
+
+def read_raw(path):
+    """Return (records in order, oldest first, as bytes; record count)"""
+
+    with open(path, "rb") as f:
+        magic, record_size, capacity, written = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or record_size != RECORD.size:
+            raise ValueError(f"{path} is not an RSSI history file")
+        body = f.read(capacity * RECORD.size)
+
+    count = min(written, capacity)
+    start = (written % capacity) * RECORD.size if written > capacity else 0
+    ordered = body[start : count * RECORD.size] + body[:start]
+    return ordered, count
+
+
+def records(path):
+    """Yield (timestamp, address, rssi, state) tuples, oldest first"""
+
+    ordered, _ = read_raw(path)
+    for timestamp, raw, rssi, state in RECORD.iter_unpack(ordered):
+        yield timestamp, address_text(raw), rssi, STATES[state]
+
+
+def arrays(path, chunk=65536):
+    """Yield the history as NumPy structured arrays of at most chunk
+    records, oldest first. Fields: timestamp, address (6 bytes), rssi,
+    state (index in STATES)."""
+
+    require_numpy()
+    ordered, count = read_raw(path)
+    data = numpy.frombuffer(ordered, dtype=DTYPE, count=count)
+    for start in range(0, count, chunk):
+        yield data[start : start + chunk]
+
+
+def load(path, address=None):
+    """Return the whole history as one array, optionally for one device"""
+
+    require_numpy()
+    data = numpy.concatenate(list(arrays(path)) or [numpy.empty(0, DTYPE)])
+    if address is not None:
+        data = data[data["address"] == address_bytes(address)]
+    return data
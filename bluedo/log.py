@@ -0,0 +1,155 @@
+"""Logging to syslog from a background thread.
+
+    from . import log
+    log.debug("Probe timed out", device=address)
+
+A call only queues the format string, its arguments and fields; a writer
+thread formats and sends them. With debug off, log.debug() is a flag check.
+Arguments are formatted later, so pass values rather than objects that
+will change.
+
+Each message type, by default its format string, gets at most BURST
+messages per PERIOD seconds, and a message equal to the previous one of
+its type is dropped. The number dropped is added to the next one that goes
+out.
+
+Fields are appended as key=value, "RSSI -3 device=AA:BB:CC:DD:EE:FF". With
+python-systemd installed, messages go to journald instead, with the fields
+also as BLUEDO_DEVICE=... entries that journalctl can filter on.
+"""
+
+import atexit
+import queue
+import syslog
+import threading
+import time
+
+try:
+    from systemd import journal
+except ImportError:  # Plain syslog then
+    journal = None
+
+PERIOD = 10.0  # Seconds
+BURST = 20  # Messages of one type per PERIOD
+CLOSE_TIMEOUT = 1.0  # Seconds to let queued messages out at exit
+
+
+class Limit:
+    """Rate limit state of one message type"""
+
+    __slots__ = ("start", "count", "last", "dropped")
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.last = None  # (priority, args, fields) of the last message let out
+        self.dropped = 0
+
+
+class Logger:
+    def __init__(self, period=PERIOD, burst=BURST):
+        self.period = period
+        self.burst = burst
+        self.debug_enabled = False
+        self.limits = {}  # Key: Limit
+        self.lock = threading.Lock()
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def set_debug(self, enabled):
+        self.debug_enabled = enabled
+
+    def debug(self, fmt, *args, key=None, **fields):
+        if self.debug_enabled:
+            self.log(syslog.LOG_DEBUG, fmt, args, key, fields)
+
+    def info(self, fmt, *args, key=None, **fields):
+        self.log(syslog.LOG_INFO, fmt, args, key, fields)
+
+    def warning(self, fmt, *args, key=None, **fields):
+        self.log(syslog.LOG_WARNING, fmt, args, key, fields)
+
+    def error(self, fmt, *args, key=None, **fields):
+        self.log(syslog.LOG_ERR, fmt, args, key, fields)
+
+    def log(self, priority, fmt, args, key, fields):
+        dropped = self.admit(fmt if key is None else key, (priority, args, fields))
+        if dropped is None:
+            return
+        if self.thread is None:
+            self.start()
+        self.queue.put((priority, fmt, args, fields, dropped))
+
+    def admit(self, key, message):
+        """Return how many messages of this type were dropped before this
+        one, or None to drop it too"""
+
+        now = time.monotonic()
+        with self.lock:
+            limit = self.limits.get(key)
+            if limit is None:
+                limit = self.limits[key] = Limit(now)
+            elif now - limit.start >= self.period:
+                limit.start = now
+                limit.count = 0
+                limit.last = None  # Repeat a steady message once a period
+            if limit.count >= self.burst or message == limit.last:
+                limit.dropped += 1
+                return None
+            limit.count += 1
+            limit.last = message
+            dropped, limit.dropped = limit.dropped, 0
+            return dropped
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                target=self.write, name="bluedo-log", daemon=True
+            )
+            self.thread.start()
+        atexit.register(self.close)
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            priority, fmt, args, fields, dropped = item
+            try:
+                message = fmt % args if args else fmt
+            except (TypeError, ValueError) as err:
+                message = f"{fmt!r} % {args!r}: {err}"
+            if fields:
+                message += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+            if dropped:
+                message += f" ({dropped} similar dropped)"
+            if journal is not None:
+                journal.send(
+                    message,
+                    PRIORITY=priority,
+                    **{f"BLUEDO_{k.upper()}": v for k, v in fields.items()},
+                )
+            else:
+                syslog.syslog(priority, message)
+
+    def close(self):
+        """Write what is queued and stop the writer"""
+
+        thread = self.thread
+        if thread is None:
+            return
+        self.queue.put(None)
+        thread.join(CLOSE_TIMEOUT)
+        self.thread = None
+
+
+LOGGER = Logger()
+
+set_debug = LOGGER.set_debug
+debug = LOGGER.debug
+info = LOGGER.info
+warning = LOGGER.warning
+error = LOGGER.error
+close = LOGGER.close
@@ -0,0 +1,295 @@
+"""Counters and histograms, exported in the Prometheus text format.
+
+Every metric is allocated once, with fixed buckets, so recording a value
+is a bisect and an increment. They are always collected. Set
+metrics_textfile to have them written for the node_exporter textfile
+collector, or metrics_socket to serve them on a unix socket, for example
+with "socat - UNIX-CONNECT:$XDG_RUNTIME_DIR/bluedo.sock".
+"""
+
+import bisect
+import os
+import socket
+import threading
+from array import array
+from contextlib import suppress
+
+from gi.repository import GLib
+
+from . import log
+from .config import atomic_write
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONNECT_BUCKETS = (0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0)
+DELAY_BUCKETS = (1.0, 2.0, 5.0, 10.0, 15.0, 20.0, 30.0, 45.0, 60.0, 120.0, 300.0)
+RSSI_BUCKETS = (*range(-100, -30, 5), *range(-30, 1, 2))  # BLE dBm, then ACL
+
+TEXTFILE_PERIOD = 15  # Seconds between textfile writes
+SEND_TIMEOUT = 1.0  # Seconds a socket client gets to read the metrics
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=""):
+        self.name = name
+        self.help = help_text
+        self.labels = labels  # Rendered, like 'action="lock"'
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+
+    def render(self):
+        labels = f"{{{self.labels}}}" if self.labels else ""
+        return [f"{self.name}{labels} {self.value}"]
+
+
+class Gauge(Counter):
+    """A value that goes up and down"""
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+
+
+class AdapterMetrics:
+    """Health and load of one Bluetooth adapter"""
+
+    def __init__(self, name):
+        labels = f'adapter="{name}"'
+        self.up = Gauge("bluedo_adapter_up", "Whether the adapter is used.", labels)
+        self.probes = Counter(
+            "bluedo_adapter_probes_total", "RSSI probes sent on the adapter.", labels
+        )
+        self.readings = Counter(
+            "bluedo_adapter_readings_total",
+            "RSSI probes on the adapter that got a reading.",
+            labels,
+        )
+        self.busy = Counter(
+            "bluedo_adapter_busy_seconds_total",
+            "Time spent probing on the adapter.",
+            labels,
+        )
+
+
+class Histogram:
+    """Counts of values in fixed buckets, plus their sum"""
+
+    def __init__(self, name, help_text, buckets, labels=""):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.bounds = tuple(buckets)
+        self.counts = array("Q", [0] * (len(self.bounds) + 1))  # Last is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+    def render(self):
+        with self.lock:
+            counts = self.counts.tolist()
+            total = self.sum
+        prefix = self.labels + "," if self.labels else ""
+        labels = f"{{{self.labels}}}" if self.labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.bounds, "+Inf"), counts, strict=True):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Metrics:
+    """All metrics of one Engine"""
+
+    def __init__(self):
+        self.probes = Counter("bluedo_probes_total", "RSSI probes sent.")
+        self.probe_failures = Counter(
+            "bluedo_probe_failures_total", "RSSI probes that got no reading."
+        )
+        self.probe_seconds = Histogram(
+            "bluedo_probe_cycle_seconds",
+            "Time to probe all devices once.",
+            LATENCY_BUCKETS,
+        )
+        self.probe_interval = Gauge(
+            "bluedo_probe_interval_seconds", "Delay before the next probe cycle."
+        )
+        self.rssi = Histogram("bluedo_rssi_dbm", "RSSI readings.", RSSI_BUCKETS)
+        self.away_delay = Histogram(
+            "bluedo_away_delay_seconds",
+            "Time from the first reading under threshold to away.",
+            DELAY_BUCKETS,
+        )
+        self.reconnects = Counter(
+            "bluedo_reconnect_attempts_total", "Attempts to reconnect the device."
+        )
+        self.reconnect_successes = Counter(
+            "bluedo_reconnect_successes_total", "Reconnect attempts that connected."
+        )
+        self.reconnect_seconds = Histogram(
+            "bluedo_reconnect_seconds",
+            "Time for a reconnect attempt to connect.",
+            CONNECT_BUCKETS,
+        )
+        self.actions = {}  # Action name: Histogram
+        self.action_failures = {}  # Action name: Counter
+        self.adapters = {}  # Adapter name: AdapterMetrics
+        self.lock = threading.Lock()
+
+    def action(self, result):
+        """Record an actions.ActionResult"""
+
+        with self.lock:
+            if result.name not in self.actions:
+                labels = f'action="{result.name}"'
+                self.actions[result.name] = Histogram(
+                    "bluedo_action_seconds",
+                    "Run time of here/away actions.",
+                    LATENCY_BUCKETS,
+                    labels,
+                )
+                self.action_failures[result.name] = Counter(
+                    "bluedo_action_failures_total",
+                    "Here/away actions that failed or timed out.",
+                    labels,
+                )
+        self.actions[result.name].observe(result.elapsed)
+        if result.error is not None:
+            self.action_failures[result.name].inc()
+
+    def adapter(self, name):
+        """Return the AdapterMetrics of adapter name, like "hci0" """
+
+        with self.lock:
+            if name not in self.adapters:
+                self.adapters[name] = AdapterMetrics(name)
+            return self.adapters[name]
+
+    def render(self):
+        """Return all metrics in the Prometheus text format"""
+
+        families = [
+            [self.probes],
+            [self.probe_failures],
+            [self.probe_seconds],
+            [self.probe_interval],
+            [self.rssi],
+            [self.away_delay],
+            [self.reconnects],
+            [self.reconnect_successes],
+            [self.reconnect_seconds],
+        ]
+        with self.lock:
+            families.append(list(self.actions.values()))
+            families.append(list(self.action_failures.values()))
+            adapters = list(self.adapters.values())
+        families.append([adapter.up for adapter in adapters])
+        families.append([adapter.probes for adapter in adapters])
+        families.append([adapter.readings for adapter in adapters])
+        families.append([adapter.busy for adapter in adapters])
+
+        lines = []
+        for family in families:
+            if not family:
+                continue
+            lines += family[0].header()
+            for metric in family:
+                lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+class Exporter:
+    """Publish metrics as a textfile from the GLib main loop and/or on a
+    unix socket from a thread of its own, so slow clients don't hold up
+    probing"""
+
+    def __init__(self, metrics, textfile="", socket_path=""):
+        self.metrics = metrics
+        self.textfile = textfile
+        self.socket_path = socket_path
+        self.timer = None
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.textfile:
+            self.write_textfile()
+            self.timer = GLib.timeout_add_seconds(TEXTFILE_PERIOD, self.write_textfile)
+        if self.socket_path:
+            self.listen()
+
+    def stop(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+            self.write_textfile()
+        if self.server is not None:
+            server, self.server = self.server, None
+            # Wakes up the thread blocked in accept(), it exits by itself
+            with suppress(OSError):
+                server.shutdown(socket.SHUT_RDWR)
+            server.close()
+            self.thread = None
+            with suppress(FileNotFoundError):
+                os.unlink(self.socket_path)
+
+    def write_textfile(self):
+        try:
+            atomic_write(self.textfile, self.metrics.render())
+        except OSError as err:
+            log.error("Unable to write metrics %s: %s", self.textfile, err)
+        return GLib.SOURCE_CONTINUE
+
+    def listen(self):
+        with suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+        try:
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.socket_path)
+            os.chmod(self.socket_path, 0o600)
+            self.server.listen(4)
+        except OSError as err:
+            log.error("Unable to serve metrics on %s: %s", self.socket_path, err)
+            self.server = None
+            return
+        self.thread = threading.Thread(
+            target=self.serve, args=(self.server,), name="bluedo-metrics", daemon=True
+        )
+        self.thread.start()
+        log.debug("Serving metrics on %s", self.socket_path)
+
+    def serve(self, server):
+        """Send the metrics to whoever connects and hang up, until stop()"""
+
+        while self.server is server:
+            try:
+                client, _ = server.accept()
+            except OSError as err:
+                if self.server is server:
+                    log.error("Metrics socket failed: %s", err)
+                return
+            with client:
+                client.settimeout(SEND_TIMEOUT)
+                try:
+                    client.sendall(self.metrics.render().encode())
+                except OSError as err:
+                    log.debug("Metrics client gone: %s", err)
@@ -0,0 +1,307 @@
+"""Presence state machine.
+
+PresenceEngine turns RSSI readings into here/away transitions. Readings are
+smoothed per device by a pluggable filter, and separate thresholds are used
+for leaving (threshold) and coming back (here_threshold), so a single noisy
+sample can't flip the state. The engine does no I/O and takes its time from
+an injectable clock, so it can be driven from recorded data.
+"""
+
+import time
+from collections import deque
+
+HERE = "here"
+AWAY = "away"
+LEAVING = "leaving"  # Signal falling steadily, see TrendPredictor
+
+PREDICT_MODES = ("off", "warn", "lock")
+
+NO_SIGNAL = -99
+
+
+class NoFilter:
+    """Pass readings through unchanged"""
+
+    def update(self, rssi):
+        return rssi
+
+    def reset(self):
+        pass
+
+
+class EmaFilter:
+    """Exponential moving average"""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, rssi):
+        if self.value is None:
+            self.value = float(rssi)
+        else:
+            self.value += self.alpha * (rssi - self.value)
+        return self.value
+
+    def reset(self):
+        self.value = None
+
+
+class MedianFilter:
+    """Median of the last window readings"""
+
+    def __init__(self, window=5):
+        self.samples = deque(maxlen=window)
+
+    def update(self, rssi):
+        self.samples.append(rssi)
+        ordered = sorted(self.samples)
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            return float(ordered[middle])
+        return (ordered[middle - 1] + ordered[middle]) / 2
+
+    def reset(self):
+        self.samples.clear()
+
+
+class KalmanFilter:
+    """One dimensional Kalman filter for a slowly changing level"""
+
+    def __init__(self, process_noise=0.5, measurement_noise=4.0):
+        self.q = process_noise
+        self.r = measurement_noise
+        self.value = None
+        self.p = 1.0
+
+    def update(self, rssi):
+        if self.value is None:
+            self.value = float(rssi)
+            self.p = self.r
+            return self.value
+
+        self.p += self.q
+        gain = self.p / (self.p + self.r)
+        self.value += gain * (rssi - self.value)
+        self.p *= 1 - gain
+        return self.value
+
+    def reset(self):
+        self.value = None
+        self.p = 1.0
+
+
+FILTERS = {
+    "none": NoFilter,
+    "ema": EmaFilter,
+    "median": MedianFilter,
+    "kalman": KalmanFilter,
+}
+
+
+class TrendPredictor:
+    """Least squares slope of RSSI over the last window readings.
+
+    The sums of the fit are updated as readings enter and leave the window,
+    so each reading costs O(1) regardless of window size.
+    """
+
+    def __init__(self, window=5, slope=1.0, min_r2=0.6):
+        self.window = window
+        self.slope_limit = slope  # dB per second, positive
+        self.min_r2 = min_r2
+        self.points = deque()
+        self.origin = None
+        self.added = 0
+        self.sx = self.sy = self.sxx = self.sxy = self.syy = 0.0
+
+    def add(self, timestamp, rssi):
+        if self.origin is None:
+            self.origin = timestamp
+        x = timestamp - self.origin
+        self.points.append((x, rssi))
+        self.accumulate(x, rssi, 1)
+        if len(self.points) > self.window:
+            self.accumulate(*self.points.popleft(), -1)
+
+        # Keep x small so the running sums don't lose precision
+        self.added += 1
+        if self.added >= 100 * self.window:
+            self.rebase()
+
+    def accumulate(self, x, y, sign):
+        self.sx += sign * x
+        self.sy += sign * y
+        self.sxx += sign * x * x
+        self.sxy += sign * x * y
+        self.syy += sign * y * y
+
+    def rebase(self):
+        points = [(x - self.points[0][0], y) for x, y in self.points]
+        self.origin += self.points[0][0]
+        self.points = deque(points)
+        self.added = 0
+        self.sx = self.sy = self.sxx = self.sxy = self.syy = 0.0
+        for x, y in points:
+            self.accumulate(x, y, 1)
+
+    def reset(self):
+        self.points.clear()
+        self.origin = None
+        self.added = 0
+        self.sx = self.sy = self.sxx = self.sxy = self.syy = 0.0
+
+    def fit(self):
+        """Return (slope, r2) of the window, None until it is full"""
+
+        n = len(self.points)
+        if n < self.window:
+            return None
+        var_x = n * self.sxx - self.sx * self.sx
+        if var_x <= 0:
+            return None
+        cov = n * self.sxy - self.sx * self.sy
+        var_y = n * self.syy - self.sy * self.sy
+        slope = cov / var_x
+        r2 = 1.0 if var_y <= 0 else cov * cov / (var_x * var_y)
+        return slope, r2
+
+    def leaving(self):
+        """True if RSSI is falling steadily faster than the slope limit"""
+
+        fit = self.fit()
+        if fit is None:
+            return False
+        slope, r2 = fit
+        return slope <= -self.slope_limit and r2 >= self.min_r2
+
+
+class PresenceEngine:
+    """Here/away state machine fed with RSSI readings.
+
+    threshold: filtered RSSI below this counts as gone.
+    here_threshold: filtered RSSI must reach this to come back. Defaults to
+        threshold; set it higher to add hysteresis.
+    away_count: consecutive gone cycles before AWAY.
+    here_count: consecutive near cycles before HERE.
+    quorum: devices that must be near for the user to count as near.
+    predictor: optional TrendPredictor. With predict="warn" a steady fall
+        returns LEAVING once, with predict="lock" it goes AWAY right away.
+    """
+
+    def __init__(
+        self,
+        threshold,
+        here_threshold=None,
+        away_count=3,
+        here_count=1,
+        quorum=1,
+        filter_name="none",
+        predictor=None,
+        predict="off",
+        clock=time.monotonic,
+    ):
+        self.threshold = threshold
+        self.here_threshold = threshold if here_threshold is None else here_threshold
+        self.away_count = away_count
+        self.here_count = here_count
+        self.quorum = quorum
+        self.filter_name = filter_name if filter_name in FILTERS else "none"
+        self.predictor = predictor
+        self.predict = predict if predictor is not None else "off"
+        self.clock = clock
+
+        self.filters = {}  # Address: filter
+        self.state = HERE
+        self.changed_at = clock()
+        self.crossed_at = None  # When the current run of gone cycles started
+        self.lost = 0  # Consecutive gone cycles
+        self.found = 0  # Consecutive near cycles while away
+        self.misses = 0  # Consecutive cycles under threshold, in any state
+        self.warned = False  # LEAVING returned for the current fall
+        self.return_level = None  # RSSI needed to come back after an early lock
+        self.rssi = NO_SIGNAL  # Strongest filtered reading of the last cycle
+
+    def filtered(self, address, rssi):
+        """Return the filtered reading, None if the probe failed"""
+
+        rssi_filter = self.filters.get(address)
+        if rssi_filter is None:
+            rssi_filter = self.filters[address] = FILTERS[self.filter_name]()
+        if rssi is None:
+            rssi_filter.reset()  # Start over when the device is back
+            return None
+        return rssi_filter.update(rssi)
+
+    def feed(self, readings, enabled=True):
+        """Feed one cycle of readings, {address: rssi or None}.
+
+        Returns HERE or AWAY if the state changed, else None. While not
+        enabled, nothing counts towards AWAY.
+        """
+
+        now = self.clock()
+        values = [self.filtered(address, rssi) for address, rssi in readings.items()]
+        values = [value for value in values if value is not None]
+        self.rssi = max(values, default=NO_SIGNAL)
+        quorum = min(self.quorum, max(1, len(readings)))
+        near = sum(1 for value in values if value >= self.threshold)
+        self.misses = 0 if near >= quorum else self.misses + 1
+
+        if self.state == HERE:
+            leaving = False
+            if self.predict != "off" and enabled and self.predicts_leaving(now):
+                if self.predict == "lock":
+                    # Come back only once RSSI is back where the fall began
+                    self.return_level = self.predictor.points[0][1]
+                    self.crossed_at = now
+                    return self.change(AWAY, now)
+                leaving = True  # After counting this cycle
+            if near >= quorum:
+                self.lost = 0
+                self.crossed_at = None
+            elif enabled:
+                if self.lost == 0:
+                    self.crossed_at = now
+                self.lost += 1
+                if self.lost >= self.away_count:
+                    return self.change(AWAY, now)
+            return LEAVING if leaving else None
+
+        here_threshold = self.here_threshold
+        if self.return_level is not None:
+            here_threshold = max(here_threshold, self.return_level)
+        near = sum(1 for value in values if value >= here_threshold)
+        if near < quorum:
+            self.found = 0
+            return None
+        self.found += 1
+        if self.found >= self.here_count:
+            self.return_level = None
+            return self.change(HERE, now)
+        return None
+
+    def predicts_leaving(self, now):
+        """Feed the trend predictor, True the first time it sees a fall"""
+
+        if self.rssi == NO_SIGNAL:
+            self.predictor.reset()
+            return False
+        self.predictor.add(now, self.rssi)
+        if not self.predictor.leaving():
+            self.warned = False
+            return False
+        if self.warned:
+            return False
+        self.warned = True
+        return True
+
+    def change(self, state, now):
+        self.state = state
+        self.changed_at = now
+        self.lost = 0
+        self.found = 0
+        self.warned = False
+        if self.predictor is not None:
+            self.predictor.reset()
+        return state
@@ -0,0 +1,223 @@
+"""RSSI probe backends.
+
+A probe reads the RSSI of a connected classic Bluetooth device and returns an
+RssiSample, or None if there is no reading. Three backends are available:
+
+* "hci": keeps a raw HCI socket open per adapter and sends HCI Read RSSI
+  directly, like hcitool does internally, but without starting a process for
+  every sample.
+* "hcitool": runs "hcitool rssi" once per sample. Slow, but kept for systems
+  where raw HCI sockets don't work.
+* "ble": listens to BLE advertisements instead, see ble.py. Needs no
+  connection.
+"""
+
+import fcntl
+import socket
+import struct
+import subprocess
+import threading
+import time
+from typing import NamedTuple
+
+from . import log
+
+HCI_COMMAND_PKT = 0x01
+HCI_EVENT_PKT = 0x04
+EVT_CMD_COMPLETE = 0x0E
+EVT_CMD_STATUS = 0x0F
+ACL_LINK = 0x01
+
+OGF_STATUS_PARAM = 0x05
+OCF_READ_RSSI = 0x0005
+OPCODE_READ_RSSI = (OGF_STATUS_PARAM << 10) | OCF_READ_RSSI
+
+SOL_HCI = 0
+HCI_FILTER = 2
+HCIGETCONNINFO = 0x800448D5  # _IOR('H', 213, int)
+
+BACKENDS = ("auto", "hci", "hcitool", "ble")
+
+
+class RssiSample(NamedTuple):
+    address: str
+    rssi: int
+    timestamp: float  # time.monotonic()
+    adapter: int = 0
+
+
+def bdaddr_bytes(address):
+    """Convert "AA:BB:CC:DD:EE:FF" to the little endian bdaddr_t layout"""
+    return bytes(int(part, 16) for part in reversed(address.split(":")))
+
+
+class HcitoolProbe:
+    """Read RSSI by running hcitool, one process per sample"""
+
+    name = "hcitool"
+    needs_connection = True  # Reads RSSI of an ACL connection
+
+    def __init__(self, adapter=0):
+        self.adapter = adapter
+
+    def read_rssi(self, address):
+        cmd = ["hcitool", "-i", f"hci{self.adapter}", "rssi", address]
+        log.debug("Running hcitool rssi", device=address)
+        try:
+            proc = subprocess.run(cmd, capture_output=True, text=True, check=False)
+        except OSError as err:
+            log.info("Unable to run hcitool: %s", err)
+            return None
+
+        for line in proc.stdout.splitlines():
+            if line:
+                log.debug("hcitool line: <%s>", line, device=address)
+            fields = line.split()
+            if fields:
+                try:
+                    rssi = int(fields[-1])
+                except ValueError:
+                    continue
+                return RssiSample(address, rssi, time.monotonic(), self.adapter)
+        return None
+
+    def close(self):
+        pass
+
+
+class HciSocketProbe:
+    """Read RSSI over a long-lived raw HCI socket"""
+
+    name = "hci"
+    needs_connection = True
+
+    def __init__(self, adapter=0, timeout=1.0):
+        self.adapter = adapter
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()  # One command in flight per socket
+
+    def open(self):
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+        try:
+            sock.bind((self.adapter,))
+            event_mask = (1 << EVT_CMD_COMPLETE) | (1 << EVT_CMD_STATUS)
+            sock.setsockopt(
+                SOL_HCI,
+                HCI_FILTER,
+                struct.pack(
+                    "<IIIH", 1 << HCI_EVENT_PKT, event_mask, 0, OPCODE_READ_RSSI
+                ),
+            )
+            sock.settimeout(self.timeout)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def connection_handle(self, address):
+        """Return the ACL connection handle for address, None if not connected"""
+
+        # struct hci_conn_info_req followed by one struct hci_conn_info
+        request = bdaddr_bytes(address) + bytes([ACL_LINK]) + bytes(17)
+        try:
+            reply = fcntl.ioctl(self.sock.fileno(), HCIGETCONNINFO, request)
+        except OSError:
+            return None
+        return struct.unpack_from("<H", reply, 8)[0]
+
+    def read_rssi(self, address):
+        return self.read_rssi_many([address])[address]
+
+    def read_rssi_many(self, addresses):
+        """Return {address: RssiSample or None}. All Read RSSI commands are
+        sent before waiting, so the cycle costs one round trip."""
+
+        samples = dict.fromkeys(addresses)
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self.open()
+                self._read_rssi_many(samples)
+            except OSError as err:
+                # Adapter gone or reset, reopen on next sample
+                log.debug("HCI RSSI read failed: %s", err)
+                self.close()
+        return samples
+
+    def _read_rssi_many(self, samples):
+        pending = {}  # Connection handle: address
+        for address in samples:
+            handle = self.connection_handle(address)
+            if handle is not None:
+                pending[handle] = address
+
+        for handle in pending:
+            self.sock.send(
+                struct.pack("<BHBH", HCI_COMMAND_PKT, OPCODE_READ_RSSI, 2, handle)
+            )
+
+        outstanding = len(pending)
+        deadline = time.monotonic() + self.timeout
+        while outstanding and time.monotonic() < deadline:
+            try:
+                packet = self.sock.recv(260)
+            except TimeoutError:
+                return
+            if len(packet) < 7 or packet[0] != HCI_EVENT_PKT:
+                continue
+
+            if packet[1] == EVT_CMD_STATUS:
+                # status, ncmd, opcode. Only sent on failure, no handle.
+                if struct.unpack_from("<H", packet, 5)[0] == OPCODE_READ_RSSI:
+                    outstanding -= 1
+                continue
+            if packet[1] != EVT_CMD_COMPLETE:
+                continue
+            # plen, ncmd, opcode, status, handle, rssi
+            if struct.unpack_from("<H", packet, 4)[0] != OPCODE_READ_RSSI:
+                continue
+            outstanding -= 1
+            if len(packet) < 10 or packet[6] != 0:
+                continue
+            address = pending.get(struct.unpack_from("<H", packet, 7)[0])
+            if address is not None:
+                rssi = struct.unpack_from("<b", packet, 9)[0]
+                samples[address] = RssiSample(
+                    address, rssi, time.monotonic(), self.adapter
+                )
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def make_probe(backend="auto", adapter=0, irks=()):
+    """Return a probe for backend. "auto" picks the HCI socket backend when
+    raw HCI sockets can be opened, else hcitool. irks are ble_irks entries
+    for the "ble" backend."""
+
+    if backend not in BACKENDS:
+        log.info("Unknown probe backend <%s>, using auto.", backend)
+        backend = "auto"
+
+    if backend == "ble":
+        from . import ble  # ble imports this module
+
+        return ble.make_probe(adapter, irks)
+
+    if backend == "hcitool":
+        return HcitoolProbe(adapter=adapter)
+
+    probe = HciSocketProbe(adapter=adapter)
+    try:
+        probe.open()
+    except (OSError, AttributeError) as err:
+        # AttributeError: Python built without AF_BLUETOOTH
+        if backend == "hci":
+            log.info("Unable to open HCI socket: %s", err)
+        else:
+            log.debug("HCI socket unavailable (%s), using hcitool", err)
+            return HcitoolProbe(adapter=adapter)
+    return probe
@@ -0,0 +1,217 @@
+"""Reconnect devices that stopped answering.
+
+Some phones drop their connection and BlueZ doesn't always bring it back,
+after which every probe fails. ReconnectManager asks BlueZ to connect
+again with Device1.Connect, or bluetoothctl connect when BlueZ isn't on
+the system bus, and gets the result on the main loop without waiting for
+it, so probing carries on.
+
+Attempts start after MISSES failed probes in a row. Each attempt doubles
+the wait before the next one, from BASE_DELAY up to MAX_DELAY, less a
+random part of up to JITTER so devices and machines don't retry in step.
+A connect that succeeds but doesn't bring the probes back counts too. A
+probe that answers cancels a running attempt and resets the wait.
+"""
+
+import random
+import time
+
+from gi.repository import Gio, GLib
+
+from . import log
+
+BLUEZ_SERVICE = "org.bluez"
+DEVICE_INTERFACE = "org.bluez.Device1"
+
+MISSES = 5  # Failed probes in a row before the first attempt
+BASE_DELAY = 10.0  # Seconds
+MAX_DELAY = 600.0
+JITTER = 0.5
+CONNECT_TIMEOUT = 30  # Seconds
+
+# D-Bus errors meaning BlueZ can't be asked, try bluetoothctl
+UNREACHABLE = (
+    "org.freedesktop.DBus.Error.ServiceUnknown",
+    "org.freedesktop.DBus.Error.UnknownObject",
+    "org.freedesktop.DBus.Error.UnknownMethod",
+)
+CONNECTED = "org.bluez.Error.AlreadyConnected"
+
+
+class Attempt:
+    """Reconnect state of one device"""
+
+    __slots__ = ("misses", "tries", "next_at", "started", "cancellable", "process")
+
+    def __init__(self):
+        self.misses = 0
+        self.tries = 0  # Attempts since the device last answered
+        self.next_at = 0.0  # Earliest time.monotonic() for the next attempt
+        self.started = 0.0
+        self.cancellable = None  # Gio.Cancellable while connecting
+        self.process = None  # Gio.Subprocess of the bluetoothctl fallback
+
+
+class ReconnectManager:
+    """Reconnect probed devices from the GLib main loop.
+
+    Call update() after every probe cycle. inventory is an optional
+    bluez.DeviceInventory for looking up device paths, metrics an optional
+    metrics.Metrics.
+    """
+
+    def __init__(self, adapter=0, inventory=None, metrics=None, rng=None):
+        self.adapter = adapter
+        self.inventory = inventory
+        self.metrics = metrics
+        self.rng = rng or random.Random()
+        self.bus = None
+        self.attempts = {}  # Address: Attempt
+
+    def update(self, readings):
+        """Follow one probe cycle, {address: rssi or None}"""
+
+        for address in set(self.attempts) - set(readings):
+            self.cancel(address)  # No longer probed
+            del self.attempts[address]
+
+        now = time.monotonic()
+        for address, rssi in readings.items():
+            attempt = self.attempts.get(address)
+            if rssi is not None:
+                if attempt is not None:
+                    self.cancel(address)
+                    del self.attempts[address]
+                continue
+            if attempt is None:
+                attempt = self.attempts[address] = Attempt()
+            attempt.misses += 1
+            if (
+                attempt.misses >= MISSES
+                and attempt.cancellable is None
+                and now >= attempt.next_at
+            ):
+                self.start(address, attempt)
+
+    def delay(self, tries):
+        """Seconds to wait after tries attempts"""
+
+        delay = min(MAX_DELAY, BASE_DELAY * 2 ** min(tries - 1, 16))
+        return delay * (1 - JITTER * self.rng.random())
+
+    def start(self, address, attempt):
+        log.info("Reconnecting", device=address, attempt=attempt.tries + 1)
+        if self.metrics is not None:
+            self.metrics.reconnects.inc()
+        attempt.started = time.monotonic()
+        attempt.cancellable = Gio.Cancellable()
+
+        bus = self.system_bus()
+        if bus is None:
+            self.start_bluetoothctl(address, attempt)
+            return
+        bus.call(
+            BLUEZ_SERVICE,
+            self.device_path(address),
+            DEVICE_INTERFACE,
+            "Connect",
+            None,
+            None,
+            Gio.DBusCallFlags.NONE,
+            CONNECT_TIMEOUT * 1000,
+            attempt.cancellable,
+            self.on_connect_done,
+            (address, attempt),
+        )
+
+    def on_connect_done(self, bus, result, data):
+        address, attempt = data
+        try:
+            bus.call_finish(result)
+        except GLib.Error as err:
+            if err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                return
+            remote = Gio.DBusError.get_remote_error(err)
+            if remote in UNREACHABLE:
+                self.start_bluetoothctl(address, attempt)
+                return
+            if remote != CONNECTED:
+                self.finish(address, attempt, False, err.message)
+                return
+        self.finish(address, attempt, True)
+
+    def start_bluetoothctl(self, address, attempt):
+        try:
+            attempt.process = Gio.Subprocess.new(
+                ["bluetoothctl", "--timeout", str(CONNECT_TIMEOUT), "connect", address],
+                Gio.SubprocessFlags.STDOUT_SILENCE | Gio.SubprocessFlags.STDERR_SILENCE,
+            )
+        except GLib.Error as err:
+            self.finish(address, attempt, False, f"Unable to run bluetoothctl: {err}")
+            return
+        attempt.process.wait_check_async(
+            attempt.cancellable, self.on_bluetoothctl_done, (address, attempt)
+        )
+
+    def on_bluetoothctl_done(self, process, result, data):
+        address, attempt = data
+        try:
+            process.wait_check_finish(result)
+        except GLib.Error as err:
+            if err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                return
+            self.finish(address, attempt, False, err.message)
+            return
+        self.finish(address, attempt, True)
+
+    def finish(self, address, attempt, connected, error=None):
+        if attempt.cancellable is None:
+            return  # Cancelled meanwhile
+        now = time.monotonic()
+        elapsed = now - attempt.started
+        attempt.cancellable = None
+        attempt.process = None
+        attempt.tries += 1
+        wait = self.delay(attempt.tries)
+        attempt.next_at = now + wait
+        if connected:
+            log.info("Reconnected in %.1fs", elapsed, device=address)
+            attempt.misses = 0  # Give the probes MISSES cycles to find it
+            if self.metrics is not None:
+                self.metrics.reconnect_successes.inc()
+                self.metrics.reconnect_seconds.observe(elapsed)
+            return
+        log.info("Reconnect failed: %s, next in %.0fs", error, wait, device=address)
+
+    def cancel(self, address):
+        """Stop a running attempt, the device is back or no longer probed"""
+
+        attempt = self.attempts.get(address)
+        if attempt is None or attempt.cancellable is None:
+            return
+        log.debug("Reconnect cancelled", device=address)
+        attempt.cancellable.cancel()
+        if attempt.process is not None:
+            attempt.process.force_exit()
+        attempt.cancellable = None
+        attempt.process = None
+
+    def stop(self):
+        for address in list(self.attempts):
+            self.cancel(address)
+        self.attempts.clear()
+
+    def system_bus(self):
+        if self.bus is None:
+            try:
+                self.bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+            except GLib.Error as err:
+                log.info("No system bus, reconnecting with bluetoothctl: %s", err)
+                return None
+        return self.bus
+
+    def device_path(self, address):
+        path = self.inventory.device_path(address) if self.inventory else None
+        if path is None:
+            path = f"/org/bluez/hci{self.adapter}/dev_{address.replace(':', '_')}"
+        return path
@@ -0,0 +1,431 @@
+"""Replay RSSI traces through the presence engine.
+
+    bluedo replay [--history FILE | --csv FILE | --synthetic SEED] [options]
+
+Runs a recorded history file (see history_file), a CSV of
+timestamp,address,rssi rows or a generated trace through PresenceEngine
+with a fake clock, and prints when here and away would have fired.
+
+With any --sweep option, every combination of the swept settings is run
+instead and summarized in a table. The sweep runs all combinations at once
+on NumPy arrays if NumPy is installed (bluedo[analysis]), else one by one.
+Sweeps use the configured rssi_filter and quorum, with predict off.
+Ranges are inclusive, give negative ones with "=", like
+--sweep-threshold=-8:-2.
+"""
+
+import argparse
+import configparser
+import csv
+import itertools
+import random
+import sys
+import time
+
+from . import history, presence
+from .config import CONFIG_PATH, Settings
+
+try:
+    import numpy
+except ImportError:  # Sweeps fall back to one engine per combination
+    numpy = None
+
+SYNTHETIC_ADDRESS = "00:00:00:00:00:01"
+WALK_SECONDS = 30  # Length of the walk away in synthetic traces
+MISSING = object()  # Device not probed in a cycle
+
+
+class ReplayClock:
+    """Clock for PresenceEngine, set to the time of each cycle"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+#
+# Traces. A trace is a list of cycles, (timestamp, {address: rssi or None}).
+#
+
+
+def group_cycles(rows):
+    """Turn (timestamp, address, rssi) rows into cycles. Rows of one cycle
+    share their timestamp."""
+
+    cycles = []
+    for timestamp, address, rssi in rows:
+        if not cycles or cycles[-1][0] != timestamp:
+            cycles.append((timestamp, {}))
+        cycles[-1][1][address] = None if rssi == presence.NO_SIGNAL else rssi
+    return cycles
+
+
+def history_trace(path):
+    return group_cycles(
+        (timestamp, address, rssi)
+        for timestamp, address, rssi, _ in history.records(path)
+    )
+
+
+def csv_trace(path):
+    """Rows of timestamp,address,rssi. An empty rssi is a failed probe.
+    Malformed rows are skipped and counted on stderr."""
+
+    rows = []
+    skipped = []  # Line numbers of malformed rows
+    header = True  # The first row may name the columns
+    with open(path, newline="", encoding="utf8") as f:
+        reader = csv.reader(f)
+        for row in reader:
+            if not any(field.strip() for field in row) or row[0].startswith("#"):
+                continue
+            first, header = header, False
+            try:
+                timestamp = float(row[0])
+            except ValueError:
+                if not first:
+                    skipped.append(reader.line_num)
+                continue
+            try:
+                address = row[1].strip()
+                rssi = int(row[2]) if row[2].strip() else presence.NO_SIGNAL
+            except (ValueError, IndexError):
+                address = None
+            if not address:
+                skipped.append(reader.line_num)
+                continue
+            rows.append((timestamp, address, rssi))
+
+    if skipped:
+        print(
+            f"Skipped {len(skipped)} malformed rows of {path}, "
+            + f"the first on line {skipped[0]}",
+            file=sys.stderr,
+        )
+    return group_cycles(rows)
+
+
+def synthetic_trace(seed, hours=24.0, interval=5.0):
+    """Return (cycles, truth) for a user coming and going at random.
+    truth[i] is True if the user was at the desk during cycle i. The walk
+    away at the end of each stay already counts as gone."""
+
+    rng = random.Random(seed)
+    cycles = []
+    truth = []
+    now = 0.0
+    present = True
+    while now < hours * 3600:
+        length = rng.uniform(1200, 5400) if present else rng.uniform(300, 3600)
+        end = now + length
+        started = now
+        while now < end:
+            # Walking away over the last WALK_SECONDS
+            walking = present and end - now < WALK_SECONDS
+            if present:
+                rssi = round(rng.gauss(-1, 1.5))
+                if walking:
+                    rssi -= round((WALK_SECONDS - (end - now)) / 3)
+            else:
+                rssi = None if rng.random() < 0.9 else round(rng.gauss(-18, 3))
+                if now - started < 20:  # Still fading out
+                    rssi = round(rng.gauss(-12, 3))
+            if rssi is not None:
+                rssi = max(-30, min(0, rssi))
+            cycles.append((now, {SYNTHETIC_ADDRESS: rssi}))
+            truth.append(present and not walking)
+            now += interval * rng.uniform(0.9, 1.1)
+        present = not present
+    return cycles, truth
+
+
+#
+# Replay
+#
+
+
+def replay(cycles, settings):
+    """Run cycles through a PresenceEngine set up like Engine does. Returns
+    [(timestamp, event)] for every HERE, AWAY and LEAVING."""
+
+    clock = ReplayClock(cycles[0][0] if cycles else 0.0)
+    engine = presence.PresenceEngine(
+        settings.threshold,
+        here_threshold=settings.here_threshold,
+        away_count=settings.away_count,
+        here_count=settings.here_count,
+        quorum=settings.quorum,
+        filter_name=settings.rssi_filter,
+        predictor=presence.TrendPredictor(
+            window=settings.predict_window, slope=settings.predict_slope
+        ),
+        predict=settings.predict,
+        clock=clock,
+    )
+    events = []
+    for timestamp, readings in cycles:
+        clock.now = timestamp
+        event = engine.feed(readings)
+        if event is not None:
+            events.append((timestamp, event))
+    return events
+
+
+def filtered_matrix(cycles, filter_name):
+    """Return (addresses, values) with values[cycle][device] the filtered
+    RSSI, None for a failed probe, MISSING if not probed that cycle"""
+
+    engine = presence.PresenceEngine(0, filter_name=filter_name)
+    addresses = sorted({address for _, readings in cycles for address in readings})
+    values = []
+    for _, readings in cycles:
+        values.append(
+            [
+                engine.filtered(address, readings[address])
+                if address in readings
+                else MISSING
+                for address in addresses
+            ]
+        )
+    return addresses, values
+
+
+def sweep_numpy(cycles, combos, quorum, filter_name):
+    """Run all combos, rows of (threshold, here_threshold, away_count,
+    here_count), at once. Same rules as PresenceEngine.feed with predict
+    off. Returns a list of [(cycle index, event)] per combo."""
+
+    _, values = filtered_matrix(cycles, filter_name)
+    combos = numpy.asarray(combos, dtype=float)
+    threshold, here_threshold = combos[:, 0, None], combos[:, 1, None]
+    away_count, here_count = combos[:, 2], combos[:, 3]
+
+    size = len(combos)
+    away = numpy.zeros(size, dtype=bool)
+    lost = numpy.zeros(size, dtype=int)
+    found = numpy.zeros(size, dtype=int)
+    events = [[] for _ in range(size)]
+
+    for index, row in enumerate(values):
+        probed = [value for value in row if value is not MISSING]
+        rssi = numpy.array(
+            [-numpy.inf if value is None else value for value in probed], dtype=float
+        )
+        need = min(quorum, max(1, len(probed)))
+        near = (rssi >= threshold).sum(axis=1) >= need
+        near_here = (rssi >= here_threshold).sum(axis=1) >= need
+
+        here = ~away
+        lost = numpy.where(here & near, 0, numpy.where(here, lost + 1, lost))
+        found = numpy.where(away & near_here, found + 1, numpy.where(away, 0, found))
+        to_away = here & (lost >= away_count)
+        to_here = away & (found >= here_count)
+
+        changed = to_away | to_here
+        if changed.any():
+            for combo in numpy.flatnonzero(to_away):
+                events[combo].append((index, presence.AWAY))
+            for combo in numpy.flatnonzero(to_here):
+                events[combo].append((index, presence.HERE))
+            away = away ^ changed
+            lost[changed] = 0
+            found[changed] = 0
+    return events
+
+
+def sweep_engines(cycles, combos, quorum, filter_name):
+    """Slow path of sweep_numpy, one PresenceEngine per combo"""
+
+    results = []
+    for threshold, here_threshold, away_count, here_count in combos:
+        engine = presence.PresenceEngine(
+            threshold,
+            here_threshold=here_threshold,
+            away_count=away_count,
+            here_count=here_count,
+            quorum=quorum,
+            filter_name=filter_name,
+        )
+        events = []
+        for index, (_, readings) in enumerate(cycles):
+            event = engine.feed(readings)
+            if event is not None:
+                events.append((index, event))
+        results.append(events)
+    return results
+
+
+def score(cycles, events, truth):
+    """Summarize one combo's events. With truth, also count false aways,
+    missed leaves and the mean delay from leaving to away."""
+
+    aways = sum(1 for _, event in events if event == presence.AWAY)
+    heres = len(events) - aways
+    summary = {"aways": aways, "heres": heres}
+    if truth is None:
+        return summary
+
+    false_aways = sum(
+        1 for index, event in events if event == presence.AWAY and truth[index]
+    )
+    leaves = [
+        index for index in range(1, len(truth)) if truth[index - 1] and not truth[index]
+    ]
+    away_at = [index for index, event in events if event == presence.AWAY]
+    delays = []
+    missed = 0
+    for leave in leaves:
+        back = next((i for i in range(leave, len(truth)) if truth[i]), len(truth))
+        hit = next((i for i in away_at if leave <= i < back), None)
+        if hit is None:
+            missed += 1
+        else:
+            delays.append(cycles[hit][0] - cycles[leave][0])
+    summary["false_aways"] = false_aways
+    summary["missed"] = missed
+    summary["delay"] = sum(delays) / len(delays) if delays else None
+    return summary
+
+
+#
+# Command line
+#
+
+
+def int_range(text):
+    """Parse "-8:-2" (inclusive) or "-8,-6,-4" into a list of ints"""
+
+    if ":" in text:
+        start, end = (int(part) for part in text.split(":", 1))
+        return list(range(start, end + 1))
+    return [int(part) for part in text.split(",") if part.strip()]
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog="bluedo replay", description="Replay RSSI traces through BlueDo"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--history", metavar="FILE", help="history_file to replay")
+    source.add_argument("--csv", metavar="FILE", help="timestamp,address,rssi rows")
+    source.add_argument(
+        "--synthetic", metavar="SEED", type=int, help="generated day at the desk"
+    )
+    parser.add_argument("--config", default=CONFIG_PATH, help="settings to start from")
+    parser.add_argument("--threshold", type=int)
+    parser.add_argument("--here-threshold", type=int)
+    parser.add_argument("--away-count", type=int)
+    parser.add_argument("--here-count", type=int)
+    parser.add_argument("--quorum", type=int)
+    parser.add_argument("--rssi-filter", choices=tuple(presence.FILTERS))
+    parser.add_argument("--predict", choices=presence.PREDICT_MODES)
+    parser.add_argument("--sweep-threshold", type=int_range, metavar="A:B")
+    parser.add_argument(
+        "--sweep-hysteresis",
+        type=int_range,
+        metavar="A:B",
+        help="here_threshold minus threshold",
+    )
+    parser.add_argument("--sweep-away-count", type=int_range, metavar="A:B")
+    parser.add_argument("--sweep-here-count", type=int_range, metavar="A:B")
+    parser.add_argument(
+        "--no-numpy", action="store_true", help="sweep without NumPy, to compare"
+    )
+    return parser.parse_args(args)
+
+
+def load_settings(options):
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(options.config, encoding="utf8")
+    settings = Settings.from_config(parser, "CONFIG")
+    for name in (
+        "threshold",
+        "here_threshold",
+        "away_count",
+        "here_count",
+        "quorum",
+        "rssi_filter",
+        "predict",
+    ):
+        value = getattr(options, name)
+        if value is not None:
+            setattr(settings, name, value)
+    if options.threshold is not None and options.here_threshold is None:
+        settings.here_threshold = None
+    return settings.resolved()
+
+
+def timestamp_text(timestamp, start):
+    if start > 1e9:  # Wall clock, from a history file
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+    return f"{timestamp - start:10.1f}s"
+
+
+def main(args):
+    options = parse_args(args)
+    settings = load_settings(options)
+
+    truth = None
+    if options.history:
+        cycles = history_trace(options.history)
+    elif options.csv:
+        cycles = csv_trace(options.csv)
+    else:
+        cycles, truth = synthetic_trace(options.synthetic, interval=settings.interval)
+    if not cycles:
+        print("Nothing to replay", file=sys.stderr)
+        return 1
+    span = cycles[-1][0] - cycles[0][0]
+
+    sweeping = (
+        options.sweep_threshold
+        or options.sweep_hysteresis
+        or options.sweep_away_count
+        or options.sweep_here_count
+    )
+    started = time.perf_counter()
+    if not sweeping:
+        events = replay(cycles, settings)
+        elapsed = time.perf_counter() - started
+        for timestamp, event in events:
+            print(f"{timestamp_text(timestamp, cycles[0][0])}  {event}")
+        print(f"{len(cycles)} cycles, {span:.0f}s of trace in {elapsed:.3f}s")
+        return 0
+
+    combos = [
+        (threshold, threshold + hysteresis, away_count, here_count)
+        for threshold, hysteresis, away_count, here_count in itertools.product(
+            options.sweep_threshold or [settings.threshold],
+            options.sweep_hysteresis or [settings.here_threshold - settings.threshold],
+            options.sweep_away_count or [settings.away_count],
+            options.sweep_here_count or [settings.here_count],
+        )
+    ]
+    sweep = sweep_engines if numpy is None or options.no_numpy else sweep_numpy
+    results = sweep(cycles, combos, settings.quorum, settings.rssi_filter)
+    elapsed = time.perf_counter() - started
+
+    header = "threshold here_threshold away_count here_count  aways heres"
+    if truth is not None:
+        header += "  false missed  delay"
+    print(header)
+    for combo, events in zip(combos, results, strict=True):
+        summary = score(cycles, events, truth)
+        line = "{:9d} {:14d} {:10d} {:10d}  {:5d} {:5d}".format(
+            *combo, summary["aways"], summary["heres"]
+        )
+        if truth is not None:
+            delay = summary["delay"]
+            line += "  {:5d} {:6d} {:>6}".format(
+                summary["false_aways"],
+                summary["missed"],
+                "-" if delay is None else f"{delay:.0f}s",
+            )
+        print(line)
+    print(
+        f"{len(combos)} combinations of {len(cycles)} cycles, {span:.0f}s of trace"
+        + f" in {elapsed:.3f}s"
+    )
+    return 0
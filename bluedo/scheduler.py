@@ -0,0 +1,110 @@
+"""Probe scheduling for several devices.
+
+ProbeScheduler reads RSSI for all configured devices in one cycle. Backends
+that can batch (the HCI socket probe) get every device in one round trip,
+others are spread over a small worker pool capped at the number of requests
+the adapter is allowed to have in flight.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from . import log
+from .presence import AWAY, NO_SIGNAL
+
+
+class ProbeScheduler:
+    """Probe a set of devices concurrently"""
+
+    def __init__(self, probe, max_workers=3, timeout=5.0):
+        self.probe = probe
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix="bluedo-probe"
+        )
+
+    def probe_all(self, addresses):
+        """Return {address: RssiSample or None} for all addresses"""
+
+        if hasattr(self.probe, "read_rssi_many"):
+            return self.probe.read_rssi_many(addresses)
+
+        futures = {
+            address: self.pool.submit(self.probe.read_rssi, address)
+            for address in addresses
+        }
+        samples = {}
+        for address, future in futures.items():
+            try:
+                samples[address] = future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                log.debug("Probe timed out", device=address)
+                samples[address] = None
+        return samples
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.probe.close()
+
+
+class AdaptiveInterval:
+    """Pick the delay before the next probe cycle.
+
+    Backs off towards max_interval while RSSI stays strong and steady, halves
+    the delay when RSSI falls more than deadband dB under its moving average,
+    and goes straight to min_interval when RSSI is within margin of
+    threshold or a probe fails. While away, backs off unless RSSI is within
+    margin of here_threshold: there is nothing to lock, and an empty desk
+    mostly fails its probes, but a user coming back should be seen at once.
+    """
+
+    def __init__(
+        self,
+        min_interval=1.0,
+        max_interval=10.0,
+        margin=3,
+        backoff=1.5,
+        deadband=3.0,
+        alpha=0.3,
+    ):
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.margin = margin
+        self.backoff = backoff
+        self.deadband = deadband
+        self.alpha = alpha
+        self.interval = self.min_interval
+        self.level = None  # Moving average of RSSI
+
+    def next(self, rssi, threshold, state=None, here_threshold=None):
+        """Return seconds to wait after a cycle that read rssi (None if the
+        probe failed), in presence state. here_threshold defaults to
+        threshold."""
+
+        failed = rssi is None or rssi == NO_SIGNAL
+        if here_threshold is None:
+            here_threshold = threshold
+        if state == AWAY:
+            if not failed and rssi >= here_threshold - self.margin:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+        elif failed or rssi < threshold + self.margin:
+            self.interval = self.min_interval
+        elif self.level is not None and rssi < self.level - self.deadband:
+            self.interval = max(self.interval / 2, self.min_interval)
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+        if failed:
+            self.level = None
+        elif self.level is None:
+            self.level = float(rssi)
+        else:
+            self.level += self.alpha * (rssi - self.level)
+        return self.interval
+
+    @property
+    def rate(self):
+        """Current probe rate in cycles per second"""
+        return 1 / self.interval if self.interval else 0.0
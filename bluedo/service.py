@@ -0,0 +1,256 @@
+"""Presence state on the session bus.
+
+    bluedo status [--json]
+
+BlueDo exports interface no.graph.bluedo at /no/graph/bluedo under its
+application id, so other tools can follow it without probing the device
+themselves:
+
+    State     s       "here" or "away"
+    Rssi      i       strongest filtered reading of the last cycle
+    Enabled   b       whether away actions run
+    Devices   a(ssi)  address, name and last raw RSSI of each probed device
+
+Changes are announced with PropertiesChanged after the probe cycle that
+made them, and Here(rssi) / Away(rssi) are emitted on every state change.
+Enable() and Disable() switch actions on and off, as the tray menu does,
+and ProbeNow() starts a probe cycle without waiting for the next one.
+
+The status command reads the properties and exits. It needs no GTK and
+doesn't start BlueDo.
+"""
+
+import argparse
+import json
+import sys
+
+from gi.repository import Gio, GLib
+
+from . import log, presence
+
+BUS_NAME = "no.graph.bluedo"
+OBJECT_PATH = "/no/graph/bluedo"
+INTERFACE = "no.graph.bluedo"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+STATUS_TIMEOUT = 1000  # ms
+
+INTROSPECTION = f"""
+<node>
+  <interface name="{INTERFACE}">
+    <property name="State" type="s" access="read"/>
+    <property name="Rssi" type="i" access="read"/>
+    <property name="Enabled" type="b" access="read"/>
+    <property name="Devices" type="a(ssi)" access="read"/>
+    <signal name="Here"><arg name="rssi" type="i"/></signal>
+    <signal name="Away"><arg name="rssi" type="i"/></signal>
+    <method name="Enable"/>
+    <method name="Disable"/>
+    <method name="ProbeNow"/>
+  </interface>
+</node>
+"""
+
+SIGNATURES = {"State": "s", "Rssi": "i", "Enabled": "b", "Devices": "a(ssi)"}
+
+
+def rssi_value(rssi):
+    """RSSI as the int D-Bus sends. Filtered readings are floats."""
+    return presence.NO_SIGNAL if rssi is None else int(round(rssi))
+
+
+class PresenceService:
+    """Export an engine.Engine on a D-Bus connection"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.connection = None
+        self.object_path = OBJECT_PATH
+        self.registration = None
+        self.owner = None  # Bus name ownership, see publish()
+        self.published = {}  # Property values last announced
+        engine.connect(self.on_engine_event)
+        engine.connect_settings(self.on_settings_changed)
+
+    def register(self, connection, object_path=OBJECT_PATH):
+        info = Gio.DBusNodeInfo.new_for_xml(INTROSPECTION).interfaces[0]
+        self.connection = connection
+        self.object_path = object_path
+        self.registration = connection.register_object(
+            object_path, info, self.on_method_call, self.on_get_property, None
+        )
+        self.published = self.properties()
+
+    def unregister(self):
+        if self.registration is not None:
+            self.connection.unregister_object(self.registration)
+            self.registration = None
+        if self.owner is not None:
+            Gio.bus_unown_name(self.owner)
+            self.owner = None
+
+    def properties(self):
+        engine = self.engine
+        settings = engine.settings
+        names = {settings.bt_address: settings.bt_name}
+        state = engine.presence_engine.state if engine.presence_engine else ""
+        return {
+            "State": state,
+            "Rssi": rssi_value(engine.rssi),
+            "Enabled": settings.enabled,
+            "Devices": [
+                (address, names.get(address, ""), rssi_value(rssi))
+                for address, rssi in engine.readings.items()
+            ],
+        }
+
+    def on_get_property(self, connection, sender, object_path, interface, name):
+        return GLib.Variant(SIGNATURES[name], self.properties()[name])
+
+    def on_method_call(
+        self, connection, sender, object_path, interface, method, params, invocation
+    ):
+        log.info("D-Bus call %s from %s", method, sender)
+        if method == "Enable":
+            self.engine.set_enabled(True)
+        elif method == "Disable":
+            self.engine.set_enabled(False)
+        elif method == "ProbeNow":
+            self.engine.wake()
+        self.announce()
+        invocation.return_value(None)
+
+    def on_engine_event(self, event):
+        if self.registration is None:
+            return
+        if event == presence.HERE:
+            self.emit("Here", self.engine.rssi)
+        elif event == presence.AWAY:
+            self.emit("Away", self.engine.rssi)
+        self.announce()
+
+    def on_settings_changed(self, changed):
+        if self.registration is not None and "enabled" in changed:
+            self.announce()
+
+    def emit(self, signal, rssi):
+        self.connection.emit_signal(
+            None,
+            self.object_path,
+            INTERFACE,
+            signal,
+            GLib.Variant("(i)", (rssi_value(rssi),)),
+        )
+
+    def announce(self):
+        """Emit PropertiesChanged for what changed since last time"""
+
+        current = self.properties()
+        changed = {
+            name: GLib.Variant(SIGNATURES[name], value)
+            for name, value in current.items()
+            if self.published.get(name) != value
+        }
+        self.published = current
+        if not changed:
+            return
+        self.connection.emit_signal(
+            None,
+            self.object_path,
+            PROPERTIES_INTERFACE,
+            "PropertiesChanged",
+            GLib.Variant("(sa{sv}as)", (INTERFACE, changed, [])),
+        )
+
+
+def publish(engine):
+    """Own BUS_NAME on the session bus and export engine there, for when
+    there is no Gtk.Application to do it. Returns the PresenceService."""
+
+    service = PresenceService(engine)
+
+    def on_bus_acquired(connection, name):
+        service.register(connection)
+
+    def on_name_lost(connection, name):
+        log.warning("Unable to own %s on the session bus, is BlueDo running?", name)
+        service.unregister()
+
+    service.owner = Gio.bus_own_name(
+        Gio.BusType.SESSION,
+        BUS_NAME,
+        Gio.BusNameOwnerFlags.NONE,
+        on_bus_acquired,
+        None,
+        on_name_lost,
+    )
+    return service
+
+
+#
+# Command line
+#
+
+
+def get_status():
+    """Return the properties of a running BlueDo, None if none runs"""
+
+    bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+    try:
+        (properties,) = bus.call_sync(
+            BUS_NAME,
+            OBJECT_PATH,
+            PROPERTIES_INTERFACE,
+            "GetAll",
+            GLib.Variant("(s)", (INTERFACE,)),
+            GLib.VariantType("(a{sv})"),
+            Gio.DBusCallFlags.NO_AUTO_START,
+            STATUS_TIMEOUT,
+            None,
+        ).unpack()
+    except GLib.Error:
+        return None
+    return properties
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="bluedo status", description="Show the state of a running BlueDo"
+    )
+    parser.add_argument("--json", action="store_true")
+    options = parser.parse_args(args)
+
+    try:
+        properties = get_status()
+    except GLib.Error as err:
+        print(f"No session bus: {err.message}", file=sys.stderr)
+        return 2
+    if properties is None:
+        if options.json:
+            print(json.dumps({"running": False}))
+        else:
+            print("BlueDo is not running")
+        return 1
+
+    devices = [
+        {"address": address, "name": name, "rssi": rssi}
+        for address, name, rssi in properties["Devices"]
+    ]
+    if options.json:
+        print(
+            json.dumps(
+                {
+                    "running": True,
+                    "state": properties["State"],
+                    "rssi": properties["Rssi"],
+                    "enabled": properties["Enabled"],
+                    "devices": devices,
+                }
+            )
+        )
+        return 0
+
+    enabled = "enabled" if properties["Enabled"] else "disabled"
+    print(f"{properties['State']}, RSSI {properties['Rssi']}, {enabled}")
+    for device in devices:
+        print(f"  {device['address']} {device['name']} RSSI {device['rssi']}")
+    return 0
@@ -0,0 +1,250 @@
+"""Session state from logind and the screensaver.
+
+SessionMonitor follows, from D-Bus signals on the GLib main loop:
+
+* locked: the logind LockedHint of our session, Lock and Unlock requests,
+  and the screensaver ActiveChanged signal. None until known.
+* active: whether our session is the one in front on its seat.
+* asleep: between PrepareForSleep(true) and PrepareForSleep(false).
+
+The engine pauses probing while asleep or inactive, and probes again as
+soon as the machine resumes or the session comes back. unlock() leaves out
+the logind Unlock call when the screensaver says the screen isn't locked.
+LockedHint alone isn't trusted for that, lockers that don't set it leave
+it False while locked.
+"""
+
+from gi.repository import Gio, GLib
+
+from . import log
+
+LOGIN1_NAME = "org.freedesktop.login1"
+LOGIN1_PATH = "/org/freedesktop/login1"
+LOGIN1_MANAGER = "org.freedesktop.login1.Manager"
+LOGIN1_SESSION = "org.freedesktop.login1.Session"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+DBUS_TIMEOUT = 2000  # ms
+
+# Bus name, object path and interface of screensavers to ask and follow
+SCREENSAVERS = (
+    ("org.gnome.ScreenSaver", "/org/gnome/ScreenSaver", "org.gnome.ScreenSaver"),
+    (
+        "org.freedesktop.ScreenSaver",
+        "/org/freedesktop/ScreenSaver",
+        "org.freedesktop.ScreenSaver",
+    ),
+)
+
+
+class SessionMonitor:
+    """Cached state of our logind session(s).
+
+    session_paths is a callable returning the logind object paths to
+    follow, like actions.DesktopActions.session_paths. Listeners added with
+    connect() are called with the set of changed names, "locked", "active"
+    or "asleep".
+    """
+
+    def __init__(self, session_paths):
+        self.session_paths = session_paths
+        self.locked_hint = {}  # Session path: LockedHint
+        self.active_hint = {}  # Session path: Active
+        self.screensaver = None  # Screensaver shown, None if none answered
+        self.locked = None
+        self.active = True
+        self.asleep = False
+        self.listeners = []
+        self.system_bus = None
+        self.session_bus = None
+        self.subscriptions = []  # (bus, subscription id)
+
+    def connect(self, callback):
+        self.listeners.append(callback)
+
+    @property
+    def unlocked(self):
+        """Whether the screen is known not to be locked, as reported by the
+        screensaver"""
+        return self.screensaver is False and not any(self.locked_hint.values())
+
+    @property
+    def paused(self):
+        """Whether probing would be pointless now"""
+        return self.asleep or not self.active
+
+    def start(self):
+        try:
+            self.system_bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+        except GLib.Error as err:
+            log.info("No system bus, not following logind: %s", err)
+        else:
+            self.follow_logind()
+        try:
+            self.session_bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+        except GLib.Error as err:
+            log.info("No session bus, not following the screensaver: %s", err)
+        else:
+            self.follow_screensaver()
+
+    def stop(self):
+        for bus, subscription in self.subscriptions:
+            bus.signal_unsubscribe(subscription)
+        self.subscriptions = []
+
+    def subscribe(self, bus, sender, interface, member, path, arg0, callback):
+        subscription = bus.signal_subscribe(
+            sender,
+            interface,
+            member,
+            path,
+            arg0,
+            Gio.DBusSignalFlags.NONE,
+            callback,
+        )
+        self.subscriptions.append((bus, subscription))
+
+    def follow_logind(self):
+        bus = self.system_bus
+        self.subscribe(
+            bus,
+            LOGIN1_NAME,
+            LOGIN1_MANAGER,
+            "PrepareForSleep",
+            LOGIN1_PATH,
+            None,
+            self.on_prepare_for_sleep,
+        )
+        for path in self.session_paths():
+            for member in ("Lock", "Unlock"):
+                self.subscribe(
+                    bus,
+                    LOGIN1_NAME,
+                    LOGIN1_SESSION,
+                    member,
+                    path,
+                    None,
+                    self.on_lock_signal,
+                )
+            self.subscribe(
+                bus,
+                LOGIN1_NAME,
+                PROPERTIES_INTERFACE,
+                "PropertiesChanged",
+                path,
+                LOGIN1_SESSION,
+                self.on_session_properties,
+            )
+            bus.call(
+                LOGIN1_NAME,
+                path,
+                PROPERTIES_INTERFACE,
+                "GetAll",
+                GLib.Variant("(s)", (LOGIN1_SESSION,)),
+                GLib.VariantType("(a{sv})"),
+                Gio.DBusCallFlags.NONE,
+                DBUS_TIMEOUT,
+                None,
+                self.on_session_get_all,
+                path,
+            )
+
+    def follow_screensaver(self):
+        bus = self.session_bus
+        for name, path, interface in SCREENSAVERS:
+            self.subscribe(
+                bus,
+                None,
+                interface,
+                "ActiveChanged",
+                None,
+                None,
+                self.on_screensaver_active_changed,
+            )
+            bus.call(
+                name,
+                path,
+                interface,
+                "GetActive",
+                None,
+                GLib.VariantType("(b)"),
+                Gio.DBusCallFlags.NO_AUTO_START,
+                DBUS_TIMEOUT,
+                None,
+                self.on_screensaver_get_active,
+                name,
+            )
+
+    #
+    # D-Bus callbacks
+    #
+
+    def on_prepare_for_sleep(self, bus, sender, path, interface, signal, params):
+        (self.asleep,) = params.unpack()
+        log.info("Suspending" if self.asleep else "Resumed")
+        self.notify({"asleep"})
+
+    def on_lock_signal(self, bus, sender, path, interface, signal, params):
+        log.debug("logind %s", signal, session=path)
+        self.locked_hint[path] = signal == "Lock"
+        self.update()
+
+    def on_session_properties(self, bus, sender, path, interface, signal, params):
+        _, changed, _ = params.unpack()
+        self.session_changed(path, changed)
+
+    def on_session_get_all(self, bus, result, path):
+        try:
+            (properties,) = bus.call_finish(result).unpack()
+        except GLib.Error as err:
+            log.warning("Unable to read logind session %s: %s", path, err)
+            return
+        self.session_changed(path, properties)
+
+    def session_changed(self, path, properties):
+        if "LockedHint" in properties:
+            self.locked_hint[path] = properties["LockedHint"]
+        if "Active" in properties:
+            self.active_hint[path] = properties["Active"]
+        self.update()
+
+    def on_screensaver_active_changed(
+        self, bus, sender, path, interface, signal, params
+    ):
+        (self.screensaver,) = params.unpack()
+        log.debug("Screensaver %s", "on" if self.screensaver else "off")
+        self.update()
+
+    def on_screensaver_get_active(self, bus, result, name):
+        try:
+            (active,) = bus.call_finish(result).unpack()
+        except GLib.Error:
+            return  # Not this screensaver
+        self.screensaver = bool(self.screensaver) or active
+        self.update()
+
+    #
+    # State
+    #
+
+    def update(self):
+        """Derive locked and active, and tell listeners what changed"""
+
+        locked = None
+        if self.locked_hint or self.screensaver is not None:
+            locked = any(self.locked_hint.values()) or bool(self.screensaver)
+        active = any(self.active_hint.values()) if self.active_hint else True
+
+        changed = set()
+        if locked != self.locked:
+            self.locked = locked
+            changed.add("locked")
+        if active != self.active:
+            self.active = active
+            log.info("Session %s", "active" if active else "inactive")
+            changed.add("active")
+        if changed:
+            self.notify(changed)
+
+    def notify(self, changed):
+        for callback in self.listeners:
+            callback(changed)
@@ -0,0 +1,110 @@
+"""Coalesced window updates.
+
+Engine state can change far faster than anyone can read it. UiSink keeps
+only the latest value of each piece of state and hands what changed to the
+window at most max_fps times a second, on the main loop. While no window is
+attached, posting only stores the value.
+"""
+
+import threading
+import time
+
+from gi.repository import GLib
+
+MISSING = object()
+
+
+class UiSink:
+    """Collect state with post(), apply it with attach(apply).
+
+    apply(changes) gets {key: latest value} for the keys changed since the
+    last frame. It may return keys it could not apply yet, they are tried
+    again next frame.
+    """
+
+    def __init__(self, max_fps=10):
+        self.frame = 1.0 / max_fps
+        self.apply = None
+        self.state = {}
+        self.dirty = set()
+        self.source = None  # GLib source of the next frame
+        self.last = 0.0  # time.monotonic() of the last frame
+        self.lock = threading.Lock()
+
+    def post(self, **values):
+        """Update state. Safe to call from any thread."""
+
+        with self.lock:
+            for key, value in values.items():
+                if self.state.get(key, MISSING) != value:
+                    self.state[key] = value
+                    self.dirty.add(key)
+            self.schedule()
+
+    def schedule(self):
+        if not self.dirty or self.apply is None or self.source is not None:
+            return
+        delay = max(0.0, self.last + self.frame - time.monotonic())
+        self.source = GLib.timeout_add(int(delay * 1000), self.flush)
+
+    def flush(self):
+        with self.lock:
+            self.source = None
+            if self.apply is None or not self.dirty:
+                return GLib.SOURCE_REMOVE
+            changes = {key: self.state[key] for key in self.dirty}
+            self.dirty.clear()
+            self.last = time.monotonic()
+            apply = self.apply
+
+        retry = apply(changes)
+
+        if retry:
+            with self.lock:
+                self.dirty |= set(retry)
+                self.schedule()
+        return GLib.SOURCE_REMOVE
+
+    def attach(self, apply):
+        """Start applying, beginning with all current state"""
+
+        with self.lock:
+            self.apply = apply
+            self.dirty = set(self.state)
+            self.schedule()
+
+    def detach(self):
+        """Stop applying, for when the window goes away"""
+
+        with self.lock:
+            self.apply = None
+            if self.source is not None:
+                GLib.source_remove(self.source)
+                self.source = None
+
+
+def sync_rows(store, rows, text_column=0, id_column=1):
+    """Make store hold rows, [(text, id)], touching only rows that differ.
+    Rows are matched by id. New rows are appended."""
+
+    wanted = {row_id: text for text, row_id in rows}
+    seen = set()
+    tree_iter = store.get_iter_first()
+    while tree_iter is not None:
+        row_id = store.get_value(tree_iter, id_column)
+        if row_id not in wanted or row_id in seen:
+            if not store.remove(tree_iter):
+                break  # Removed the last row
+            continue
+        seen.add(row_id)
+        if store.get_value(tree_iter, text_column) != wanted[row_id]:
+            store.set_value(tree_iter, text_column, wanted[row_id])
+        tree_iter = store.iter_next(tree_iter)
+
+    for text, row_id in rows:
+        if row_id not in seen:
+            seen.add(row_id)
+            row = [None] * store.get_n_columns()
+            row[text_column] = text
+            row[id_column] = row_id
+            store.append(row)
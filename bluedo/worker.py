@@ -0,0 +1,188 @@
+"""Persistent shell for user commands.
+
+Starting /bin/sh, and whatever the user's commands source, on every
+transition is slow. CommandWorker keeps one shell running, initialized
+once with command_init, and runs each command in a subshell of it, so
+the environment is already there and nothing the command changes leaks
+into the next one.
+"""
+
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import suppress
+
+from . import log
+
+INIT_TIMEOUT = 60.0  # Seconds command_init may take, apart from action_timeout
+
+
+class WorkerDied(ChildProcessError):
+    pass
+
+
+class InitFailed(ChildProcessError):
+    pass
+
+
+class CommandWorker:
+    """Run shell commands in a long-lived shell.
+
+    Output of a command ends at a marker line carrying its exit status.
+    A command that runs past its timeout is killed together with the
+    shell, and a dead shell is started again on the next run(). If init
+    fails to finish, run() raises InitFailed rather than run commands
+    without it, and tries again next time.
+    """
+
+    def __init__(self, shell="/bin/sh", init="", init_timeout=INIT_TIMEOUT):
+        self.shell = shell
+        self.init = init
+        self.init_timeout = init_timeout
+        self.process = None
+        self.marker = b""
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def start(self):
+        """Start the shell and run init now, so the first command doesn't
+        wait for them. Errors are logged, run() raises them again."""
+
+        with self.lock:
+            if self.closed or self.alive():
+                return
+            try:
+                self.launch()
+            except InitFailed as err:
+                if not self.closed:  # Not killed by close()
+                    log.error("%s", err)
+
+    def launch(self):
+        """Start the shell and run init in it, for at most init_timeout
+        seconds. Raises InitFailed if init didn't finish."""
+
+        self.spawn()
+        if not self.init:
+            return
+
+        # Not in a subshell, so the environment stays for later commands
+        try:
+            output, status = self.send(self.init, self.init_timeout, subshell=False)
+        except subprocess.TimeoutExpired:
+            raise InitFailed(
+                f"Command worker init still running after {self.init_timeout}s"
+            ) from None
+        except (BrokenPipeError, WorkerDied) as err:
+            self.kill()
+            raise InitFailed(f"Command worker died in init: {err}") from None
+        if status != 0:
+            log.warning(
+                "Command worker init exited with %s: %s", status, output.strip()
+            )
+
+    def spawn(self):
+        self.kill()  # Reap a shell that exited, close its pipes
+        self.marker = f"\n{uuid.uuid4().hex} ".encode()
+        self.process = subprocess.Popen(
+            [self.shell],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,  # So a timeout can kill the whole group
+        )
+        log.debug("Started command worker %s", self.process.pid)
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def run(self, cmd, timeout=None):
+        """Run cmd like subprocess.run(cmd, shell=True, check=True,
+        timeout=timeout) and return its output"""
+
+        with self.lock:
+            if not self.alive():
+                self.launch()
+            try:
+                output, status = self.send(cmd, timeout)
+            except (BrokenPipeError, WorkerDied):
+                # Died since the last command, try once with a fresh shell
+                self.kill()
+                self.launch()
+                output, status = self.send(cmd, timeout)
+
+        if output:
+            log.debug("Output of <%s>: %s", cmd, output.strip())
+        if status != 0:
+            raise subprocess.CalledProcessError(status, cmd, output=output)
+        return output
+
+    def send(self, cmd, timeout, subshell=True):
+        token = self.marker.decode().strip()
+        # stdin is the command pipe, a command reading it would eat the
+        # marker line
+        if subshell:
+            cmd = f"( {cmd}\n) < /dev/null 2>&1"
+        else:
+            cmd = f"{{ {cmd}\n}} < /dev/null 2>&1"
+        self.process.stdin.write(
+            f"{cmd}\nprintf '\\n%s %d\\n' {token} \"$?\"\n".encode()
+        )
+        self.process.stdin.flush()
+
+        try:
+            return self.read_result(timeout)
+        except subprocess.TimeoutExpired:
+            self.kill()
+            raise subprocess.TimeoutExpired(cmd, timeout) from None
+
+    def read_result(self, timeout):
+        """Read output up to the marker, return (output, status)"""
+
+        fd = self.process.stdout.fileno()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        buffer = bytearray()
+        while True:
+            end = buffer.find(self.marker)
+            if end >= 0:
+                newline = buffer.find(b"\n", end + len(self.marker))
+                if newline >= 0:
+                    status = int(buffer[end + len(self.marker) : newline])
+                    return bytes(buffer[:end]).decode(errors="replace"), status
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired("", timeout)
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise WorkerDied(f"Command worker exited with {self.process.wait()}")
+            buffer += chunk
+
+    def kill(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            with suppress(ProcessLookupError):
+                os.killpg(self.process.pid, signal.SIGKILL)
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process = None
+
+    def close(self):
+        self.closed = True
+        # Kill first, start() may hold the lock while init runs
+        process = self.process
+        if process is not None and process.poll() is None:
+            with suppress(ProcessLookupError):
+                os.killpg(process.pid, signal.SIGKILL)
+        with self.lock:
+            self.kill()
@@ -0,0 +1,118 @@
+import threading
+import time
+import unittest
+
+from bluedo.actions import Action, ActionExecutor
+
+TIMEOUT = 0.5
+
+
+class ActionExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = ActionExecutor(timeout=TIMEOUT)
+        self.reported = []
+        self.executor.on_result = self.reported.append
+        self.events = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.executor.batches.shutdown(wait=False, cancel_futures=True)
+        self.executor.pool.shutdown(wait=False, cancel_futures=True)
+
+    def record(self, event, delay=0.0):
+        def action():
+            with self.lock:
+                self.events.append(("start", event))
+            time.sleep(delay)
+            with self.lock:
+                self.events.append(("end", event))
+
+        return action
+
+    def test_priority_order(self):
+        results = self.executor.submit(
+            "away",
+            [
+                Action("mute", self.record("mute")),
+                Action("pause_music", self.record("pause_music")),
+                Action("lock", self.record("lock", 0.1), priority=0),
+            ],
+        ).result()
+        self.assertEqual(self.events[:2], [("start", "lock"), ("end", "lock")])
+        self.assertEqual(
+            {event for _, event in self.events[2:]}, {"mute", "pause_music"}
+        )
+        self.assertEqual(results[0].name, "lock")
+        self.assertTrue(all(result.error is None for result in results))
+
+    def test_same_priority_runs_together(self):
+        barrier = threading.Barrier(2, timeout=TIMEOUT)
+        results = self.executor.submit(
+            "here",
+            [Action("one", barrier.wait), Action("two", barrier.wait)],
+        ).result()
+        self.assertEqual([result.error for result in results], [None, None])
+
+    def test_failure_reported_others_run(self):
+        def fail():
+            raise RuntimeError("no session")
+
+        results = self.executor.submit(
+            "here",
+            [
+                Action("unlock", fail, priority=0),
+                Action("unmute", self.record("unmute")),
+            ],
+        ).result()
+        errors = {result.name: result.error for result in results}
+        self.assertIsInstance(errors["unlock"], RuntimeError)
+        self.assertIsNone(errors["unmute"])
+        self.assertEqual(
+            sorted(result.name for result in self.reported), ["unlock", "unmute"]
+        )
+
+    def test_timeout(self):
+        release = threading.Event()
+        started = time.monotonic()
+        results = self.executor.submit(
+            "away",
+            [
+                Action("hang", release.wait, priority=0),
+                Action("mute", self.record("mute")),
+            ],
+        ).result()
+        release.set()
+        self.assertLess(time.monotonic() - started, 5 * TIMEOUT)
+        errors = {result.name: result.error for result in results}
+        self.assertIsInstance(errors["hang"], TimeoutError)
+        self.assertIsNone(errors["mute"])  # The next group still runs
+        hung = next(result for result in results if result.name == "hang")
+        self.assertEqual(hung.elapsed, TIMEOUT)
+
+    def test_batches_in_order(self):
+        away = self.executor.submit("away", [Action("lock", self.record("lock", 0.1))])
+        here = self.executor.submit("here", [Action("unlock", self.record("unlock"))])
+        here.result()
+        self.assertTrue(away.done())
+        self.assertEqual(
+            [event for _, event in self.events], ["lock", "lock", "unlock", "unlock"]
+        )
+
+    def test_close_waits_for_batches(self):
+        self.executor.submit("here", [Action("unlock", self.record("unlock", 0.1))])
+        self.executor.close(timeout=5)
+        self.assertEqual(self.events[-1], ("end", "unlock"))
+        with self.assertRaises(RuntimeError):
+            self.executor.submit("away", [])
+
+    def test_close_timeout(self):
+        release = threading.Event()
+        self.executor.submit("away", [Action("hang", release.wait)])
+        started = time.monotonic()
+        self.executor.close(timeout=0.1)
+        self.assertLess(time.monotonic() - started, TIMEOUT)
+        release.set()
+
+
+if __name__ == "__main__":
+    unittest.main()
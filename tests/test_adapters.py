@@ -0,0 +1,173 @@
+import os
+import tempfile
+import unittest
+
+from bluedo import adapters
+from bluedo.probe import RssiSample
+
+ADDRESS = "AA:BB:CC:DD:EE:FF"
+
+
+class Radio:
+    """What each adapter hears, {index: {address: rssi}}, and who asked"""
+
+    def __init__(self, needs_connection=True):
+        self.needs_connection = needs_connection
+        self.heard = {}
+        self.asked = []  # (index, address)
+
+    def make_probe(self, backend, adapter=0, irks=()):
+        return FakeProbe(self, adapter)
+
+
+class FakeProbe:
+    def __init__(self, radio, adapter):
+        self.radio = radio
+        self.adapter = adapter
+        self.name = f"fake on hci{adapter}"
+        self.needs_connection = radio.needs_connection
+        self.closed = False
+
+    def read_rssi_many(self, addresses):
+        heard = self.radio.heard.get(self.adapter, {})
+        samples = {}
+        for address in addresses:
+            self.radio.asked.append((self.adapter, address))
+            rssi = heard.get(address)
+            samples[address] = (
+                None if rssi is None else RssiSample(address, rssi, 0.0, self.adapter)
+            )
+        return samples
+
+    def close(self):
+        self.closed = True
+
+
+class ListAdaptersTest(unittest.TestCase):
+    def test_skips_connections(self):
+        with tempfile.TemporaryDirectory() as sysfs:
+            for name in ("hci1", "hci0", "hci0:256", "hci10"):
+                os.mkdir(os.path.join(sysfs, name))
+            self.assertEqual(adapters.list_adapters(sysfs), [0, 1, 10])
+
+    def test_no_sysfs(self):
+        with tempfile.TemporaryDirectory() as sysfs:
+            missing = os.path.join(sysfs, "bluetooth")
+            self.assertEqual(adapters.list_adapters(missing), [0])
+
+    def test_adapter_index(self):
+        self.assertEqual(adapters.adapter_index("hci1"), 1)
+        self.assertEqual(adapters.adapter_index("2"), 2)
+
+
+class AdapterPoolTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.sysfs = tmp.name
+        self.plug("hci0", "hci1", "hci0:256")
+        self.radio = Radio()
+
+    def plug(self, *names):
+        for name in names:
+            os.mkdir(os.path.join(self.sysfs, name))
+
+    def unplug(self, name):
+        os.rmdir(os.path.join(self.sysfs, name))
+
+    def pool(self, **kwargs):
+        pool = adapters.AdapterPool(
+            sysfs=self.sysfs, make_probe=self.radio.make_probe, **kwargs
+        )
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_uses_present_adapters(self):
+        pool = self.pool()
+        self.assertEqual(sorted(pool.adapters), [0, 1])
+        self.assertEqual(pool.name, "auto on hci0, hci1")
+
+    def test_wanted_adapters(self):
+        pool = self.pool(adapters=["hci1"])
+        self.assertEqual(list(pool.adapters), [1])
+
+    def test_best(self):
+        self.radio.heard = {0: {ADDRESS: -8}, 1: {ADDRESS: -2}}
+        sample = self.pool().read_rssi(ADDRESS)
+        self.assertEqual((sample.rssi, sample.adapter), (-2, 1))
+
+    def test_mean(self):
+        self.radio.heard = {0: {ADDRESS: -8}, 1: {ADDRESS: -3}}
+        sample = self.pool(combine="mean").read_rssi(ADDRESS)
+        self.assertEqual((sample.rssi, sample.adapter), (-6, 1))
+
+    def test_mean_of_one(self):
+        self.radio.heard = {1: {ADDRESS: -3}}
+        self.assertEqual(self.pool(combine="mean").read_rssi(ADDRESS).rssi, -3)
+
+    def test_not_heard(self):
+        pool = self.pool()
+        self.assertIsNone(pool.read_rssi(ADDRESS))
+        self.assertEqual(pool.home, {})
+
+    def test_probed_on_home_only(self):
+        self.radio.heard = {1: {ADDRESS: -2}}
+        pool = self.pool()
+        pool.read_rssi(ADDRESS)
+        self.assertEqual(pool.home, {ADDRESS: 1})
+        self.radio.asked = []
+        self.assertEqual(pool.read_rssi(ADDRESS).rssi, -2)
+        self.assertEqual(self.radio.asked, [(1, ADDRESS)])
+
+    def test_ble_asks_every_adapter(self):
+        self.radio = Radio(needs_connection=False)
+        self.radio.heard = {1: {ADDRESS: -2}}
+        pool = self.pool()
+        pool.read_rssi(ADDRESS)
+        self.radio.asked = []
+        pool.read_rssi(ADDRESS)
+        self.assertEqual(sorted(self.radio.asked), [(0, ADDRESS), (1, ADDRESS)])
+
+    def test_failover_in_same_cycle(self):
+        self.radio.heard = {1: {ADDRESS: -2}}
+        pool = self.pool()
+        pool.read_rssi(ADDRESS)
+        self.radio.heard = {0: {ADDRESS: -4}}
+        self.radio.asked = []
+        sample = pool.read_rssi(ADDRESS)
+        self.assertEqual((sample.rssi, sample.adapter), (-4, 0))
+        self.assertEqual(self.radio.asked, [(1, ADDRESS), (0, ADDRESS)])
+        self.assertEqual(pool.home, {ADDRESS: 0})
+
+    def test_adapter_unplugged(self):
+        self.radio.heard = {0: {ADDRESS: -4}, 1: {ADDRESS: -2}}
+        pool = self.pool()
+        pool.read_rssi(ADDRESS)
+        gone = pool.adapters[1]
+        self.unplug("hci1")
+        sample = pool.read_rssi(ADDRESS)
+        self.assertEqual((sample.rssi, sample.adapter), (-4, 0))
+        self.assertEqual(list(pool.adapters), [0])
+        self.assertTrue(gone.probe.closed)
+
+    def test_adapter_plugged_in(self):
+        self.radio = Radio(needs_connection=False)
+        self.radio.heard = {2: {ADDRESS: -1}}
+        pool = self.pool()
+        self.assertIsNone(pool.read_rssi(ADDRESS))
+        self.plug("hci2")
+        self.assertEqual(pool.read_rssi(ADDRESS).adapter, 2)
+
+    def test_probe_error_counts_as_not_heard(self):
+        self.radio.heard = {1: {ADDRESS: -2}}
+        pool = self.pool()
+
+        def broken(addresses):
+            raise OSError("Adapter down")
+
+        pool.adapters[0].probe.read_rssi_many = broken
+        self.assertEqual(pool.read_rssi(ADDRESS).adapter, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
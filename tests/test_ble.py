@@ -0,0 +1,172 @@
+import struct
+import unittest
+
+from bluedo import ble
+from bluedo.ble import PUBLIC_ADDRESS, RANDOM_ADDRESS
+
+IDENTITY = "AA:BB:CC:DD:EE:FF"
+IRK_ENTRY = IDENTITY + "=" + "00112233445566778899aabbccddeeff"
+OTHER = "11:22:33:44:55:66"
+
+
+def report(address, address_type, rssi):
+    """Return an HCI LE Advertising Report event with one report"""
+
+    raw = bytes.fromhex(address.replace(":", ""))[::-1]
+    data = b"\x02\x01\x06"  # Flags
+    body = bytes([ble.EVT_LE_ADVERTISING_REPORT, 1, 0, address_type])
+    body += raw + bytes([len(data)]) + data + struct.pack("<b", rssi)
+    return bytes([ble.HCI_EVENT_PKT, ble.EVT_LE_META_EVENT, len(body)]) + body
+
+
+def extended_report(address, address_type, rssi, event_type=0x0013):
+    """Return an HCI LE Extended Advertising Report event with one report"""
+
+    raw = bytes.fromhex(address.replace(":", ""))[::-1]
+    data = b"\x02\x01\x06"
+    body = bytes([ble.EVT_LE_EXT_ADVERTISING_REPORT, 1])
+    body += ble.EXT_REPORT.pack(
+        event_type, address_type, raw, 1, 0, 0xFF, 127, rssi, 0, 0, bytes(6), len(data)
+    )
+    body += data
+    return bytes([ble.HCI_EVENT_PKT, ble.EVT_LE_META_EVENT, len(body)]) + body
+
+
+def private_address(irk, prand):
+    """Return the resolvable private address for prand under irk"""
+
+    cipher = ble.Cipher(ble.algorithms.AES(irk), ble.modes.ECB())
+    raw = prand + ble.ah(cipher, prand)
+    return ":".join(f"{byte:02X}" for byte in raw)
+
+
+class ParseTest(unittest.TestCase):
+    def test_advertising_report(self):
+        adverts = ble.parse_advertising_report(report(OTHER, PUBLIC_ADDRESS, -60), 2.0)
+        self.assertEqual(adverts, [ble.Advertisement(OTHER, PUBLIC_ADDRESS, -60, 2.0)])
+
+    def test_other_packet(self):
+        self.assertEqual(ble.parse_advertising_report(b"\x04\x0e\x04\x01", 0), [])
+
+    def test_rssi_unavailable(self):
+        packet = report(OTHER, PUBLIC_ADDRESS, 0)[:-1] + bytes([ble.RSSI_UNAVAILABLE])
+        self.assertEqual(ble.parse_advertising_report(packet, 0), [])
+
+    def test_extended_advertising_report(self):
+        packet = extended_report(OTHER, RANDOM_ADDRESS, -61)
+        self.assertEqual(
+            ble.parse_advertising_report(packet, 3.0),
+            [ble.Advertisement(OTHER, RANDOM_ADDRESS, -61, 3.0)],
+        )
+
+    def test_extended_report_skipped(self):
+        more_data = extended_report(OTHER, PUBLIC_ADDRESS, -61, event_type=0x0020)
+        anonymous = extended_report(OTHER, ble.ANONYMOUS_ADDRESS, -61)
+        unavailable = extended_report(OTHER, PUBLIC_ADDRESS, ble.RSSI_UNAVAILABLE)
+        for packet in (more_data, anonymous, unavailable):
+            self.assertEqual(ble.parse_advertising_report(packet, 0), [])
+
+
+class FakeSocket:
+    """HCI socket answering commands with Command Complete, status from
+    refused (opcode: status)"""
+
+    def __init__(self, refused=()):
+        self.refused = dict(refused)
+        self.sent = []
+        self.replies = []
+
+    def send(self, packet):
+        opcode = struct.unpack_from("<H", packet, 1)[0]
+        self.sent.append(opcode)
+        status = self.refused.get(opcode, 0)
+        self.replies.append(bytes([ble.HCI_EVENT_PKT, ble.EVT_CMD_COMPLETE, 4, 1]))
+        self.replies[-1] += struct.pack("<HB", opcode, status)
+
+    def recv(self, size):
+        return self.replies.pop(0)
+
+
+class ScannerTest(unittest.TestCase):
+    def scanner(self, refused=()):
+        scanner = ble.BleScanner()
+        scanner.sock = FakeSocket(refused)
+        return scanner
+
+    def test_legacy_scan(self):
+        scanner = self.scanner()
+        scanner.enable()
+        self.assertFalse(scanner.extended)
+        self.assertEqual(scanner.sock.sent[-1], ble.OPCODE_LE_SET_SCAN_ENABLE)
+
+    def test_extended_scan_after_legacy_refused(self):
+        disallowed = 0x0C
+        scanner = self.scanner({ble.OPCODE_LE_SET_SCAN_PARAMETERS: disallowed})
+        scanner.enable()
+        self.assertTrue(scanner.extended)
+        self.assertEqual(scanner.sock.sent[-1], ble.OPCODE_LE_SET_EXT_SCAN_ENABLE)
+        scanner.disable()
+        self.assertEqual(scanner.sock.sent[-1], ble.OPCODE_LE_SET_EXT_SCAN_ENABLE)
+
+    def test_both_refused(self):
+        scanner = self.scanner(
+            {
+                ble.OPCODE_LE_SET_SCAN_PARAMETERS: 0x0C,
+                ble.OPCODE_LE_SET_EXT_SCAN_PARAMETERS: 0x01,
+            }
+        )
+        with self.assertRaises(ble.CommandRefused):
+            scanner.enable()  # An error, not a scan that hears nothing
+
+
+@unittest.skipIf(ble.Cipher is None, "needs the cryptography package")
+class ResolveTest(unittest.TestCase):
+    def setUp(self):
+        self.irks = ble.parse_irks([IRK_ENTRY])
+        self.rpa = private_address(self.irks[IDENTITY], b"\x4a\x12\x34")
+        self.rpa2 = private_address(self.irks[IDENTITY], b"\x71\xfe\x01")
+
+    def test_resolver(self):
+        resolver = ble.Resolver(self.irks)
+        self.assertTrue(ble.resolvable(self.rpa, RANDOM_ADDRESS))
+        self.assertEqual(resolver.identity(self.rpa, RANDOM_ADDRESS), IDENTITY)
+        self.assertEqual(resolver.identity(OTHER, PUBLIC_ADDRESS), OTHER)
+        unknown = private_address(bytes(16), b"\x4a\x12\x34")
+        self.assertIsNone(resolver.identity(unknown, RANDOM_ADDRESS))
+
+    def test_recorded_advertisements(self):
+        recording = ble.RecordedAdvertisements(
+            [
+                (0.5, report(self.rpa, RANDOM_ADDRESS, -70)),
+                (1.0, report(self.rpa, RANDOM_ADDRESS, -50)),
+                (1.5, report(OTHER, PUBLIC_ADDRESS, -40)),
+                # The address rotated, same device
+                (2.0, report(self.rpa2, RANDOM_ADDRESS, -55)),
+                (9.0, report(self.rpa2, RANDOM_ADDRESS, -65)),
+            ]
+        )
+        probe = ble.BleProbe(
+            irks=self.irks, window=5.0, source=recording, clock=lambda: recording.now
+        )
+        addresses = [IDENTITY, OTHER, "00:00:00:00:00:01"]
+        probe.read_rssi_many(addresses)  # Starts the scan, nothing heard yet
+
+        recording.play(3.0)
+        samples = probe.read_rssi_many(addresses)
+        self.assertEqual(samples[IDENTITY].rssi, -55)  # Median of -70 -50 -55
+        self.assertEqual(samples[IDENTITY].timestamp, 2.0)
+        self.assertEqual(samples[OTHER].rssi, -40)
+        self.assertIsNone(samples["00:00:00:00:00:01"])
+
+        # Only the last advertisement is inside the window
+        recording.play(9.5)
+        samples = probe.read_rssi_many(addresses)
+        self.assertEqual(samples[IDENTITY].rssi, -65)
+        self.assertIsNone(samples[OTHER])
+
+        probe.close()
+        self.assertIsNone(recording.callback)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+from bluedo.bluez import DeviceInventory, FakeBus
+
+PHONE = "AA:BB:CC:DD:EE:FF"
+WATCH = "11:22:33:44:55:66"
+
+
+class DeviceInventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.bus = FakeBus()
+        self.bus.add_adapter()
+        self.phone = self.bus.add_device(PHONE, "Phone")
+        self.inventory = DeviceInventory(self.bus)
+        self.changes = 0
+        self.inventory.connect(self.changed)
+        self.inventory.start()
+
+    def tearDown(self):
+        self.inventory.stop()
+
+    def changed(self):
+        self.changes += 1
+
+    def test_initial_objects(self):
+        self.assertEqual(self.inventory.devices(), [("Phone", PHONE)])
+        self.assertEqual(self.inventory.adapters(), ["/org/bluez/hci0"])
+        self.assertEqual(self.inventory.device_path(PHONE.lower()), self.phone)
+
+    def test_device_added(self):
+        changes = self.changes
+        self.bus.add_device(WATCH, "Watch")
+        self.assertEqual(
+            sorted(self.inventory.devices()), [("Phone", PHONE), ("Watch", WATCH)]
+        )
+        self.assertGreater(self.changes, changes)
+
+    def test_properties_changed(self):
+        self.bus.change(self.phone, Name="Renamed")
+        self.assertEqual(self.inventory.devices(), [("Renamed", PHONE)])
+
+    def test_device_removed(self):
+        self.bus.remove(self.phone)
+        self.assertEqual(self.inventory.devices(), [])
+        self.assertIsNone(self.inventory.device_path(PHONE))
+
+    def test_no_adapter_no_devices(self):
+        self.bus.remove("/org/bluez/hci0")
+        self.assertEqual(self.inventory.adapters(), [])
+        self.assertEqual(self.inventory.devices(), [])
+
+    def test_stop_unsubscribes(self):
+        self.inventory.stop()
+        self.bus.add_device(WATCH, "Watch")
+        self.assertEqual(self.inventory.devices(), [("Phone", PHONE)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+from bluedo.calibrate import Calibrator, RssiSketch
+from bluedo.presence import NO_SIGNAL
+
+ADDRESS = "AA:BB:CC:DD:EE:FF"
+
+
+class RssiSketchTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertIsNone(RssiSketch().quantile(0.5))
+
+    def test_quantiles(self):
+        sketch = RssiSketch()
+        for rssi in range(-10, 0):  # -10 .. -1, ten values
+            sketch.add(rssi)
+        self.assertEqual(sketch.quantile(0.0), -10)
+        self.assertEqual(sketch.quantile(0.1), -10)
+        self.assertEqual(sketch.quantile(0.11), -9)
+        self.assertEqual(sketch.quantile(0.5), -6)
+        self.assertEqual(sketch.quantile(0.95), -1)
+        self.assertEqual(sketch.quantile(1.0), -1)
+
+    def test_repeated_values(self):
+        sketch = RssiSketch()
+        for rssi in (-3, -3, -3, -20):
+            sketch.add(rssi)
+        self.assertEqual(sketch.quantile(0.25), -20)
+        self.assertEqual(sketch.quantile(0.5), -3)
+
+    def test_clamped(self):
+        sketch = RssiSketch()
+        sketch.add(-500)
+        sketch.add(500)
+        self.assertEqual(sketch.quantile(0.0), -128)
+        self.assertEqual(sketch.quantile(1.0), 127)
+
+    def test_decay(self):
+        sketch = RssiSketch()
+        for _ in range(4):
+            sketch.add(-10)
+        sketch.decay(0.25)
+        for _ in range(3):
+            sketch.add(-2)
+        # -10 now weighs 1 against 3 for -2
+        self.assertEqual(sketch.total, 4)
+        self.assertEqual(sketch.quantile(0.25), -10)
+        self.assertEqual(sketch.quantile(0.5), -2)
+
+
+class CalibratorTest(unittest.TestCase):
+    def test_bands(self):
+        calibrator = Calibrator(min_samples=10)
+        self.assertIsNone(calibrator.bands(ADDRESS))
+        for _ in range(10):
+            calibrator.add(ADDRESS, -2, True)
+            calibrator.add(ADDRESS, None, True)  # Ignored at the desk
+            calibrator.add(ADDRESS, -14, False)
+        self.assertEqual(calibrator.here[ADDRESS].total, 10)
+        # Gap -14 .. -2, a third and two thirds into it
+        self.assertEqual(calibrator.bands(ADDRESS), (-10, -6, False))
+
+    def test_overlap(self):
+        calibrator = Calibrator(min_samples=1)
+        calibrator.add(ADDRESS, -8, True)
+        calibrator.add(ADDRESS, -4, False)
+        self.assertEqual(calibrator.bands(ADDRESS), (-8, -8, True))
+
+    def test_failed_probes_count_away(self):
+        calibrator = Calibrator(min_samples=1)
+        calibrator.add(ADDRESS, None, False)
+        self.assertEqual(calibrator.away[ADDRESS].quantile(0.5), NO_SIGNAL)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+
+from bluedo import config
+from bluedo.config import ConfigStore, Settings
+
+SECTION = "main"
+
+
+class SettingsTest(unittest.TestCase):
+    def test_derived_values_follow(self):
+        settings = Settings(threshold=-6, interval=4.0).resolved()
+        self.assertEqual(settings.here_threshold, -6)
+        self.assertEqual(settings.min_interval, 1.0)
+        self.assertEqual(settings.max_interval, 8.0)
+
+    def test_here_threshold_not_below_threshold(self):
+        settings = Settings(threshold=-4, here_threshold=-8).resolved()
+        self.assertEqual(settings.here_threshold, -4)
+
+    def test_invalid_value_uses_default(self):
+        store = ConfigStore(os.devnull)
+        store.load(f"[{SECTION}]\naway_count = 0\nrssi_filter = bogus\nquorum = 2\n")
+        settings = Settings.from_config(store, SECTION)
+        self.assertEqual(settings.away_count, Settings().away_count)
+        self.assertEqual(settings.rssi_filter, Settings().rssi_filter)
+        self.assertEqual(settings.quorum, 2)
+
+    def test_validate(self):
+        with self.assertRaises(ValueError):
+            config.validate("bt_address", "AA:BB")
+        with self.assertRaises(ValueError):
+            config.validate("ble_irks", ("AA:BB:CC:DD:EE:FF=00",))
+        config.validate("probe_adapters", ("hci0", "1"))
+
+
+class ConfigStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "bluedo.ini")
+        self.store = ConfigStore(self.path, delay=60)
+        self.store.load()
+
+    def tearDown(self):
+        self.store.flush()
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.path, encoding="utf8") as f:
+            return f.read()
+
+    def test_dirty_only_on_change(self):
+        self.store.add_section(SECTION)
+        self.store.set(SECTION, "threshold", "-4")
+        self.assertTrue(self.store.dirty)
+        self.store.flush()
+        self.assertFalse(self.store.dirty)
+        self.store.set(SECTION, "threshold", "-4")
+        self.assertFalse(self.store.dirty)
+
+    def test_flush_writes_once(self):
+        self.store.add_section(SECTION)
+        self.store.set(SECTION, "threshold", "-4")
+        self.store.schedule_flush()
+        self.assertFalse(os.path.exists(self.path))
+        self.store.flush()
+        self.assertIsNone(self.store.timer)
+        self.assertIn("threshold = -4", self.read())
+
+        os.unlink(self.path)
+        self.store.flush()  # Nothing changed
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_atomic_write_keeps_mode(self):
+        config.atomic_write(self.path, "old\n")
+        os.chmod(self.path, 0o640)
+        config.atomic_write(self.path, "new\n")
+        self.assertEqual(self.read(), "new\n")
+        self.assertEqual(os.stat(self.path).st_mode & 0o7777, 0o640)
+        self.assertEqual(os.listdir(self.directory.name), ["bluedo.ini"])
+
+    def test_atomic_write_new_file_follows_umask(self):
+        umask = os.umask(0o027)
+        try:
+            config.atomic_write(self.path, "new\n")
+            self.assertEqual(os.umask(0o027), 0o027)  # Left alone
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(self.path).st_mode & 0o7777, 0o640)
+        self.assertEqual(os.listdir(self.directory.name), ["bluedo.ini"])
+
+    def test_remove_option_marks_dirty(self):
+        self.store.add_section(SECTION)
+        self.store.set(SECTION, "threshold", "-4")
+        self.store.flush()
+        self.store.remove_option(SECTION, "threshold")
+        self.assertTrue(self.store.dirty)
+
+    def test_reload(self):
+        self.store.add_section(SECTION)
+        self.store.set(SECTION, "threshold", "-4")
+        self.store.flush()
+        self.assertFalse(self.store.reload())  # Our own write
+
+        config.atomic_write(self.path, f"[{SECTION}]\nthreshold = -9\n")
+        self.assertTrue(self.store.reload())
+        self.assertEqual(self.store.get(SECTION, "threshold"), "-9")
+        self.assertFalse(self.store.dirty)
+
+    def test_derived_values_not_saved(self):
+        Settings(threshold=-6).to_config(self.store, SECTION)
+        self.store.flush()
+        text = self.read()
+        self.assertIn("threshold = -6", text)
+        self.assertNotIn("here_threshold", text)
+        self.assertNotIn("max_interval", text)
+
+        self.store.load()
+        settings = Settings.from_config(self.store, SECTION)
+        self.assertEqual(settings, Settings(threshold=-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+from bluedo import history
+from bluedo.presence import AWAY, HERE
+
+ADDRESS = "AA:BB:CC:DD:EE:FF"
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "history")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_ring_wraps_oldest_first(self):
+        recorder = history.HistoryRecorder(self.path, capacity=16).open()
+        for index in range(20):
+            recorder.append(float(index), ADDRESS, -index, HERE if index % 2 else AWAY)
+        recorder.close()
+
+        rows = list(history.records(self.path))
+        self.assertEqual(len(rows), 16)
+        self.assertEqual(rows[0], (4.0, ADDRESS, -4, AWAY))
+        self.assertEqual(rows[-1], (19.0, ADDRESS, -19, HERE))
+
+    def test_reopen_appends(self):
+        history.HistoryRecorder(self.path, capacity=16).open().close()
+        recorder = history.HistoryRecorder(self.path, capacity=16).open()
+        recorder.append(1.0, ADDRESS, -200, HERE)  # Clamped to int8
+        recorder.close()
+        recorder = history.HistoryRecorder(self.path, capacity=16).open()
+        recorder.append(2.0, ADDRESS, -3, HERE)
+        recorder.close()
+        self.assertEqual(
+            [rssi for _, _, rssi, _ in history.records(self.path)], [-128, -3]
+        )
+
+    @unittest.skipIf(history.numpy is None, "needs numpy")
+    def test_load(self):
+        recorder = history.HistoryRecorder(self.path, capacity=16).open()
+        recorder.append(1.0, ADDRESS, -3, HERE)
+        recorder.append(2.0, "11:22:33:44:55:66", -5, AWAY)
+        recorder.close()
+        data = history.load(self.path, ADDRESS)
+        self.assertEqual(list(data["rssi"]), [-3])
+
+
+if __name__ == "__main__":
+    unittest.main()
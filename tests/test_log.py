@@ -0,0 +1,64 @@
+import unittest
+
+from bluedo.log import Logger
+
+
+class AdmitTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = Logger(period=3600, burst=3)
+
+    def admit(self, key, message):
+        return self.logger.admit(key, message)
+
+    def next_period(self, key):
+        self.logger.limits[key].start -= self.logger.period
+
+    def test_burst(self):
+        self.assertEqual([self.admit("probe", n) for n in range(3)], [0, 0, 0])
+        self.assertIsNone(self.admit("probe", 3))
+        self.assertIsNone(self.admit("probe", 4))
+        self.next_period("probe")
+        self.assertEqual(self.admit("probe", 5), 2)  # Dropped ones counted
+        self.assertEqual(self.admit("probe", 6), 0)
+
+    def test_repeat_dropped(self):
+        self.assertEqual(self.admit("rssi", -3), 0)
+        self.assertIsNone(self.admit("rssi", -3))
+        self.assertIsNone(self.admit("rssi", -3))
+        self.assertEqual(self.admit("rssi", -4), 2)
+        self.assertEqual(self.admit("rssi", -3), 0)  # Only the previous one
+
+    def test_repeat_once_a_period(self):
+        self.admit("rssi", -3)
+        self.assertIsNone(self.admit("rssi", -3))
+        self.next_period("rssi")
+        self.assertEqual(self.admit("rssi", -3), 1)
+
+    def test_types_limited_apart(self):
+        for n in range(3):
+            self.admit("probe", n)
+        self.assertIsNone(self.admit("probe", 3))
+        self.assertEqual(self.admit("adapter", 3), 0)
+
+    def test_key(self):
+        logger = Logger(period=3600, burst=1)
+        logger.debug_enabled = True
+        logger.start = lambda: None  # Queue only, no writer thread
+        logger.info("Probe of %s failed", "a", key="probe")
+        logger.info("Probe of %s timed out", "b", key="probe")
+        logger.info("Unrelated")
+        queued = []
+        while not logger.queue.empty():
+            queued.append(logger.queue.get()[1])
+        self.assertEqual(queued, ["Probe of %s failed", "Unrelated"])
+
+    def test_debug_off(self):
+        logger = Logger()
+        logger.start = lambda: None
+        logger.debug("Probe timed out")
+        self.assertTrue(logger.queue.empty())
+        self.assertEqual(logger.limits, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import socket
+import tempfile
+import unittest
+from collections import namedtuple
+
+from bluedo import metrics
+
+Result = namedtuple("Result", "name error elapsed")
+
+
+class FormatTest(unittest.TestCase):
+    def test_counter(self):
+        counter = metrics.Counter("bluedo_test_total", "Things.", 'action="lock"')
+        counter.inc()
+        counter.inc(2)
+        self.assertEqual(
+            counter.header() + counter.render(),
+            [
+                "# HELP bluedo_test_total Things.",
+                "# TYPE bluedo_test_total counter",
+                'bluedo_test_total{action="lock"} 3',
+            ],
+        )
+
+    def test_gauge(self):
+        gauge = metrics.Gauge("bluedo_test", "A level.")
+        gauge.set(2.5)
+        self.assertEqual(gauge.header()[1], "# TYPE bluedo_test gauge")
+        self.assertEqual(gauge.render(), ["bluedo_test 2.5"])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("bluedo_test_seconds", "Times.", (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.header()[1], "# TYPE bluedo_test_seconds histogram")
+        self.assertEqual(
+            histogram.render(),
+            [
+                'bluedo_test_seconds_bucket{le="0.1"} 2',
+                'bluedo_test_seconds_bucket{le="1.0"} 3',
+                'bluedo_test_seconds_bucket{le="+Inf"} 4',
+                "bluedo_test_seconds_sum 3.65",
+                "bluedo_test_seconds_count 4",
+            ],
+        )
+
+    def test_histogram_labels(self):
+        histogram = metrics.Histogram("bluedo_t", "T.", (1.0,), 'action="lock"')
+        histogram.observe(2.0)
+        self.assertEqual(
+            histogram.render(),
+            [
+                'bluedo_t_bucket{action="lock",le="1.0"} 0',
+                'bluedo_t_bucket{action="lock",le="+Inf"} 1',
+                'bluedo_t_sum{action="lock"} 2.0',
+                'bluedo_t_count{action="lock"} 1',
+            ],
+        )
+
+    def test_render(self):
+        collected = metrics.Metrics()
+        collected.probes.inc(4)
+        collected.action(Result("lock", None, 0.02))
+        collected.action(Result("lock", TimeoutError("lock"), 10.0))
+        collected.adapter("hci1").up.set(1)
+        text = collected.render()
+
+        self.assertTrue(text.endswith("\n"))
+        lines = text.splitlines()
+        self.assertIn("bluedo_probes_total 4", lines)
+        self.assertIn('bluedo_action_failures_total{action="lock"} 1', lines)
+        self.assertIn('bluedo_action_seconds_count{action="lock"} 2', lines)
+        self.assertIn('bluedo_adapter_up{adapter="hci1"} 1', lines)
+        # One HELP and TYPE per metric family
+        types = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+        self.assertEqual(len(types), len(set(types)))
+        for line in lines:
+            if not line.startswith("#"):
+                float(line.rsplit(" ", 1)[1])
+
+
+class ExporterTest(unittest.TestCase):
+    def test_socket(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.sock")
+            collected = metrics.Metrics()
+            collected.probes.inc()
+            exporter = metrics.Exporter(collected, socket_path=path)
+            exporter.start()
+            try:
+                for _ in range(2):
+                    with socket.socket(socket.AF_UNIX) as client:
+                        client.connect(path)
+                        text = client.makefile(encoding="utf8").read()
+                    self.assertEqual(text, collected.render())
+            finally:
+                exporter.stop()
+            self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
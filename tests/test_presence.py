@@ -0,0 +1,81 @@
+import unittest
+
+from bluedo import presence
+from bluedo.presence import AWAY, HERE, LEAVING, PresenceEngine
+
+ADDRESS = "AA:BB:CC:DD:EE:FF"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def feed(engine, *readings):
+    """Feed one reading per cycle, return the events"""
+    return [engine.feed({ADDRESS: rssi}) for rssi in readings]
+
+
+class PresenceEngineTest(unittest.TestCase):
+    def test_away_after_away_count(self):
+        engine = PresenceEngine(-5, away_count=3)
+        self.assertEqual(feed(engine, -8, -8), [None, None])
+        self.assertEqual(feed(engine, -8), [AWAY])
+        self.assertEqual(engine.state, AWAY)
+
+    def test_near_reading_resets_away_count(self):
+        engine = PresenceEngine(-5, away_count=3)
+        self.assertEqual(feed(engine, -8, -8, -2, -8, -8), [None] * 5)
+        self.assertEqual(engine.state, HERE)
+
+    def test_failed_probes_count_as_gone(self):
+        engine = PresenceEngine(-5, away_count=2)
+        self.assertEqual(feed(engine, None, None), [None, AWAY])
+
+    def test_hysteresis(self):
+        engine = PresenceEngine(-5, here_threshold=-2, away_count=1)
+        self.assertEqual(feed(engine, -8), [AWAY])
+        # Above threshold but under here_threshold: still away
+        self.assertEqual(feed(engine, -4, -3), [None, None])
+        self.assertEqual(feed(engine, -2), [HERE])
+
+    def test_here_count(self):
+        engine = PresenceEngine(-5, away_count=1, here_count=2)
+        feed(engine, -8)
+        self.assertEqual(feed(engine, -1, -8, -1), [None, None, None])
+        self.assertEqual(feed(engine, -1), [HERE])
+
+    def test_disabled_never_goes_away(self):
+        engine = PresenceEngine(-5, away_count=1)
+        self.assertIsNone(engine.feed({ADDRESS: -8}, enabled=False))
+        self.assertEqual(engine.state, HERE)
+
+    def test_quorum(self):
+        engine = PresenceEngine(-5, away_count=1, quorum=2)
+        self.assertEqual(engine.feed({"A": -1, "B": -9}), AWAY)
+        self.assertIsNone(engine.feed({"A": -1, "B": -9}))
+        self.assertEqual(engine.feed({"A": -1, "B": -1}), HERE)
+
+    def test_leaving_counts_towards_away(self):
+        clock = Clock()
+        engine = PresenceEngine(
+            -5,
+            away_count=2,
+            predictor=presence.TrendPredictor(window=3, slope=1.0),
+            predict="warn",
+            clock=clock,
+        )
+        events = []
+        for rssi in (-1, -3, -6, -9):
+            clock.now += 1
+            events.append(engine.feed({ADDRESS: rssi}))
+        self.assertIn(LEAVING, events)
+        # -6 and -9 are under threshold, so away comes on the second
+        self.assertEqual(events[-1], AWAY)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+from bluedo.bluez import DeviceInventory, FakeBus
+from bluedo.reconnect import BASE_DELAY, JITTER, MAX_DELAY, MISSES, ReconnectManager
+
+ADDRESS = "AA:BB:CC:DD:EE:FF"
+
+
+class FixedRandom:
+    def __init__(self, value):
+        self.value = value
+
+    def random(self):
+        return self.value
+
+
+class RecordingManager(ReconnectManager):
+    """Records attempts instead of connecting"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.started = []
+
+    def start(self, address, attempt):
+        self.started.append(address)
+        attempt.cancellable = object()  # Running
+
+
+class DelayTest(unittest.TestCase):
+    def test_doubles_up_to_max(self):
+        manager = ReconnectManager(rng=FixedRandom(0.0))
+        delays = [manager.delay(tries) for tries in range(1, 10)]
+        self.assertEqual(delays[:4], [BASE_DELAY * 2**n for n in range(4)])
+        self.assertEqual(delays[-1], MAX_DELAY)
+        self.assertEqual(delays, sorted(delays))
+        self.assertEqual(manager.delay(1000), MAX_DELAY)  # No overflow
+
+    def test_jitter(self):
+        manager = ReconnectManager(rng=FixedRandom(1.0))
+        self.assertEqual(manager.delay(1), BASE_DELAY * (1 - JITTER))
+
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = RecordingManager(rng=FixedRandom(0.0))
+
+    def test_starts_after_misses(self):
+        for _ in range(MISSES - 1):
+            self.manager.update({ADDRESS: None})
+        self.assertEqual(self.manager.started, [])
+        self.manager.update({ADDRESS: None})
+        self.assertEqual(self.manager.started, [ADDRESS])
+        self.manager.update({ADDRESS: None})  # Still running
+        self.assertEqual(self.manager.started, [ADDRESS])
+
+    def test_reading_resets(self):
+        for _ in range(MISSES - 1):
+            self.manager.update({ADDRESS: None})
+        self.manager.update({ADDRESS: -3})
+        self.manager.update({ADDRESS: None})
+        self.assertEqual(self.manager.started, [])
+        self.assertEqual(self.manager.attempts[ADDRESS].misses, 1)
+
+    def test_waits_after_failure(self):
+        for _ in range(MISSES):
+            self.manager.update({ADDRESS: None})
+        attempt = self.manager.attempts[ADDRESS]
+        self.manager.finish(ADDRESS, attempt, False, "failed")
+        self.assertEqual(attempt.tries, 1)
+        self.assertIsNone(attempt.cancellable)
+        self.manager.update({ADDRESS: None})
+        self.assertEqual(len(self.manager.started), 1)  # Not before next_at
+
+        attempt.next_at = 0.0
+        self.manager.update({ADDRESS: None})
+        self.assertEqual(len(self.manager.started), 2)
+
+    def test_unprobed_device_dropped(self):
+        self.manager.update({ADDRESS: None})
+        self.manager.update({})
+        self.assertEqual(self.manager.attempts, {})
+
+
+class DevicePathTest(unittest.TestCase):
+    def test_from_inventory(self):
+        bus = FakeBus()
+        bus.add_adapter("/org/bluez/hci1")
+        path = bus.add_device(ADDRESS, "Phone", adapter="/org/bluez/hci1")
+        inventory = DeviceInventory(bus)
+        inventory.start()
+        self.assertEqual(
+            ReconnectManager(inventory=inventory).device_path(ADDRESS), path
+        )
+
+    def test_guessed(self):
+        self.assertEqual(
+            ReconnectManager(adapter=2).device_path(ADDRESS),
+            "/org/bluez/hci2/dev_AA_BB_CC_DD_EE_FF",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from bluedo import replay
+from bluedo.config import Settings
+from bluedo.presence import AWAY, HERE, LEAVING
+
+ADDRESS = replay.SYNTHETIC_ADDRESS
+INTERVAL = 5.0
+
+
+def trace(*readings):
+    return [(index * INTERVAL, {ADDRESS: rssi}) for index, rssi in enumerate(readings)]
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        # Here for 4 cycles, gone for 6 with one stray reading, back for 3
+        self.cycles = trace(-1, -2, -1, -1, -9, None, -3, None, None, None, -2, -1, -1)
+        self.truth = [True] * 4 + [False] * 6 + [True] * 3
+
+    def test_replay(self):
+        settings = Settings(threshold=-4, away_count=3).resolved()
+        events = replay.replay(self.cycles, settings)
+        # The stray -3 resets the count, so away is three misses after it
+        self.assertEqual(events, [(45.0, AWAY), (50.0, HERE)])
+
+    def test_score(self):
+        combos = [(-4, -4, 3, 1), (-4, -4, 2, 1), (-2, -2, 1, 1)]
+        events, faster, jumpy = replay.sweep_engines(self.cycles, combos, 1, "none")
+        self.assertEqual(events, [(9, AWAY), (10, HERE)])
+        self.assertEqual(
+            replay.score(self.cycles, events, self.truth),
+            {"aways": 1, "heres": 1, "false_aways": 0, "missed": 0, "delay": 25.0},
+        )
+        self.assertEqual(replay.score(self.cycles, faster, self.truth)["delay"], 5.0)
+
+        summary = replay.score(self.cycles, jumpy, self.truth)
+        self.assertEqual(summary["false_aways"], 0)
+        self.assertEqual(summary["delay"], 0.0)
+        self.assertEqual(
+            replay.score(self.cycles, jumpy, None).keys(), {"aways", "heres"}
+        )
+
+    def test_missed_and_false_away(self):
+        events = [(2, AWAY), (3, HERE)]
+        summary = replay.score(self.cycles, events, self.truth)
+        self.assertEqual(summary["false_aways"], 1)
+        self.assertEqual(summary["missed"], 1)
+        self.assertIsNone(summary["delay"])
+
+    def test_csv_trace(self):
+        text = (
+            "timestamp,address,rssi\n"
+            "# A comment\n"
+            f"0.0,{ADDRESS},-3\n"
+            "\n"
+            ",,\n"
+            f"0.0,{ADDRESS}\n"
+            f"5.0,{ADDRESS},\n"
+            f"5.0,{ADDRESS},strong\n"
+            "later,x,1\n"
+            f"10.0,{ADDRESS},-1\n"
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.csv")
+            with open(path, "w", encoding="utf8") as f:
+                f.write(text)
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                cycles = replay.csv_trace(path)
+        self.assertEqual(
+            cycles,
+            [(0.0, {ADDRESS: -3}), (5.0, {ADDRESS: None}), (10.0, {ADDRESS: -1})],
+        )
+        self.assertIn("Skipped 3 malformed rows", stderr.getvalue())
+        self.assertIn("line 6", stderr.getvalue())
+
+    @unittest.skipIf(replay.numpy is None, "needs numpy")
+    def test_sweep_numpy_matches_engines(self):
+        cycles, _ = replay.synthetic_trace(3, hours=6)
+        combos = [(-4, -4, 3, 1), (-6, -3, 2, 2), (-2, -2, 1, 1)]
+        self.assertEqual(
+            replay.sweep_numpy(cycles, combos, 1, "none"),
+            replay.sweep_engines(cycles, combos, 1, "none"),
+        )
+
+    def test_synthetic_trace(self):
+        cycles, truth = replay.synthetic_trace(1)
+        self.assertEqual(len(cycles), len(truth))
+        self.assertEqual(replay.synthetic_trace(1)[0], cycles)  # Seeded
+
+        settings = Settings().resolved()
+        index = {timestamp: i for i, (timestamp, _) in enumerate(cycles)}
+        events = [
+            (index[timestamp], event)
+            for timestamp, event in replay.replay(cycles, settings)
+            if event != LEAVING
+        ]
+        summary = replay.score(cycles, events, truth)
+        self.assertGreater(summary["aways"], 0)
+        self.assertEqual(summary["false_aways"], 0)
+        self.assertEqual(summary["missed"], 0)
+        self.assertLess(summary["delay"], 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from bluedo.presence import AWAY, HERE, NO_SIGNAL
+from bluedo.scheduler import AdaptiveInterval
+
+THRESHOLD = -10
+
+
+class AdaptiveIntervalTest(unittest.TestCase):
+    def setUp(self):
+        self.pacer = AdaptiveInterval(1.0, 8.0, margin=3, backoff=2.0, deadband=3.0)
+
+    def steps(self, *readings, state=HERE, here_threshold=None):
+        return [
+            self.pacer.next(rssi, THRESHOLD, state, here_threshold=here_threshold)
+            for rssi in readings
+        ]
+
+    def test_backs_off_while_steady(self):
+        self.assertEqual(self.steps(-2, -2, -2, -2, -2), [2.0, 4.0, 8.0, 8.0, 8.0])
+        self.assertEqual(self.pacer.rate, 1 / 8)
+
+    def test_noise_inside_deadband_keeps_backing_off(self):
+        self.assertEqual(self.steps(-2, -4, -2, -4), [2.0, 4.0, 8.0, 8.0])
+
+    def test_drop_halves(self):
+        self.steps(-2, -2, -2)
+        self.assertEqual(self.steps(-6), [4.0])
+
+    def test_near_threshold_or_failed_is_fast(self):
+        self.steps(-2, -2, -2)
+        self.assertEqual(self.steps(-8), [1.0])
+        self.steps(-2, -2)
+        self.assertEqual(self.steps(None), [1.0])
+        self.steps(-2, -2)
+        self.assertEqual(self.steps(NO_SIGNAL), [1.0])
+
+    def test_away_backs_off(self):
+        self.assertEqual(
+            self.steps(None, None, -30, None, state=AWAY), [2.0, 4.0, 8.0, 8.0]
+        )
+
+    def test_away_fast_when_near_here_threshold(self):
+        self.steps(None, None, None, state=AWAY)
+        self.assertEqual(self.steps(-6, state=AWAY, here_threshold=-5), [1.0])
+        self.assertEqual(self.steps(-9, state=AWAY, here_threshold=-5), [2.0])
+        # here_threshold defaults to threshold
+        self.assertEqual(self.steps(-12, state=AWAY), [1.0])
+
+    def test_min_above_max(self):
+        pacer = AdaptiveInterval(20.0, 8.0)
+        self.assertEqual(pacer.next(None, THRESHOLD), 8.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
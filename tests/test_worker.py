@@ -0,0 +1,74 @@
+import os
+import subprocess
+import time
+import unittest
+
+from bluedo.worker import CommandWorker, InitFailed
+
+
+class CommandWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.worker = CommandWorker(init="export BLUEDO_TEST=kept; cd /")
+
+    def tearDown(self):
+        self.worker.close()
+
+    def test_init_environment_kept(self):
+        self.worker.start()
+        self.assertEqual(self.worker.run("echo $BLUEDO_TEST"), "kept\n")
+        self.assertEqual(self.worker.run("pwd"), "/\n")
+
+    def test_commands_run_in_subshells(self):
+        self.worker.run("BLUEDO_TEST=changed; cd /tmp")
+        self.assertEqual(self.worker.run("echo $BLUEDO_TEST; pwd"), "kept\n/\n")
+
+    def test_failed_command(self):
+        with self.assertRaises(subprocess.CalledProcessError) as caught:
+            self.worker.run("echo oops; exit 3")
+        self.assertEqual(caught.exception.returncode, 3)
+        self.assertEqual(caught.exception.output, "oops\n")
+
+    def test_stdin_not_read(self):
+        self.assertEqual(self.worker.run("read line; echo done", timeout=5), "done\n")
+
+    def test_timeout_kills_and_restarts(self):
+        self.worker.run("true")
+        pid = self.worker.process.pid
+        started = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            self.worker.run("sleep 30", timeout=0.2)
+        self.assertLess(time.monotonic() - started, 5)
+        with self.assertRaises(ProcessLookupError):
+            os.killpg(pid, 0)  # The whole group is gone
+
+        # A fresh shell, initialized again
+        self.assertEqual(self.worker.run("echo $BLUEDO_TEST"), "kept\n")
+        self.assertNotEqual(self.worker.process.pid, pid)
+
+    def test_restart_after_shell_exit(self):
+        self.worker.start()
+        self.worker.process.stdin.write(b"exit\n")
+        self.worker.process.stdin.flush()
+        self.worker.process.wait()
+        self.assertEqual(self.worker.run("echo $BLUEDO_TEST"), "kept\n")
+
+    def test_init_not_bound_by_command_timeout(self):
+        worker = CommandWorker(init="sleep 0.5; export BLUEDO_TEST=slow")
+        try:
+            self.assertEqual(worker.run("echo $BLUEDO_TEST", timeout=0.2), "slow\n")
+        finally:
+            worker.close()
+
+    def test_init_timeout_fails_commands(self):
+        worker = CommandWorker(init="sleep 30", init_timeout=0.2)
+        try:
+            worker.start()  # Logged
+            self.assertFalse(worker.alive())
+            with self.assertRaises(InitFailed):
+                worker.run("true")
+        finally:
+            worker.close()
+
+
+if __name__ == "__main__":
+    unittest.main()